@@ -0,0 +1,110 @@
+import os
+from argparse import ArgumentParser
+from itertools import combinations
+from typing import Optional
+
+import polars as pl
+
+from analysis_utils.correlations import correlation_table
+from analysis_utils.lag_times import MOTILITY_MEASURES, lag_time_index
+from analysis_utils.loading import tracking_dataframe_columns
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.results import STAGES, run_analysis_stages
+
+static_measures = [
+    "cell_shape",
+    "cell_area_mum_squared",
+    "local_density_per_mum_squared",
+    "nucleus_shape",
+    "nucleus_area_mum_squared",
+]
+
+grouping_sets = [
+    (),
+    ("cell_line_name",),
+    ("cell_line_name", "cell_culture_methodology"),
+]
+
+
+def compute_correlations(df_file: str) -> dict[str, dict]:
+    pairs = list(combinations(static_measures, 2))
+
+    for lag_time_columns in lag_time_index(
+        tracking_dataframe_columns(df_file)
+    ).values():
+        motility_measures = [
+            lag_time_columns[m] for m in MOTILITY_MEASURES if m in lag_time_columns
+        ]
+
+        pairs.extend((sm, mm) for sm in static_measures for mm in motility_measures)
+        pairs.extend(combinations(motility_measures, 2))
+
+    table = correlation_table(df_file, pairs, grouping_sets=grouping_sets)
+
+    # one record with the table as columns of plain values
+    return {"correlations": table.to_dict(as_series=False)}
+
+
+def render_correlations(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    # nothing to draw, the correlation table is the result
+    pl.DataFrame(records["correlations"]).write_csv(
+        os.path.join(parent_dir_out, "correlations.csv")
+    )
+
+
+def correlations(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "correlations",
+        compute_correlations,
+        render_correlations,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
+    parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering, unused since there are no figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
+    args = parser.parse_args()
+
+    with profile_task(
+        "correlations", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        correlations(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
@@ -1,46 +1,53 @@
 import os
 from argparse import ArgumentParser
+from typing import Optional
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-import polars as pl
-import seaborn as sns
-from scipy.stats import gaussian_kde, pearsonr
-
-plt.rcParams.update(
-    {
-        "text.usetex": False,
-        "font.family": "sans-serif",
-        "font.sans-serif": ["Fira Sans"],
-        "mathtext.fontset": "stixsans",
-    }
+
+from analysis_utils.correlations import correlation_table, lookup_correlation
+from analysis_utils.kde import stratified_grid_kde
+from analysis_utils.lag_times import (
+    LAG_TIME_COLUMN,
+    MOTILITY_MEASURES,
+    motility_column,
+    scan_lag_time_view,
+    tracking_lag_times,
 )
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.quantiles import column_quantiles
+from analysis_utils.rendering import DEFAULT_RC_PARAMS, FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
+from analysis_utils.sampling import Stratum, stratified_reservoir_sample
+
+# cells drawn per scatter plot, the correlations use all cells
+SAMPLE_SIZE = 30_000
+SAMPLE_SEED = 0
 
 
-def plot_d2min_vs_crsd(crsd, d2min, title: str):
+def plot_d2min_vs_crsd(
+    crsd, d2min, density, crsd_cutoff: float, d2min_cutoff: float, title: str
+):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     f = plt.figure(figsize=(5, 5))
     ax = f.add_subplot(111)
 
-    kde = gaussian_kde(np.vstack((crsd, d2min)))
-    z = kde(np.vstack((crsd, d2min)))
-
     # Sort the points by density, so that the densest points are plotted last
-    idx = np.argsort(z)
-    crsd, d2min, z = crsd[idx], d2min[idx], z[idx]
+    idx = np.argsort(density)
+    crsd, d2min, z = crsd[idx], d2min[idx], density[idx]
 
     ax.scatter(crsd, d2min, c=z, s=1, edgecolor=None, cmap="Reds", alpha=0.5)
     ax.plot(
-        [0, np.percentile(crsd, 97)],
-        [0, np.percentile(crsd, 97)],
+        [0, crsd_cutoff],
+        [0, crsd_cutoff],
         "r--",
         alpha=0.25,
         linewidth=2,
     )
 
-    ax.set_xlim(0, np.percentile(crsd, 97))
-    ax.set_ylim(0, np.percentile(d2min, 97))
+    ax.set_xlim(0, crsd_cutoff)
+    ax.set_ylim(0, d2min_cutoff)
 
     ax.set_xlabel(r"CRSD in $\left[\mu m^2\right]$", fontfamily="sans-serif")
     ax.set_ylabel(
@@ -59,52 +66,149 @@ def plot_d2min_vs_crsd(crsd, d2min, title: str):
     return f
 
 
-def d2min_vs_crsd(df_file: str, parent_dir_out: str):
-    # read in combined cell tracking dataframe from ipc file
-    big_dataframe: pl.DataFrame = pl.read_ipc(df_file, memory_map=False)
+def compute_d2min_vs_crsd(df_file: str) -> dict[str, dict]:
+    crsd_measure = "cage_relative_squared_displacement_mum_squared"
 
-    # get a list of all lag times
-    all_lag_times = [
-        lt.removesuffix("_minutes").removeprefix("D2min_")
-        for lt in [c for c in big_dataframe.columns if "D2min_" in c]
-    ]
+    # all lag times with both motility measures
+    all_lag_times = tracking_lag_times(df_file, list(MOTILITY_MEASURES))
 
-    for lt in all_lag_times:
-        crsd_col = f"cage_relative_squared_displacement_mum_squared_{lt}_min"
-        d2min_col = f"D2min_{lt}_minutes"
+    pairs = {
+        lt: (motility_column(crsd_measure, lt), motility_column("D2min", lt))
+        for lt in all_lag_times
+    }
 
-        current_df = big_dataframe.filter(
-            pl.col(crsd_col).is_not_nan() & pl.col(d2min_col).is_not_nan()
-        )
+    # correlations for all lag times in a single grouped query
+    correlations = correlation_table(
+        scan_lag_time_view(df_file, [crsd_measure, "D2min"], lag_times=all_lag_times),
+        [(crsd_measure, "D2min")],
+        grouping_sets=[(LAG_TIME_COLUMN,)],
+    )
+
+    strata = {lt: Stratum(columns=pair) for lt, pair in pairs.items()}
+
+    # samples for all lag times in a single pass over the data
+    samples = stratified_reservoir_sample(
+        df_file, strata, size=SAMPLE_SIZE, seed=SAMPLE_SEED
+    )
+
+    # point density of all cells, evaluated at the sampled ones
+    densities = stratified_grid_kde(
+        df_file,
+        strata,
+        {lt: samples[lt].get_columns() for lt in strata},
+    )
+
+    records: dict[str, dict] = {}
 
-        # calculate pearson correlation coefficient
-        pearson_corr = pearsonr(
-            current_df[crsd_col].to_numpy(), current_df[d2min_col].to_numpy()
-        ).statistic
+    for lt, (crsd_col, d2min_col) in pairs.items():
 
-        current_sampled_df = current_df.sample(n=min(30_000, len(current_df)))
+        crsd = samples[lt][crsd_col].to_numpy()
+        d2min = samples[lt][d2min_col].to_numpy()
 
-        current_figure = plot_d2min_vs_crsd(
-            current_sampled_df[crsd_col],
-            current_sampled_df[d2min_col],
-            r"$D^2 _\text{min}$ vs CRSD ($\tau = "
-            + lt
-            + " \textit{{min}}$)"
-            + f"(Pearson correlation: {pearson_corr:.2f})",
+        correlation = lookup_correlation(
+            correlations, crsd_measure, "D2min", **{LAG_TIME_COLUMN: str(lt)}
         )
 
-        current_figure.savefig(
-            os.path.join(parent_dir_out, f"d2min_vs_crsd_{lt}_minutes.png"),
-            dpi=300,
-            bbox_inches="tight",
+        records[f"d2min_vs_crsd_{lt}_minutes"] = {
+            "lag_time": str(lt),
+            "crsd": crsd,
+            "d2min": d2min,
+            "density": densities[lt],
+            # cutoffs of all cells, not only of the sampled ones
+            "crsd_cutoff": column_quantiles(df_file, crsd_col, [0.97])[0],
+            "d2min_cutoff": column_quantiles(df_file, d2min_col, [0.97])[0],
+            "pearson_r": correlation["pearson_r"],
+            "pearson_pvalue": correlation["pearson_pvalue"],
+            "spearman_r": correlation["spearman_r"],
+            "spearman_pvalue": correlation["spearman_pvalue"],
+            "num_cells": correlation["n"],
+            "num_sampled_cells": len(crsd),
+        }
+
+    return records
+
+
+def render_d2min_vs_crsd(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    figure_jobs: list[FigureJob] = []
+
+    for name, record in records.items():
+        figure_jobs.append(
+            FigureJob(
+                plot_function=plot_d2min_vs_crsd,
+                kwargs={
+                    "crsd": record["crsd"],
+                    "d2min": record["d2min"],
+                    "density": record["density"],
+                    "crsd_cutoff": record["crsd_cutoff"],
+                    "d2min_cutoff": record["d2min_cutoff"],
+                    "title": r"$D^2 _\text{min}$ vs CRSD ($\tau = "
+                    + record["lag_time"]
+                    + " \textit{{min}}$)"
+                    + f"(Pearson correlation: {record['pearson_r']:.2f})",
+                },
+                filename=f"{name}.png",
+                savefig_kwargs={"dpi": 300, "bbox_inches": "tight"},
+            )
         )
 
+    render_figures(
+        figure_jobs, parent_dir_out, workers=workers, rc_params=DEFAULT_RC_PARAMS
+    )
+
+
+def d2min_vs_crsd(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "d2min_vs_crsd",
+        compute_d2min_vs_crsd,
+        render_d2min_vs_crsd,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
+
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    d2min_vs_crsd(args.dataframe_file, args.parent_dir_out)
+    with profile_task(
+        "d2min_vs_crsd", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        d2min_vs_crsd(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
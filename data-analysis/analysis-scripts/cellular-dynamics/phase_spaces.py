@@ -1,23 +1,18 @@
 import os
 import sys
 from argparse import ArgumentParser
-from itertools import product
 from typing import Optional
 
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
 import numpy as np
 import polars as pl
-import seaborn as sns
-
-plt.rcParams.update(
-    {
-        "text.usetex": False,
-        "font.family": "sans-serif",
-        "font.sans-serif": ["Fira Sans"],
-        "mathtext.fontset": "stixsans",
-    }
-)
+
+from analysis_utils.binned_statistics import binned_statistics_2d
+from analysis_utils.lag_times import MOTILITY_MEASURES, lag_time_index
+from analysis_utils.loading import load_tracking_dataframe, tracking_dataframe_columns
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.quantiles import column_quantiles
+from analysis_utils.rendering import DEFAULT_RC_PARAMS, FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
 
 latex_strings = {
     "cell_shape": {"name": "Cell Shape", "formula": "cs", "unit": ""},
@@ -75,51 +70,26 @@ def get_label_string(quant_name, exponent) -> str:
     return label
 
 
-def rescale_data(data: np.array) -> np.array:
+def rescale_data(data: np.array, where: Optional[np.array] = None) -> np.array:
+    # the exponent is determined from the values selected by 'where' only,
+    # but all values are rescaled
     data = data.copy()
     exponent: int = 0
 
-    while np.abs(data).max() < 1:
+    abs_max = np.abs(data).max(where=True if where is None else where, initial=0)
+
+    # no values to determine the exponent from
+    if not np.isfinite(abs_max) or abs_max == 0:
+        return data, exponent
+
+    while abs_max < 1:
         data *= 10.0
+        abs_max *= 10.0
         exponent += 1
 
     return data, -exponent
 
 
-def create_2d_heatmap(
-    independent_x, indenpendent_y, dependent_z, num_bins=20, min_count: int = 2
-) -> tuple[np.array, tuple[np.array, np.array]]:
-
-    # Create 2D histogram-like bins
-    x_bins = np.linspace(min(independent_x), max(independent_x), num_bins + 1)
-    y_bins = np.linspace(min(indenpendent_y), max(indenpendent_y), num_bins + 1)
-
-    # Digitize the x and y data
-    x_indices = np.digitize(independent_x, x_bins) - 1
-    y_indices = np.digitize(indenpendent_y, y_bins) - 1
-
-    # Create empty grid for the values
-    heatmap_data = np.zeros((num_bins, num_bins))
-    count_grid = np.zeros((num_bins, num_bins))
-
-    # Fill the grid with mean values
-    for x_idx, y_idx, val in zip(x_indices, y_indices, dependent_z):
-        if x_idx < num_bins and y_idx < num_bins:  # Prevent index out of bounds
-            heatmap_data[y_idx, x_idx] += val
-            count_grid[y_idx, x_idx] += 1
-
-    # Calculate means (avoid division by zero)
-    mask = count_grid > min_count
-    heatmap_data[mask] = heatmap_data[mask] / count_grid[mask]
-    heatmap_data[~mask] = np.nan
-
-    # the origin should be in the lower left corner
-    heatmap_data = np.flipud(heatmap_data)
-    y_bins = np.flipud(y_bins)
-
-    return heatmap_data, (x_bins, y_bins)
-
-
 def plot_heatmap(
     matrix,
     x_bins,
@@ -130,6 +100,9 @@ def plot_heatmap(
     colorbar_label,
     z_cutoff: Optional[float] = None,
 ):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # Create the plot
     fig = plt.figure(figsize=(10, 10))
     ax = fig.add_subplot(111)
@@ -172,21 +145,15 @@ def plot_heatmap(
     plt.xticks(rotation=45, ha="right")
     plt.yticks(rotation=45, ha="right")
 
-    return fig
+    fig.tight_layout()
 
+    return fig
 
-def phase_spaces(df_file: str, parent_dir_out: str):
-
-    # step 1: read in combined cell tracking dataframe from ipc file
-    big_dataframe: pl.DataFrame = pl.read_ipc(df_file, memory_map=False)
 
-    # get a list of all lag times
-    all_lag_times = [
-        lt.removesuffix("_minutes").removeprefix("D2min_")
-        for lt in [c for c in big_dataframe.columns if "D2min_" in c]
-    ]
+def compute_phase_spaces(df_file: str) -> dict[str, dict]:
 
-    all_motility_measures = ["D2min", "cage_relative_squared_displacement_mum_squared"]
+    # motility columns of all lag times
+    lag_time_columns = lag_time_index(tracking_dataframe_columns(df_file))
 
     # specify phase_space independent variables, x,y tuples
     indendent_vars: list[tuple[str, str]] = [
@@ -195,33 +162,103 @@ def phase_spaces(df_file: str, parent_dir_out: str):
         ("nucleus_shape", "nucleus_area_mum_squared"),
     ]
 
-    for (inx_col, iny_col), mot_m, lag_time in product(
-        indendent_vars, all_motility_measures, all_lag_times
-    ):
+    motility_columns: dict[str, tuple[str, str]] = {
+        columns[mot_m]: (mot_m, str(lag_time))
+        for mot_m in MOTILITY_MEASURES
+        for lag_time, columns in lag_time_columns.items()
+        if mot_m in columns
+    }
 
-        motility_measure = (
-            f"{mot_m}_{lag_time}_minutes"
-            if mot_m == "D2min"
-            else f"{mot_m}_{lag_time}_min"
-        )
+    # step 1: read in the required columns of the combined cell tracking dataframe
+    big_dataframe: pl.DataFrame = load_tracking_dataframe(
+        df_file,
+        columns=[
+            *dict.fromkeys(c for xy_cols in indendent_vars for c in xy_cols),
+            *motility_columns,
+        ],
+    )
 
-        current_filtered_df: pl.DataFrame = big_dataframe.filter(
-            pl.col(motility_measure).is_not_nan()
-        )
+    motility_values: dict[str, np.array] = {
+        motility_measure: big_dataframe[motility_measure].to_numpy()
+        for motility_measure in motility_columns
+    }
+    motility_valid: dict[str, np.array] = {
+        motility_measure: ~np.isnan(values)
+        for motility_measure, values in motility_values.items()
+    }
 
-        x_vals = current_filtered_df[inx_col].to_numpy()
-        y_vals = current_filtered_df[iny_col].to_numpy()
+    # the same colorbar cutoff for all phase spaces of a motility measure
+    z_cutoffs: dict[str, float] = {
+        motility_measure: column_quantiles(df_file, motility_measure, [0.96])[0]
+        for motility_measure in motility_columns
+    }
 
-        x_vals, x_exponent = rescale_data(x_vals)
-        y_vals, y_exponent = rescale_data(y_vals)
+    records: dict[str, dict] = {}
+
+    for inx_col, iny_col in indendent_vars:
+
+        all_x_vals = big_dataframe[inx_col].to_numpy()
+        all_y_vals = big_dataframe[iny_col].to_numpy()
+
+        # group motility measures by the exponents of their rescaled x / y values,
+        # so that all measures of a group are binned in a single pass
+        measure_groups: dict[tuple[int, int], list[str]] = {}
+        rescaled_x_vals: dict[int, np.array] = {}
+        rescaled_y_vals: dict[int, np.array] = {}
+
+        for motility_measure, valid in motility_valid.items():
+            if not valid.any():
+                # e.g. a lag time longer than all tracks
+                continue
+
+            x_vals, x_exponent = rescale_data(all_x_vals, where=valid)
+            y_vals, y_exponent = rescale_data(all_y_vals, where=valid)
+
+            rescaled_x_vals.setdefault(x_exponent, x_vals)
+            rescaled_y_vals.setdefault(y_exponent, y_vals)
+            measure_groups.setdefault((x_exponent, y_exponent), []).append(
+                motility_measure
+            )
+
+        for (x_exponent, y_exponent), group_measures in measure_groups.items():
+
+            heatmaps = binned_statistics_2d(
+                rescaled_x_vals[x_exponent],
+                rescaled_y_vals[y_exponent],
+                {m: motility_values[m] for m in group_measures},
+                statistics=("mean", "count"),
+            )
+
+            for motility_measure in group_measures:
+                mot_m, lag_time = motility_columns[motility_measure]
+                heatmap = heatmaps[motility_measure]
+
+                records[f"{motility_measure}_vs_{inx_col}_and_{iny_col}"] = {
+                    "mean": heatmap.grids["mean"],
+                    "count": heatmap.grids["count"],
+                    "x_bins": heatmap.x_bins,
+                    "y_bins": heatmap.y_bins,
+                    "x_column": inx_col,
+                    "y_column": iny_col,
+                    "x_exponent": x_exponent,
+                    "y_exponent": y_exponent,
+                    "motility_measure": mot_m,
+                    "lag_time": lag_time,
+                    "z_cutoff": z_cutoffs[motility_measure],
+                    "num_cells": int(motility_valid[motility_measure].sum()),
+                }
+
+    return records
+
+
+def render_phase_spaces(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    figure_jobs: list[FigureJob] = []
 
-        x_label = get_label_string(inx_col, x_exponent)
-        y_label = get_label_string(iny_col, y_exponent)
-        matrix, (xbin, ybin) = create_2d_heatmap(
-            x_vals,
-            y_vals,
-            current_filtered_df[motility_measure],
-        )
+    for name, record in records.items():
+        mot_m, lag_time = record["motility_measure"], record["lag_time"]
+        inx_col, iny_col = record["x_column"], record["y_column"]
 
         motility_str = (
             "$"
@@ -232,38 +269,80 @@ def phase_spaces(df_file: str, parent_dir_out: str):
             + " min\\right)$"
         )
 
-        fig = plot_heatmap(
-            matrix,
-            xbin,
-            ybin,
-            x_label=x_label,
-            y_label=y_label,
-            title=f"{motility_str} vs {latex_strings[inx_col]['name']} and {latex_strings[iny_col]['name']}",
-            colorbar_label=motility_str,
-            z_cutoff=np.percentile(
-                current_filtered_df[motility_measure].to_numpy(), 96
-            ),
+        figure_jobs.append(
+            FigureJob(
+                plot_function=plot_heatmap,
+                kwargs={
+                    "matrix": record["mean"],
+                    "x_bins": record["x_bins"],
+                    "y_bins": record["y_bins"],
+                    "x_label": get_label_string(inx_col, record["x_exponent"]),
+                    "y_label": get_label_string(iny_col, record["y_exponent"]),
+                    "title": f"{motility_str} vs {latex_strings[inx_col]['name']} and {latex_strings[iny_col]['name']}",
+                    "colorbar_label": motility_str,
+                    "z_cutoff": record["z_cutoff"],
+                },
+                filename=f"{name}.png",
+                savefig_kwargs={"bbox_inches": "tight", "dpi": 500},
+            )
         )
 
-        fig.tight_layout()
+    render_figures(
+        figure_jobs, parent_dir_out, workers=workers, rc_params=DEFAULT_RC_PARAMS
+    )
 
-        fig.savefig(
-            os.path.join(
-                parent_dir_out,
-                f"{motility_measure}_vs_{inx_col}_and_{iny_col}.png",
-            ),
-            bbox_inches="tight",
-            dpi=500,
-        )
 
-        plt.close(fig)
+def phase_spaces(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "phase_spaces",
+        compute_phase_spaces,
+        render_phase_spaces,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
 
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    phase_spaces(args.dataframe_file, args.parent_dir_out)
+    with profile_task(
+        "phase_spaces", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        phase_spaces(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
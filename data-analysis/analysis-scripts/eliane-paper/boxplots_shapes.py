@@ -3,47 +3,180 @@
 
 import os
 from argparse import ArgumentParser
+from typing import Optional
 
 import numpy as np
 import polars as pl
-import seaborn as sns
-from matplotlib import pyplot as plt
-
-plt.rcParams.update(
-    {
-        "text.usetex": False,
-        "font.family": "sans-serif",
-        "font.sans-serif": ["Fira Sans"],
-        "mathtext.fontset": "stixsans",
-    }
-)
-
-
-def boxplot_shapes(df_file: str, parent_dir_out: str):
-    big_dataframe: pl.DataFrame = pl.read_ipc(df_file, memory_map=True)
-
-    for cln in ["hela", "caski"]:
-        cdf = big_dataframe.filter(pl.col("cell_line_name").str.to_lowercase().eq(cln))
-        f = plt.figure(figsize=(5, 5))
-        ax = f.add_subplot(111)
-        sns.violinplot(data=cdf, ax=ax, x="cell_culture_methodology", y="cell_shape")
-        ax.set_title(cln)
-
-        sns.despine(f, ax)
-        f.tight_layout()
-
-        f.savefig(
-            os.path.join(parent_dir_out, f"{cln}_cell_shape_boxplot.png"),
-            dpi=500,
-            bbox_inches="tight",
+
+from analysis_utils.loading import cell_line_filter
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.rendering import DEFAULT_RC_PARAMS, FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
+from analysis_utils.violins import plot_violins, violin_arrays, violin_summary_table
+
+# all columns are summarized in the same pass, one figure per cell line each
+SHAPE_COLUMNS = ["cell_shape"]
+
+
+def plot_shape_violins(
+    cell_culture_methodology: np.ndarray,
+    support: np.ndarray,
+    density: np.ndarray,
+    q1: np.ndarray,
+    median: np.ndarray,
+    q3: np.ndarray,
+    whisker_low: np.ndarray,
+    whisker_high: np.ndarray,
+    column: str,
+    title: str,
+):
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
+    f = plt.figure(figsize=(5, 5))
+    ax = f.add_subplot(111)
+    plot_violins(
+        ax,
+        cell_culture_methodology,
+        support,
+        density,
+        q1,
+        median,
+        q3,
+        whisker_low,
+        whisker_high,
+    )
+    ax.set_xlabel("cell_culture_methodology")
+    ax.set_ylabel(column)
+    ax.set_title(title)
+
+    sns.despine(f, ax)
+    f.tight_layout()
+
+    return f
+
+
+def compute_boxplot_shapes(df_file: str) -> dict[str, dict]:
+    cell_line_names = ["hela", "caski"]
+
+    # box and violin summaries of all columns and groups in a single query
+    summaries = violin_summary_table(
+        df_file,
+        columns=SHAPE_COLUMNS,
+        group_by=["cell_line_name", "cell_culture_methodology"],
+        filters=[pl.any_horizontal([cell_line_filter(cln) for cln in cell_line_names])],
+    )
+
+    records: dict[str, dict] = {}
+
+    for column in SHAPE_COLUMNS:
+        for cln in cell_line_names:
+            try:
+                violins = violin_arrays(
+                    summaries,
+                    "cell_culture_methodology",
+                    column=column,
+                    cell_line_name=cln,
+                )
+            except KeyError:
+                # no cells of this cell line
+                continue
+
+            records[f"{cln}_{column}_boxplot"] = {
+                "cell_line_name": cln,
+                "column": column,
+                **violins,
+                "num_cells": int(violins["num_values"].sum()),
+            }
+
+    return records
+
+
+def render_boxplot_shapes(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    figure_jobs: list[FigureJob] = [
+        FigureJob(
+            plot_function=plot_shape_violins,
+            kwargs={
+                **{
+                    k: record[k]
+                    for k in [
+                        "cell_culture_methodology",
+                        "support",
+                        "density",
+                        "q1",
+                        "median",
+                        "q3",
+                        "whisker_low",
+                        "whisker_high",
+                        "column",
+                    ]
+                },
+                "title": record["cell_line_name"],
+            },
+            filename=f"{name}.png",
+            savefig_kwargs={"dpi": 500, "bbox_inches": "tight"},
         )
+        for name, record in records.items()
+    ]
+
+    render_figures(
+        figure_jobs, parent_dir_out, workers=workers, rc_params=DEFAULT_RC_PARAMS
+    )
+
+
+def boxplot_shapes(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "boxplot_shapes",
+        compute_boxplot_shapes,
+        render_boxplot_shapes,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
 
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    boxplot_shapes(args.dataframe_file, args.parent_dir_out)
+    with profile_task(
+        "boxplot_shapes", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        boxplot_shapes(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
@@ -3,76 +3,218 @@
 
 import os
 from argparse import ArgumentParser
+from typing import Optional
 
 import numpy as np
 import polars as pl
-import seaborn as sns
-from matplotlib import pyplot as plt
-from scipy.stats import gaussian_kde, pearsonr, spearmanr
 from tqdm import tqdm
 
+from analysis_utils.correlations import correlation_table, lookup_correlation
+from analysis_utils.kde import stratified_grid_kde
+from analysis_utils.lag_times import (
+    LAG_TIME_COLUMN,
+    motility_column,
+    scan_lag_time_view,
+    tracking_lag_times,
+)
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.quantiles import column_quantiles
+from analysis_utils.rendering import FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
+from analysis_utils.sampling import Stratum, stratified_reservoir_sample
+
+# cells drawn per scatter plot, the correlations use all cells
+SAMPLE_SIZE = 20_000
+SAMPLE_SEED = 0
+
+
+def plot_motility_vs_density(
+    local_density: np.array,
+    motility: np.array,
+    density: np.array,
+    x_max: float,
+    y_max: float,
+    target_column: str,
+    title: str,
+):
+    from matplotlib import pyplot as plt
+
+    f = plt.figure(figsize=(5, 5))
+    ax = f.add_subplot(111)
+    ax.scatter(
+        local_density,
+        motility,
+        c=density,
+        s=2,
+        cmap="Reds",
+        edgecolor=None,
+    )
+    ax.set_xlabel("local_density_per_mum_squared")
+    ax.set_ylabel(target_column)
+
+    ax.set_ylim(0, y_max)
+    ax.set_xlim(0, x_max)
+    ax.set_title(title)
+
+    return f
 
-def cell_density(df_file: str, parent_dir_out: str):
 
-    big_df = pl.read_ipc(
+def compute_cell_density(df_file: str) -> dict[str, dict]:
+
+    lag_times_minutes = tracking_lag_times(df_file, ["D2min"])
+
+    lag_time_view = scan_lag_time_view(
         df_file,
-        memory_map=False,
+        ["D2min"],
+        columns=["local_density_per_mum_squared"],
+        lag_times=lag_times_minutes,
     )
 
-    lag_times_minutes = "30,60,90,120,150,180,210,240".split(",")
+    # correlations for all lag times in a single grouped query
+    correlations = correlation_table(
+        lag_time_view,
+        [("local_density_per_mum_squared", "D2min")],
+        grouping_sets=[(LAG_TIME_COLUMN,)],
+    )
 
-    for lt in tqdm(lag_times_minutes):
-        target_column = f"D2min_{lt}_minutes"
+    # axis limits of all cells with a motility value at the lag time, not only
+    # of the sampled ones
+    x_max = dict(
+        lag_time_view.filter(pl.col("D2min").is_not_nan())
+        .group_by(LAG_TIME_COLUMN)
+        .agg(pl.col("local_density_per_mum_squared").quantile(0.97, "linear"))
+        .collect()
+        .iter_rows()
+    )
 
-        filtered_df = big_df.filter(pl.col(target_column).is_not_nan())
+    strata = {
+        lt: Stratum(
+            columns=["local_density_per_mum_squared", motility_column("D2min", lt)]
+        )
+        for lt in lag_times_minutes
+    }
 
-        sampled_df = filtered_df.sample(n=min(20_000, len(filtered_df)))
-        # Calculate the local density using gaussian_kde
+    # samples for all lag times in a single pass over the data
+    samples = stratified_reservoir_sample(
+        df_file, strata, size=SAMPLE_SIZE, seed=SAMPLE_SEED
+    )
 
-        print(
-            spearmanr(
-                filtered_df["local_density_per_mum_squared"], filtered_df[target_column]
-            )
-        )
+    # point density of all cells, evaluated at the sampled ones
+    densities = stratified_grid_kde(
+        df_file,
+        strata,
+        {lt: samples[lt].get_columns() for lt in strata},
+    )
 
-        kde = gaussian_kde(
-            [sampled_df["local_density_per_mum_squared"], sampled_df[target_column]]
-        )
-        density = kde(
-            [sampled_df["local_density_per_mum_squared"], sampled_df[target_column]]
-        )
+    records: dict[str, dict] = {}
 
-        f = plt.figure(figsize=(5, 5))
-        ax = f.add_subplot(111)
-        sns.scatterplot(
-            ax=ax,
-            data=sampled_df,
-            x="local_density_per_mum_squared",
-            y=target_column,
-            hue=density,
-            s=2,
-            palette="Reds",
-            edgecolor=None,
-        )
+    for lt in tqdm(lag_times_minutes):
+        target_column = motility_column("D2min", lt)
+
+        local_density = samples[lt]["local_density_per_mum_squared"].to_numpy()
+        motility = samples[lt][target_column].to_numpy()
 
-        ax.set_ylim(0, np.percentile(sampled_df[target_column], 97))
-        ax.set_xlim(0, np.percentile(sampled_df["local_density_per_mum_squared"], 97))
-        ax.set_title(
-            f"Motility vs. Density at {lt} minutes (Pearson: {pearsonr(filtered_df['local_density_per_mum_squared'], filtered_df[target_column])[0]:.2f})"
+        correlation = lookup_correlation(
+            correlations,
+            "local_density_per_mum_squared",
+            "D2min",
+            **{LAG_TIME_COLUMN: str(lt)},
         )
 
-        f.savefig(
-            os.path.join(parent_dir_out, f"motility_vs_density_{lt}_minutes.png"),
-            bbox_inches="tight",
-            dpi=400,
+        records[f"motility_vs_density_{lt}_minutes"] = {
+            "lag_time": str(lt),
+            "target_column": target_column,
+            "local_density": local_density,
+            "motility": motility,
+            "density": densities[lt],
+            "x_max": x_max[lt],
+            "y_max": column_quantiles(df_file, target_column, [0.97])[0],
+            "pearson_r": correlation["pearson_r"],
+            "pearson_pvalue": correlation["pearson_pvalue"],
+            "spearman_r": correlation["spearman_r"],
+            "spearman_pvalue": correlation["spearman_pvalue"],
+            "num_cells": correlation["n"],
+            "num_sampled_cells": len(motility),
+        }
+
+    return records
+
+
+def render_cell_density(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    figure_jobs: list[FigureJob] = [
+        FigureJob(
+            plot_function=plot_motility_vs_density,
+            kwargs={
+                "local_density": record["local_density"],
+                "motility": record["motility"],
+                "density": record["density"],
+                "x_max": record["x_max"],
+                "y_max": record["y_max"],
+                "target_column": record["target_column"],
+                "title": f"Motility vs. Density at {record['lag_time']} minutes (Pearson: {record['pearson_r']:.2f})",
+            },
+            filename=f"{name}.png",
+            savefig_kwargs={"bbox_inches": "tight", "dpi": 400},
         )
+        for name, record in records.items()
+    ]
+
+    render_figures(figure_jobs, parent_dir_out, workers=workers)
+
+
+def cell_density(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "cell_density",
+        compute_cell_density,
+        render_cell_density,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
 
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    cell_density(args.dataframe_file, args.parent_dir_out)
+    with profile_task(
+        "cell_density", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        cell_density(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
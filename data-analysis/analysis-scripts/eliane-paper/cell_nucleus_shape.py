@@ -3,103 +3,224 @@
 
 import os
 from argparse import ArgumentParser
+from typing import Optional
 
 import numpy as np
-import polars as pl
-import seaborn as sns
-from matplotlib import pyplot as plt
-from scipy.stats import gaussian_kde, pearsonr
-
-plt.rcParams.update(
-    {
-        "text.usetex": False,
-        "font.family": "sans-serif",
-        "font.sans-serif": ["Fira Sans"],
-        "mathtext.fontset": "stixsans",
-    }
-)
-
-
-def cell_nucleus_shape(df_file: str, parent_dir_out: str):
 
-    # read in combined cell tracking dataframe from ipc file
-    big_dataframe: pl.DataFrame = pl.read_ipc(df_file, memory_map=False)
+from analysis_utils.correlations import correlation_table, lookup_correlation
+from analysis_utils.kde import stratified_grid_kde
+from analysis_utils.loading import cell_line_filter, culture_method_filter
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.quantiles import column_quantiles
+from analysis_utils.rendering import DEFAULT_RC_PARAMS, FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
+from analysis_utils.sampling import Stratum, stratified_reservoir_sample
+
+# cells drawn per scatter plot, the correlations use all cells
+SAMPLE_SIZE = 30_000
+SAMPLE_SEED = 0
+
+
+def plot_cell_nucleus_shape(
+    cell_shape: np.ndarray,
+    nucleus_shape: np.ndarray,
+    density: np.ndarray,
+    xlim: np.ndarray,
+    ylim: np.ndarray,
+    title: str,
+):
+    import seaborn as sns
+    from matplotlib import pyplot as plt
 
     font_size = 12
 
-    for cln in ["hela", "caski"]:
-        cell_line_df = big_dataframe.filter(
-            pl.col("cell_line_name").str.to_lowercase().eq(cln)
-        )
-        for ccm in ["co-culture", "control"]:
-            current_df = cell_line_df.filter(
-                pl.col("cell_culture_methodology").str.to_lowercase().eq(ccm)
-            )
-            current_sampled_df = current_df.sample(n=min(30_000, len(current_df)))
-
-            pR = pearsonr(current_df["cell_shape"], current_df["nucleus_shape"])
+    f = plt.figure(figsize=(5, 5))
+    ax = f.add_subplot(111)
+    ax.scatter(
+        cell_shape,
+        nucleus_shape,
+        s=0.75,
+        c=density,
+        cmap="Reds",
+        edgecolor=None,
+    )
+
+    f.tight_layout()
+    ax.set_title(title, fontsize=int(1.4 * font_size))
+
+    # Set axis line width (spines)
+    ax.spines["top"].set_linewidth(2)
+    ax.spines["right"].set_linewidth(2)
+    ax.spines["bottom"].set_linewidth(2)
+    ax.spines["left"].set_linewidth(2)
+    # You can also set tick width
+    ax.tick_params(width=2)
+    # Set tick label sizes
+    ax.tick_params(axis="both", which="major", labelsize=12)  # both x and y axes
+    ax.set_xlabel("Cell Shape ($cs$)", fontsize=font_size)
+    ax.set_ylabel("Nucleus Shape ($ns$)", fontsize=font_size)
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+
+    sns.despine(f, ax)
+
+    return f
+
+
+def compute_cell_nucleus_shape(df_file: str) -> dict[str, dict]:
+
+    correlations = correlation_table(
+        df_file,
+        [("cell_shape", "nucleus_shape")],
+        grouping_sets=[("cell_line_name", "cell_culture_methodology")],
+    )
+
+    groups = [
+        (cln, ccm) for cln in ["hela", "caski"] for ccm in ["co-culture", "control"]
+    ]
+    group_filters = {
+        (cln, ccm): [cell_line_filter(cln), culture_method_filter(ccm)]
+        for cln, ccm in groups
+    }
 
-            # Calculate the local density using gaussian_kde
-            kde = gaussian_kde(
-                [current_sampled_df["cell_shape"], current_sampled_df["nucleus_shape"]]
-            )
-            density = kde(
-                [current_sampled_df["cell_shape"], current_sampled_df["nucleus_shape"]]
-            )
-            f = plt.figure(figsize=(5, 5))
-            ax = f.add_subplot(111)
-            sns.scatterplot(
-                data=current_sampled_df,
-                x="cell_shape",
-                y="nucleus_shape",
-                s=0.75,
-                hue=density,
-                palette="Reds",
-                edgecolor=None,
-            )
+    strata = {
+        group: Stratum(
+            columns=["cell_shape", "nucleus_shape"], filters=group_filters[group]
+        )
+        for group in groups
+    }
 
-            f.tight_layout()
-            ax.set_title(
-                f"Nucleus Shape ($ns$) vs. Cell Shape ($cs$): {cln} / {ccm} (Pearson's $R$: {pR[0]:.2f})",
-                fontsize=int(1.4 * font_size),
-            )
+    # samples for all groups in a single pass over the data
+    samples = stratified_reservoir_sample(
+        df_file, strata, size=SAMPLE_SIZE, seed=SAMPLE_SEED
+    )
+
+    # point density of all cells of a group, evaluated at the sampled ones
+    densities = stratified_grid_kde(
+        df_file,
+        strata,
+        {group: samples[group].get_columns() for group in groups},
+    )
+
+    records: dict[str, dict] = {}
+
+    for cln, ccm in groups:
+        cell_shape = samples[(cln, ccm)]["cell_shape"]
+        nucleus_shape = samples[(cln, ccm)]["nucleus_shape"]
+
+        correlation = lookup_correlation(
+            correlations,
+            "cell_shape",
+            "nucleus_shape",
+            cell_line_name=cln,
+            cell_culture_methodology=ccm,
+        )
 
-            ax.get_legend().remove()
-            # Set axis line width (spines)
-            ax.spines["top"].set_linewidth(2)
-            ax.spines["right"].set_linewidth(2)
-            ax.spines["bottom"].set_linewidth(2)
-            ax.spines["left"].set_linewidth(2)
-            # You can also set tick width
-            ax.tick_params(width=2)
-            # Set tick label sizes
-            ax.tick_params(
-                axis="both", which="major", labelsize=12
-            )  # both x and y axes
-            ax.set_xlabel("Cell Shape ($cs$)", fontsize=font_size)
-            ax.set_ylabel("Nucleus Shape ($ns$)", fontsize=font_size)
-            ax.set_xlim(
-                current_sampled_df["cell_shape"].min(),
-                current_sampled_df["cell_shape"].quantile(0.99),
-            )
-            ax.set_ylim(
-                current_sampled_df["nucleus_shape"].min(),
-                current_sampled_df["nucleus_shape"].quantile(0.99),
+        records[f"cell_nucleus_shape_{cln}_{ccm}"] = {
+            "cell_line_name": cln,
+            "cell_culture_methodology": ccm,
+            "cell_shape": cell_shape.to_numpy(),
+            "nucleus_shape": nucleus_shape.to_numpy(),
+            "density": densities[(cln, ccm)],
+            # axis limits of all cells of the group, not only of the sampled ones
+            "xlim": column_quantiles(
+                df_file, "cell_shape", [0, 0.99], group_filters[(cln, ccm)]
+            ),
+            "ylim": column_quantiles(
+                df_file, "nucleus_shape", [0, 0.99], group_filters[(cln, ccm)]
+            ),
+            "pearson_r": correlation["pearson_r"],
+            "pearson_pvalue": correlation["pearson_pvalue"],
+            "spearman_r": correlation["spearman_r"],
+            "spearman_pvalue": correlation["spearman_pvalue"],
+            "num_cells": correlation["n"],
+            "num_sampled_cells": len(cell_shape),
+        }
+
+    return records
+
+
+def render_cell_nucleus_shape(
+    records: dict[str, dict], parent_dir_out: str, workers: int = 1
+):
+    figure_jobs: list[FigureJob] = []
+
+    for name, record in records.items():
+        cln = record["cell_line_name"]
+        ccm = record["cell_culture_methodology"]
+
+        figure_jobs.append(
+            FigureJob(
+                plot_function=plot_cell_nucleus_shape,
+                kwargs={
+                    "cell_shape": record["cell_shape"],
+                    "nucleus_shape": record["nucleus_shape"],
+                    "density": record["density"],
+                    "xlim": record["xlim"],
+                    "ylim": record["ylim"],
+                    "title": f"Nucleus Shape ($ns$) vs. Cell Shape ($cs$): {cln} / {ccm} (Pearson's $R$: {record['pearson_r']:.2f})",
+                },
+                filename=f"{name}.png",
+                savefig_kwargs={"bbox_inches": "tight", "dpi": 500},
             )
+        )
 
-            sns.despine(f, ax)
-            f.savefig(
-                os.path.join(parent_dir_out, f"cell_nucleus_shape_{cln}_{ccm}.png"),
-                bbox_inches="tight",
-                dpi=500,
-            )
+    render_figures(
+        figure_jobs, parent_dir_out, workers=workers, rc_params=DEFAULT_RC_PARAMS
+    )
+
+
+def cell_nucleus_shape(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "cell_nucleus_shape",
+        compute_cell_nucleus_shape,
+        render_cell_nucleus_shape,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
 
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    cell_nucleus_shape(args.dataframe_file, args.parent_dir_out)
+    with profile_task(
+        "cell_nucleus_shape", os.path.join(args.parent_dir_out, PROFILE_FILENAME)
+    ):
+        cell_nucleus_shape(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
@@ -3,73 +3,234 @@
 
 import os
 from argparse import ArgumentParser
+from typing import Optional
 
 import numpy as np
 import polars as pl
-import seaborn as sns
-from matplotlib import pyplot as plt
-from tqdm import tqdm
+
+from analysis_utils.histograms import histogram_arrays, histogram_table
+from analysis_utils.lag_times import (
+    LAG_TIME_COLUMN,
+    motility_column,
+    scan_lag_time_view,
+    tracking_lag_times,
+)
+from analysis_utils.loading import CELL_LINE_NAMES, canonical_category, cell_line_filter
+from analysis_utils.profiling import PROFILE_FILENAME, profile_task
+from analysis_utils.quantiles import column_quantiles, has_quantile_sketches
+from analysis_utils.rendering import FigureJob, render_figures
+from analysis_utils.results import STAGES, run_analysis_stages
 
 font_size = 16
 
+# bins between the smallest value and the 96th percentile of a cell line
+NUM_BINS = 80
+UPPER_QUANTILE = 0.96
+
+
+def plot_motility_histogram(
+    bin_edges: np.ndarray,
+    densities: np.ndarray,
+    cell_culture_methodologies: list[str],
+    x_max: float,
+):
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
+    f = plt.figure(figsize=(5 * 1.618, 5))
+    ax = f.add_subplot(111)
+
+    # precomputed densities on shared bins, drawn like 'sns.histplot'
+    for density, ccm, color in zip(
+        densities, cell_culture_methodologies, sns.color_palette()
+    ):
+        ax.stairs(density, bin_edges, fill=True, color=color, alpha=0.5, label=ccm)
+        ax.stairs(density, bin_edges, color=color, linewidth=0.5)
 
-def motility(df_file: str, parent_dir_out: str):
+    legend = ax.legend()
+    legend.set_title(title="Cell Culture Methodology")
+    plt.xlim(0, x_max)
+    f.tight_layout()
 
-    # read in combined cell tracking dataframe from ipc file
-    big_dataframe: pl.DataFrame = pl.read_ipc(df_file, memory_map=False)
+    # Set axis line width (spines)
+    ax.spines["top"].set_linewidth(2)
+    ax.spines["right"].set_linewidth(2)
+    ax.spines["bottom"].set_linewidth(2)
+    ax.spines["left"].set_linewidth(2)
+    # You can also set tick width
+    ax.tick_params(width=2)
+    # Set tick label sizes
+    ax.tick_params(axis="both", which="major", labelsize=12)  # both x and y axes
+    ax.set_xlabel(r"$D^2_\text{min}$ in [$\mu m^2$]", fontsize=font_size)
+    ax.set_ylabel("Probability Density", fontsize=font_size)
+    sns.despine(f, trim=False)
 
-    lag_times_minutes = "30,60,90,120,150,180,210,240".split(",")
+    return f
+
+
+def compute_motility(df_file: str) -> dict[str, dict]:
+
+    lag_times_minutes = tracking_lag_times(df_file, ["D2min"])
     cell_line_names = ["hela", "caski"]
 
-    for lt in tqdm(lag_times_minutes):
-        target_column = f"D2min_{lt}_minutes"
+    # the quantile sketches of a partitioned dataset save the quantile
+    # computation in the histogram query
+    bin_ranges = None
+    if has_quantile_sketches(df_file):
+        bin_ranges = pl.DataFrame(
+            [
+                {
+                    "column": "D2min",
+                    LAG_TIME_COLUMN: lt,
+                    "cell_line_name": canonical_category(cln, CELL_LINE_NAMES),
+                    "lower": lower,
+                    "upper": upper,
+                }
+                for lt in lag_times_minutes
+                for cln in cell_line_names
+                for lower, upper in [
+                    column_quantiles(
+                        df_file,
+                        motility_column("D2min", lt),
+                        [0, UPPER_QUANTILE],
+                        [cell_line_filter(cln)],
+                    )
+                ]
+                if not np.isnan(lower)
+            ],
+            schema={
+                "column": pl.String,
+                LAG_TIME_COLUMN: pl.Int32,
+                "cell_line_name": pl.String,
+                "lower": pl.Float64,
+                "upper": pl.Float64,
+            },
+        )
+
+    # histograms of all lag times, cell lines and culture methods in a single
+    # grouped query over the long-format lag time view
+    histograms = histogram_table(
+        scan_lag_time_view(
+            df_file,
+            ["D2min"],
+            columns=["cell_line_name", "cell_culture_methodology"],
+            filters=[
+                pl.any_horizontal([cell_line_filter(cln) for cln in cell_line_names])
+            ],
+            lag_times=lag_times_minutes,
+        ),
+        columns=["D2min"],
+        group_by=[LAG_TIME_COLUMN, "cell_line_name", "cell_culture_methodology"],
+        common_bins_by=[LAG_TIME_COLUMN, "cell_line_name"],
+        num_bins=NUM_BINS,
+        upper_quantile=UPPER_QUANTILE,
+        bin_ranges=bin_ranges,
+    )
+
+    records: dict[str, dict] = {}
 
+    for lt in lag_times_minutes:
         for cln in cell_line_names:
-            # we need to filter the dataframe
-            df = big_dataframe.filter(
-                pl.col("cell_line_name").str.to_lowercase().eq(cln)
+            cell_line_histograms = histograms.filter(
+                pl.col(LAG_TIME_COLUMN) == str(lt),
+                pl.col("cell_line_name").str.to_lowercase() == cln,
             )
-            df = df.filter(pl.col(target_column).is_not_nan())
-            f = plt.figure(figsize=(5 * 1.618, 5))
-            ax = f.add_subplot(111)
-            sns.histplot(
-                ax=ax,
-                data=df,
-                x=target_column,
-                hue="cell_culture_methodology",
-                common_norm=False,
-                stat="density",
-            )
-            legend = ax.get_legend()
-            legend.set_title(title="Cell Culture Methodology")
-            plt.xlim(0, df[target_column].quantile(0.96))
-            f.tight_layout()
-
-            # Set axis line width (spines)
-            ax.spines["top"].set_linewidth(2)
-            ax.spines["right"].set_linewidth(2)
-            ax.spines["bottom"].set_linewidth(2)
-            ax.spines["left"].set_linewidth(2)
-            # You can also set tick width
-            ax.tick_params(width=2)
-            # Set tick label sizes
-            ax.tick_params(
-                axis="both", which="major", labelsize=12
-            )  # both x and y axes
-            ax.set_xlabel(r"$D^2_\text{min}$ in [$\mu m^2$]", fontsize=font_size)
-            ax.set_ylabel("Probability Density", fontsize=font_size)
-            sns.despine(f, trim=False)
-            f.savefig(
-                os.path.join(parent_dir_out, f"motility_{cln}_{lt}_minutes.png"),
-                bbox_inches="tight",
+            cell_culture_methodologies = (
+                cell_line_histograms["cell_culture_methodology"]
+                .unique()
+                .sort()
+                .to_list()
             )
+            if not cell_culture_methodologies:
+                # no cells of this cell line at this lag time
+                continue
+
+            histogram_per_method = [
+                histogram_arrays(cell_line_histograms, cell_culture_methodology=ccm)
+                for ccm in cell_culture_methodologies
+            ]
+
+            records[f"motility_{cln}_{lt}_minutes"] = {
+                "cell_line_name": cln,
+                "lag_time": str(lt),
+                "bin_edges": histogram_per_method[0][0],
+                "densities": np.vstack([h[1] for h in histogram_per_method]),
+                "cell_culture_methodologies": cell_culture_methodologies,
+                "x_max": histogram_per_method[0][0][-1],
+                "num_cells": sum(h[2] for h in histogram_per_method),
+            }
+
+    return records
+
+
+def render_motility(records: dict[str, dict], parent_dir_out: str, workers: int = 1):
+    figure_jobs: list[FigureJob] = [
+        FigureJob(
+            plot_function=plot_motility_histogram,
+            kwargs={
+                "bin_edges": record["bin_edges"],
+                "densities": record["densities"],
+                "cell_culture_methodologies": record["cell_culture_methodologies"],
+                "x_max": record["x_max"],
+            },
+            filename=f"{name}.png",
+            savefig_kwargs={"bbox_inches": "tight"},
+        )
+        for name, record in records.items()
+    ]
+
+    render_figures(figure_jobs, parent_dir_out, workers=workers)
+
+
+def motility(
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    run_analysis_stages(
+        "motility",
+        compute_motility,
+        render_motility,
+        df_file,
+        parent_dir_out,
+        workers=workers,
+        stage=stage,
+        results_file=results_file,
+    )
 
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
-    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Combined cell tracking dataframe (not needed for '--stage=render').",
+    )
     parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering figures.",
+    )
+    parser.add_argument("--stage", type=str, choices=STAGES, default="all")
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Numeric results artifact, defaults to a file in '--parent_dir_out'.",
+    )
     args = parser.parse_args()
 
-    motility(args.dataframe_file, args.parent_dir_out)
+    with profile_task("motility", os.path.join(args.parent_dir_out, PROFILE_FILENAME)):
+        motility(
+            args.dataframe_file,
+            args.parent_dir_out,
+            workers=args.workers,
+            stage=args.stage,
+            results_file=args.results_file,
+        )
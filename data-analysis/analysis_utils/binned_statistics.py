@@ -0,0 +1,152 @@
+from typing import Mapping, NamedTuple, Sequence
+
+import numpy as np
+
+SUPPORTED_STATISTICS = ("mean", "count", "median", "std")
+
+
+class BinnedStatistics2D(NamedTuple):
+    # every grid is indexed [y, x] with the origin in the lower left corner,
+    # i.e. flipped upside down just like 'y_bins'
+    grids: dict[str, np.ndarray]
+    x_bins: np.ndarray
+    y_bins: np.ndarray
+
+
+def _flat_bin_indices(
+    x: np.ndarray, y: np.ndarray, x_bins: np.ndarray, y_bins: np.ndarray
+) -> np.ndarray:
+    num_x_bins = len(x_bins) - 1
+    num_y_bins = len(y_bins) - 1
+
+    x_indices = np.digitize(x, x_bins) - 1
+    y_indices = np.digitize(y, y_bins) - 1
+
+    # values equal to the upper bin edge (and NaNs) are dropped
+    inside = (
+        (x_indices >= 0)
+        & (x_indices < num_x_bins)
+        & (y_indices >= 0)
+        & (y_indices < num_y_bins)
+    )
+
+    return np.where(inside, y_indices * num_x_bins + x_indices, -1)
+
+
+def _grouped_median(
+    bin_indices: np.ndarray, values: np.ndarray, counts: np.ndarray
+) -> np.ndarray:
+    order = np.lexsort((values, bin_indices))
+    sorted_values = values[order]
+
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(len(counts), np.nan)
+
+    filled = counts > 0
+    lower = starts[filled] + (counts[filled] - 1) // 2
+    upper = starts[filled] + counts[filled] // 2
+    medians[filled] = (sorted_values[lower] + sorted_values[upper]) / 2
+
+    return medians
+
+
+def binned_statistics_2d(
+    x: np.ndarray,
+    y: np.ndarray,
+    values: Mapping[str, np.ndarray],
+    num_bins: int = 20,
+    min_count: int = 2,
+    statistics: Sequence[str] = ("mean", "count"),
+) -> dict[str, BinnedStatistics2D]:
+    """
+    Compute binned statistics of several value columns over the same (x, y) plane.
+
+    For every value column, rows where the value is NaN are ignored and the
+    bin edges span the remaining x / y values. Value columns whose valid rows
+    share the same x / y extent reuse a single digitization of the data.
+    Bins with at most 'min_count' entries are set to NaN (except for 'count').
+    """
+
+    unknown_statistics = set(statistics) - set(SUPPORTED_STATISTICS)
+    if unknown_statistics:
+        raise ValueError(f"Unsupported statistics: {sorted(unknown_statistics)}")
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    num_grid_cells = num_bins * num_bins
+    bin_indices_cache: dict[tuple[float, float, float, float], tuple] = {}
+    results: dict[str, BinnedStatistics2D] = {}
+
+    for name, z in values.items():
+        z = np.asarray(z)
+        valid = ~np.isnan(z)
+
+        if not valid.any():
+            raise ValueError(f"Value column '{name}' does not contain any valid values")
+
+        extent = (
+            x.min(where=valid, initial=np.inf),
+            x.max(where=valid, initial=-np.inf),
+            y.min(where=valid, initial=np.inf),
+            y.max(where=valid, initial=-np.inf),
+        )
+
+        if extent not in bin_indices_cache:
+            x_bins = np.linspace(extent[0], extent[1], num_bins + 1)
+            y_bins = np.linspace(extent[2], extent[3], num_bins + 1)
+            bin_indices_cache[extent] = (
+                _flat_bin_indices(x, y, x_bins, y_bins),
+                x_bins,
+                y_bins,
+            )
+
+        all_bin_indices, x_bins, y_bins = bin_indices_cache[extent]
+
+        bin_indices = all_bin_indices[valid]
+        z = z[valid]
+        inside = bin_indices >= 0
+        bin_indices = bin_indices[inside]
+        z = z[inside]
+
+        counts = np.bincount(bin_indices, minlength=num_grid_cells)
+        sums = np.bincount(bin_indices, weights=z, minlength=num_grid_cells)
+        mask = counts > min_count
+
+        grids: dict[str, np.ndarray] = {}
+
+        if "count" in statistics:
+            grids["count"] = counts
+
+        if "mean" in statistics:
+            means = np.full(num_grid_cells, np.nan)
+            means[mask] = sums[mask] / counts[mask]
+            grids["mean"] = means
+
+        if "std" in statistics:
+            bin_means = sums / np.maximum(counts, 1)
+            squared_deviations = np.bincount(
+                bin_indices,
+                weights=(z - bin_means[bin_indices]) ** 2,
+                minlength=num_grid_cells,
+            )
+            stds = np.full(num_grid_cells, np.nan)
+            stds[mask] = np.sqrt(squared_deviations[mask] / counts[mask])
+            grids["std"] = stds
+
+        if "median" in statistics:
+            medians = _grouped_median(bin_indices, z, counts)
+            medians[~mask] = np.nan
+            grids["median"] = medians
+
+        # the origin should be in the lower left corner
+        results[name] = BinnedStatistics2D(
+            grids={
+                stat: np.flipud(grid.reshape(num_bins, num_bins))
+                for stat, grid in grids.items()
+            },
+            x_bins=x_bins,
+            y_bins=np.flipud(y_bins),
+        )
+
+    return results
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import uuid
+from argparse import ArgumentParser
+from typing import Optional, Sequence
+
+from analysis_utils.profiling import PROFILE_FILENAME
+
+# bump to invalidate all existing cache entries, e.g. if the layout changes
+CACHE_VERSION = 1
+
+# marks an entry as complete, entries are only restored if it exists
+COMPLETE_MARKER = ".complete"
+
+
+def file_digest(path: str, chunk_size: int = 1 << 22) -> str:
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _files(path: str) -> list[str]:
+    # all files below 'path' (or 'path' itself), in a deterministic order
+    if os.path.isfile(path):
+        return [path]
+
+    return sorted(
+        os.path.join(root, fn)
+        for root, dirs, filenames in os.walk(path)
+        if "__pycache__" not in root.split(os.sep)
+        for fn in filenames
+        if not fn.endswith(".pyc")
+    )
+
+
+def content_fingerprint(path: str) -> str:
+    """
+    Hash the content of a file, or of all files in a directory together with
+    their paths relative to it (e.g. a partitioned tracking dataset).
+    """
+
+    digest = hashlib.blake2b(digest_size=32)
+    for fpath in _files(path):
+        digest.update(os.path.relpath(fpath, path).encode())
+        digest.update(file_digest(fpath).encode())
+    return digest.hexdigest()
+
+
+def dataframe_fingerprint(df_file: str) -> str:
+    """
+    Fingerprint a tracking dataframe without reading all of its data: a
+    partitioned tracking dataset is identified by its manifest, i.e. the paths,
+    row counts and column statistics of its partitions, together with the sizes
+    of the partition files. Only the small quantile sketches file is hashed,
+    a single dataframe file is hashed completely.
+    """
+
+    # imported here, so that restoring cached results does not import polars
+    from analysis_utils.loading import is_partitioned_dataset, read_manifest
+
+    if not is_partitioned_dataset(df_file):
+        return content_fingerprint(df_file)
+
+    manifest = read_manifest(df_file)
+    sizes = {
+        p["path"]: os.path.getsize(os.path.join(df_file, p["path"]))
+        for p in manifest["partitions"]
+    }
+
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(json.dumps(manifest, sort_keys=True).encode())
+    digest.update(json.dumps(sizes, sort_keys=True).encode())
+    if "quantile_sketches" in manifest:
+        sketches_file = os.path.join(df_file, manifest["quantile_sketches"])
+        digest.update(file_digest(sketches_file).encode())
+    return digest.hexdigest()
+
+
+def cache_key(
+    script: str,
+    dataframe_fingerprint: str,
+    code_paths: Sequence[str] = (),
+    params: Optional[dict[str, str]] = None,
+) -> str:
+    key = {
+        "version": CACHE_VERSION,
+        "script": file_digest(script),
+        "dataframe": dataframe_fingerprint,
+        # shared code and the environment an analysis script depends on
+        "code": {os.path.basename(p): content_fingerprint(p) for p in code_paths},
+        "params": params or {},
+    }
+    return hashlib.blake2b(
+        json.dumps(key, sort_keys=True).encode(), digest_size=32
+    ).hexdigest()
+
+
+def restore_outputs(cache_dir: str, key: str, outdir: str) -> bool:
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(entry, COMPLETE_MARKER)):
+        return False
+
+    for name in os.listdir(entry):
+        if name == COMPLETE_MARKER:
+            continue
+        src = os.path.join(entry, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(outdir, name), dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, os.path.join(outdir, name))
+
+    # the restored profile describes the run that created the entry, it is
+    # kept for reference but left out of the hotspot report of this run
+    profile_file = os.path.join(outdir, PROFILE_FILENAME)
+    if os.path.isfile(profile_file):
+        with open(profile_file, "r") as f:
+            profile = json.load(f)
+        profile["cached"] = True
+        with open(profile_file, "w") as f:
+            json.dump(profile, f, indent=2)
+
+    return True
+
+
+def store_outputs(cache_dir: str, key: str, outdir: str):
+    # staged inputs are symbolic links and are not part of the outputs
+    outputs = [
+        name
+        for name in os.listdir(outdir)
+        if not os.path.islink(os.path.join(outdir, name)) and not name.startswith(".")
+    ]
+
+    # copy into a temporary directory first, so concurrent or interrupted
+    # runs never leave a partial entry behind
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_entry = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}")
+    os.makedirs(tmp_entry)
+
+    for name in outputs:
+        src = os.path.join(outdir, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(tmp_entry, name))
+        else:
+            shutil.copy2(src, os.path.join(tmp_entry, name))
+
+    open(os.path.join(tmp_entry, COMPLETE_MARKER), "w").close()
+
+    entry = os.path.join(cache_dir, key)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp_entry, entry)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fingerprint_parser = subparsers.add_parser(
+        "fingerprint", help="Print the fingerprint of a tracking dataframe."
+    )
+    fingerprint_parser.add_argument("--path", type=str, required=True)
+
+    key_parser = subparsers.add_parser(
+        "key", help="Print the cache key of an analysis script."
+    )
+    key_parser.add_argument("--script", type=str, required=True)
+    key_parser.add_argument("--dataframe_fingerprint", type=str, required=True)
+    key_parser.add_argument("--code_path", type=str, action="append", default=[])
+    key_parser.add_argument(
+        "--param",
+        type=str,
+        action="append",
+        default=[],
+        help="'name=value' pair that changes the results of the script.",
+    )
+
+    for command in ["restore", "store"]:
+        command_parser = subparsers.add_parser(
+            command, help=f"{command.capitalize()} the outputs of a cache entry."
+        )
+        command_parser.add_argument("--cache_dir", type=str, required=True)
+        command_parser.add_argument("--key", type=str, required=True)
+        command_parser.add_argument("--outdir", type=str, required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "fingerprint":
+        print(dataframe_fingerprint(args.path))
+
+    elif args.command == "key":
+        print(
+            cache_key(
+                args.script,
+                args.dataframe_fingerprint,
+                args.code_path,
+                dict(p.split("=", 1) for p in args.param),
+            )
+        )
+
+    elif args.command == "restore":
+        # exit code 1 signals a cache miss
+        sys.exit(0 if restore_outputs(args.cache_dir, args.key, args.outdir) else 1)
+
+    else:
+        store_outputs(args.cache_dir, args.key, args.outdir)
@@ -0,0 +1,136 @@
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+from scipy.special import stdtr
+
+from analysis_utils.loading import scan_tracking_dataframe
+from analysis_utils.profiling import profiled
+
+# group value used for rows that are pooled over a grouping key
+ALL_GROUPS = "all"
+
+CORRELATION_METHODS = ("pearson", "spearman")
+
+
+def correlation_pvalue(r: np.ndarray, n: np.ndarray) -> np.ndarray:
+    # two-sided p-value of the t-test for a vanishing correlation, which is
+    # what 'scipy.stats.pearsonr' and 'scipy.stats.spearmanr' report
+    r = np.asarray(r, dtype=np.float64)
+    dof = np.asarray(n, dtype=np.float64) - 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt(dof / ((1.0 - r) * (1.0 + r)))
+        pvalue = 2 * stdtr(dof, -np.abs(t))
+
+    return np.where(dof > 0, pvalue, np.nan)
+
+
+def _pair_statistics(index: int, x_column: str, y_column: str) -> list[pl.Expr]:
+    # pairwise filtering: only rows in which both measures are valid
+    valid = pl.col(x_column).is_not_nan() & pl.col(y_column).is_not_nan()
+    x, y = pl.col(x_column).filter(valid), pl.col(y_column).filter(valid)
+
+    return [
+        valid.sum().alias(f"{index}::n"),
+        *[
+            pl.corr(x, y, method=method).alias(f"{index}::{method}_r")
+            for method in CORRELATION_METHODS
+        ],
+    ]
+
+
+@profiled()
+def correlation_table(
+    df_file: Union[str, pl.LazyFrame],
+    pairs: Sequence[tuple[str, str]],
+    grouping_sets: Sequence[Sequence[str]] = ((),),
+    filters: Optional[Sequence[pl.Expr]] = None,
+) -> pl.DataFrame:
+    """
+    Compute Pearson and Spearman correlation coefficients, p-values and the
+    number of cells for every (x, y) column pair in 'pairs' and every group of
+    every grouping set in a single lazy query.
+
+    Rows in which either column of a pair is NaN or null are ignored for that
+    pair only. Grouping keys that are not part of a grouping set are set to
+    'all' in the resulting tidy table, i.e. '()' pools over all cells.
+    """
+
+    keys = list(dict.fromkeys(k for gs in grouping_sets for k in gs))
+    measure_columns = list(dict.fromkeys(c for pair in pairs for c in pair))
+
+    lf = scan_tracking_dataframe(
+        df_file, columns=keys + measure_columns, filters=filters
+    )
+
+    statistics = [
+        e for i, (x, y) in enumerate(pairs) for e in _pair_statistics(i, x, y)
+    ]
+
+    tables: list[pl.LazyFrame] = []
+    for gs in grouping_sets:
+        grouped = lf.group_by(list(gs)).agg(statistics) if gs else lf.select(statistics)
+        grouped = grouped.with_columns(
+            *[pl.col(k).cast(pl.String) for k in gs],
+            *[pl.lit(ALL_GROUPS).alias(k) for k in keys if k not in gs],
+        )
+
+        for i, (x, y) in enumerate(pairs):
+            tables.append(
+                grouped.select(
+                    *keys,
+                    pl.lit(x).alias("x_column"),
+                    pl.lit(y).alias("y_column"),
+                    pl.col(f"{i}::n").cast(pl.Int64).alias("n"),
+                    *[
+                        pl.col(f"{i}::{method}_r").alias(f"{method}_r")
+                        for method in CORRELATION_METHODS
+                    ],
+                )
+            )
+
+    table = pl.concat(tables).collect()
+
+    return (
+        table.with_columns(
+            pl.Series(
+                f"{method}_pvalue",
+                correlation_pvalue(
+                    table[f"{method}_r"].to_numpy(), table["n"].to_numpy()
+                ),
+            )
+            for method in CORRELATION_METHODS
+        )
+        .select(
+            *keys,
+            "x_column",
+            "y_column",
+            "n",
+            *[
+                f"{method}_{s}"
+                for method in CORRELATION_METHODS
+                for s in ("r", "pvalue")
+            ],
+        )
+        .sort([*keys, "x_column", "y_column"])
+    )
+
+
+def lookup_correlation(
+    table: pl.DataFrame, x_column: str, y_column: str, **group_values: str
+) -> dict:
+    # group values are compared case-insensitively, like the loading filters
+    row = table.filter(
+        pl.col("x_column").eq(x_column),
+        pl.col("y_column").eq(y_column),
+        *[pl.col(k).str.to_lowercase().eq(v.lower()) for k, v in group_values.items()],
+    )
+
+    if len(row) != 1:
+        raise ValueError(
+            f"Expected a single correlation for '{x_column}' vs. '{y_column}' "
+            f"({group_values}), found {len(row)}"
+        )
+
+    return row.row(0, named=True)
@@ -0,0 +1,446 @@
+import json
+import os
+import tempfile
+from argparse import ArgumentParser
+from collections import deque
+from typing import Any, Iterator, NamedTuple, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.profiling import stage
+
+# graph datasets converted with 'write_graph_store' are directories with an
+# index and one uncompressed .npz file per frame, which are read one by one
+GRAPH_STORE_INDEX_FILENAME = "graph_store.json"
+GRAPH_STORE_FORMAT_VERSION = 1
+
+_ATTRIBUTE_PREFIX = "attribute::"
+
+
+class GraphFrame(NamedTuple):
+    # the neighbours of node i are 'indices[indptr[i]:indptr[i + 1]]'
+    identifier: Any
+    node_ids: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    attributes: dict[str, np.ndarray]
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def rows(self) -> np.ndarray:
+        # the node of every entry of 'indices'
+        return np.repeat(np.arange(self.num_nodes), self.degrees())
+
+
+def _numeric_attributes(graph) -> list[str]:
+    return sorted(
+        {
+            name
+            for _, data in graph.nodes(data=True)
+            for name, value in data.items()
+            if isinstance(value, (int, float, np.number))
+            and not isinstance(value, bool)
+        }
+    )
+
+
+def graph_to_csr(
+    identifier: Any,
+    graph,
+    attributes: Optional[Sequence[str]] = None,
+    track_attribute: Optional[str] = None,
+) -> GraphFrame:
+    """
+    Convert a networkx graph into CSR adjacency arrays and one array per node
+    attribute in 'attributes' (all numeric node attributes by default).
+
+    Nodes are identified across frames by their key in the graph, or by their
+    'track_attribute'. Self-loops are dropped, missing attribute values are
+    NaN.
+    """
+
+    import networkx as nx
+
+    nodes = list(graph.nodes)
+    if attributes is None:
+        attributes = _numeric_attributes(graph)
+
+    adjacency = nx.to_scipy_sparse_array(
+        graph, nodelist=nodes, weight=None, format="csr"
+    )
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    adjacency.sort_indices()
+
+    node_data = graph.nodes
+    node_ids = (
+        nodes
+        if track_attribute is None
+        else [node_data[n][track_attribute] for n in nodes]
+    )
+
+    return GraphFrame(
+        identifier=identifier,
+        node_ids=np.asarray(node_ids),
+        indptr=adjacency.indptr.astype(np.int64),
+        indices=adjacency.indices.astype(np.int32),
+        attributes={
+            a: np.array([node_data[n].get(a, np.nan) for n in nodes], dtype=np.float64)
+            for a in attributes
+        },
+    )
+
+
+def is_graph_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, GRAPH_STORE_INDEX_FILENAME))
+
+
+def _iter_pickled_graphs(
+    path: str,
+    attributes: Optional[Sequence[str]] = None,
+    track_attribute: Optional[str] = None,
+) -> Iterator[GraphFrame]:
+    from core_data_utils.datasets import BaseDataSet
+
+    # a pickled dataset can only be loaded as a whole
+    for entry in BaseDataSet.from_pickle(path):
+        yield graph_to_csr(entry.identifier, entry.data, attributes, track_attribute)
+
+
+def write_graph_store(frames: Iterator[GraphFrame], outdir: str) -> int:
+    os.makedirs(outdir, exist_ok=True)
+
+    entries = []
+    for index, frame in enumerate(frames):
+        filename = f"frame_{index:06d}.npz"
+        np.savez(
+            os.path.join(outdir, filename),
+            node_ids=frame.node_ids,
+            indptr=frame.indptr,
+            indices=frame.indices,
+            **{f"{_ATTRIBUTE_PREFIX}{a}": v for a, v in frame.attributes.items()},
+        )
+        entries.append({"identifier": frame.identifier, "file": filename})
+
+    # written last, an interrupted conversion is not a graph store
+    with open(os.path.join(outdir, GRAPH_STORE_INDEX_FILENAME), "w") as f:
+        json.dump({"format_version": GRAPH_STORE_FORMAT_VERSION, "entries": entries}, f)
+
+    return len(entries)
+
+
+def _read_graph_store_frame(
+    path: str, entry: dict, attributes: Optional[Sequence[str]] = None
+) -> GraphFrame:
+    with np.load(os.path.join(path, entry["file"]), allow_pickle=False) as npz:
+        stored = [
+            k.removeprefix(_ATTRIBUTE_PREFIX)
+            for k in npz.files
+            if k.startswith(_ATTRIBUTE_PREFIX)
+        ]
+        num_nodes = len(npz["node_ids"])
+
+        return GraphFrame(
+            identifier=entry["identifier"],
+            node_ids=npz["node_ids"],
+            indptr=npz["indptr"],
+            indices=npz["indices"],
+            attributes={
+                a: (
+                    npz[f"{_ATTRIBUTE_PREFIX}{a}"]
+                    if a in stored
+                    else np.full(num_nodes, np.nan)
+                )
+                for a in (stored if attributes is None else attributes)
+            },
+        )
+
+
+def iter_graph_frames(
+    path: str,
+    attributes: Optional[Sequence[str]] = None,
+    track_attribute: Optional[str] = None,
+) -> Iterator[GraphFrame]:
+    """
+    Iterate over the frames of a graph dataset in order.
+
+    Graph stores are read one frame at a time, pickled graph datasets (e.g.
+    from 'calculate_local_density') are loaded as a whole and converted frame
+    by frame. 'track_attribute' only applies to pickled datasets, graph stores
+    keep the node ids they were written with.
+    """
+
+    if not is_graph_store(path):
+        yield from _iter_pickled_graphs(path, attributes, track_attribute)
+        return
+
+    with open(os.path.join(path, GRAPH_STORE_INDEX_FILENAME), "r") as f:
+        index = json.load(f)
+
+    if index["format_version"] != GRAPH_STORE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported graph store version {index['format_version']} in '{path}'"
+        )
+
+    for entry in index["entries"]:
+        yield _read_graph_store_frame(path, entry, attributes)
+
+
+def neighbour_means(frame: GraphFrame, values: np.ndarray) -> np.ndarray:
+    # mean over the non-NaN values of the neighbours of every node, NaN for
+    # nodes without such neighbours
+    neighbour_values = values[frame.indices]
+    valid = ~np.isnan(neighbour_values)
+    rows = frame.rows()[valid]
+
+    sums = np.bincount(rows, weights=neighbour_values[valid], minlength=frame.num_nodes)
+    counts = np.bincount(rows, minlength=frame.num_nodes)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def neighbour_retention(earlier: GraphFrame, later: GraphFrame) -> np.ndarray:
+    """
+    Fraction of the neighbours of every node of 'earlier' that are still its
+    neighbours in 'later', matched by node id. Neighbours that are not part of
+    'later' are ignored, nodes that are not part of 'later' or have no such
+    neighbours are NaN.
+    """
+
+    _, codes = np.unique(
+        np.concatenate([earlier.node_ids, later.node_ids]), return_inverse=True
+    )
+    earlier_codes, later_codes = codes[: earlier.num_nodes], codes[earlier.num_nodes :]
+    num_codes = np.int64(codes.max() + 1) if len(codes) > 0 else np.int64(1)
+
+    def edge_keys(frame: GraphFrame, frame_codes: np.ndarray) -> np.ndarray:
+        return frame_codes[frame.rows()].astype(np.int64) * num_codes + frame_codes[
+            frame.indices
+        ].astype(np.int64)
+
+    retained = np.isin(edge_keys(earlier, earlier_codes), edge_keys(later, later_codes))
+    # only neighbours that still exist can be retained
+    tracked = np.isin(earlier_codes[earlier.indices], later_codes)
+    rows = earlier.rows()
+
+    num_retained = np.bincount(
+        rows, weights=retained & tracked, minlength=earlier.num_nodes
+    )
+    num_tracked = np.bincount(rows, weights=tracked, minlength=earlier.num_nodes)
+
+    present = np.isin(earlier_codes, later_codes)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(present & (num_tracked > 0), num_retained / num_tracked, np.nan)
+
+
+class NeighbourStatistics(NamedTuple):
+    nodes: pl.DataFrame
+    degree_distribution: pl.DataFrame
+    retention: pl.DataFrame
+
+
+def neighbour_statistics(
+    path: str,
+    nodes_dir: str,
+    attributes: Optional[Sequence[str]] = None,
+    lag_frames: Sequence[int] = (1,),
+    track_attribute: Optional[str] = None,
+) -> NeighbourStatistics:
+    """
+    Compute the neighbour-based observables of a graph dataset in a single
+    pass over its frames:
+
+    - 'nodes': degree, attribute values and neighbour-averaged attribute
+      values of every node of every frame, which are written to one IPC file
+      per frame in 'nodes_dir' and scanned lazily
+    - 'degree_distribution': number of nodes per degree over all frames
+    - 'retention': mean fraction of retained neighbours between every frame
+      and the frames 'lag_frames' later
+
+    Only the last 'max(lag_frames)' frames of a graph store are kept in
+    memory, a pickled graph dataset is loaded as a whole.
+    """
+
+    max_lag = max(lag_frames, default=0)
+    previous: deque[GraphFrame] = deque(maxlen=max_lag + 1)
+
+    os.makedirs(nodes_dir, exist_ok=True)
+    node_files: list[str] = []
+    degree_counts = np.zeros(0, dtype=np.int64)
+    retention_rows: list[dict] = []
+
+    with stage("neighbour_statistics") as s:
+        frames = iter_graph_frames(path, attributes, track_attribute)
+        for frame_index, frame in enumerate(frames):
+            s.add_rows(frame.num_nodes)
+            previous.append(frame)
+
+            degrees = frame.degrees()
+            frame_degree_counts = np.bincount(degrees)
+            if len(frame_degree_counts) > len(degree_counts):
+                degree_counts = np.pad(
+                    degree_counts, (0, len(frame_degree_counts) - len(degree_counts))
+                )
+            degree_counts[: len(frame_degree_counts)] += frame_degree_counts
+
+            node_files.append(os.path.join(nodes_dir, f"frame_{frame_index:06d}.arrow"))
+            pl.DataFrame(
+                {
+                    "frame": np.full(frame.num_nodes, frame_index, dtype=np.int32),
+                    "node_id": frame.node_ids,
+                    "degree": degrees,
+                    **frame.attributes,
+                    **{
+                        f"neighbour_mean_{a}": neighbour_means(frame, values)
+                        for a, values in frame.attributes.items()
+                    },
+                }
+            ).write_ipc(node_files[-1], compression="uncompressed")
+
+            for lag in lag_frames:
+                if lag >= len(previous):
+                    continue
+                earlier = previous[-1 - lag]
+                retention = neighbour_retention(earlier, frame)
+                valid = ~np.isnan(retention)
+                retention_rows.append(
+                    {
+                        "frame": frame_index - lag,
+                        "lag_frames": lag,
+                        "num_nodes": int(valid.sum()),
+                        "mean_retention": (
+                            float(retention[valid].mean()) if valid.any() else None
+                        ),
+                    }
+                )
+
+    return NeighbourStatistics(
+        # frames may differ in their numeric attributes
+        nodes=(
+            pl.concat([pl.scan_ipc(f) for f in node_files], how="diagonal")
+            if node_files
+            else pl.LazyFrame()
+        ),
+        degree_distribution=pl.DataFrame(
+            {"degree": np.arange(len(degree_counts)), "count": degree_counts}
+        ),
+        retention=pl.DataFrame(
+            retention_rows,
+            schema={
+                "frame": pl.Int64,
+                "lag_frames": pl.Int64,
+                "num_nodes": pl.Int64,
+                "mean_retention": pl.Float64,
+            },
+        ),
+    )
+
+
+def write_neighbour_statistics(
+    graph_datasets: dict[str, str],
+    outdir: str,
+    attributes: Optional[Sequence[str]] = None,
+    lag_frames: Sequence[int] = (1,),
+    track_attribute: Optional[str] = None,
+):
+    # one dataset at a time, the tables of all datasets are concatenated; the
+    # node tables are streamed from their per-frame files into a single file
+    tables: dict[str, list] = {name: [] for name in NeighbourStatistics._fields}
+
+    os.makedirs(outdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="nodes-", dir=outdir) as nodes_dir:
+        for basename, path in graph_datasets.items():
+            statistics = neighbour_statistics(
+                path,
+                os.path.join(nodes_dir, basename),
+                attributes,
+                lag_frames,
+                track_attribute,
+            )
+            for name, table in statistics._asdict().items():
+                tables[name].append(
+                    table.with_columns(pl.lit(basename).alias("dataset_basename"))
+                )
+
+        with stage("write_node_statistics"):
+            pl.concat(tables["nodes"], how="diagonal").sink_ipc(
+                os.path.join(outdir, "neighbour_statistics.arrow"), compression="lz4"
+            )
+
+    pl.concat(tables["degree_distribution"]).write_csv(
+        os.path.join(outdir, "degree_distribution.csv")
+    )
+    pl.concat(tables["retention"]).write_csv(
+        os.path.join(outdir, "neighbour_retention.csv")
+    )
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser(
+        "convert", help="Convert a pickled graph dataset into a graph store."
+    )
+    convert_parser.add_argument("--infile", type=str, required=True)
+    convert_parser.add_argument("--outdir", type=str, required=True)
+    convert_parser.add_argument(
+        "--attribute",
+        type=str,
+        action="append",
+        default=None,
+        help="Node attribute to keep, defaults to all numeric node attributes.",
+    )
+    convert_parser.add_argument(
+        "--track_attribute",
+        type=str,
+        default=None,
+        help="Node attribute that identifies a cell across frames.",
+    )
+
+    statistics_parser = subparsers.add_parser(
+        "statistics", help="Compute the neighbour statistics of graph datasets."
+    )
+    statistics_parser.add_argument(
+        "--graph_dataset",
+        type=str,
+        action="append",
+        required=True,
+        help="'basename=path' of a graph store or a pickled graph dataset.",
+    )
+    statistics_parser.add_argument("--outdir", type=str, required=True)
+    statistics_parser.add_argument(
+        "--attribute", type=str, action="append", default=None
+    )
+    statistics_parser.add_argument("--track_attribute", type=str, default=None)
+    statistics_parser.add_argument(
+        "--lag_frames",
+        type=int,
+        action="append",
+        default=None,
+        help="Frame lags of the neighbour retention, defaults to 1.",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        write_graph_store(
+            _iter_pickled_graphs(args.infile, args.attribute, args.track_attribute),
+            args.outdir,
+        )
+    else:
+        write_neighbour_statistics(
+            dict(d.split("=", 1) for d in args.graph_dataset),
+            args.outdir,
+            attributes=args.attribute,
+            lag_frames=args.lag_frames or [1],
+            track_attribute=args.track_attribute,
+        )
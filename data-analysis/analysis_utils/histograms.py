@@ -0,0 +1,142 @@
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.loading import scan_tracking_dataframe
+from analysis_utils.profiling import profiled
+
+
+@profiled()
+def histogram_table(
+    df_file: Union[str, pl.LazyFrame],
+    columns: Sequence[str],
+    group_by: Sequence[str],
+    common_bins_by: Sequence[str] = (),
+    num_bins: int = 80,
+    upper_quantile: float = 1.0,
+    filters: Optional[Sequence[pl.Expr]] = None,
+    bin_ranges: Optional[pl.DataFrame] = None,
+) -> pl.DataFrame:
+    """
+    Histogram every column in 'columns' for every group of 'group_by' in a
+    single grouped query.
+
+    Groups that agree in 'common_bins_by' (a subset of 'group_by') share the
+    same 'num_bins' equal-width bins, which span the minimum to the
+    'upper_quantile' quantile of the values of these groups. NaN and missing
+    values are ignored. The density of every group is normalized by the
+    number of values of that group, including values beyond the last bin,
+    like 'sns.histplot(stat="density", common_norm=False)'.
+
+    Precomputed 'bin_ranges' with the columns "column", 'common_bins_by',
+    "lower" and "upper" replace the minimum and quantile, e.g. from the
+    quantile sketches of the tracking dataset. Values outside of the ranges
+    are not binned, but still count towards the normalization.
+
+    The result is a tidy table with one row per column, group and bin.
+    """
+
+    if not set(common_bins_by).issubset(group_by):
+        raise ValueError("'common_bins_by' has to be a subset of 'group_by'")
+
+    bin_keys = ["column", *common_bins_by]
+    group_keys = ["column", *group_by]
+
+    values = (
+        scan_tracking_dataframe(df_file, [*group_by, *columns], filters)
+        .with_columns(
+            pl.col(group_by).cast(pl.String),
+            # compacted columns may have different float types
+            pl.col(columns).cast(pl.Float64),
+        )
+        .unpivot(on=columns, index=group_by, variable_name="column")
+        .filter(pl.col("value").is_not_null() & pl.col("value").is_not_nan())
+    )
+
+    if bin_ranges is None:
+        bin_ranges = values.group_by(bin_keys).agg(
+            pl.col("value").min().alias("lower"),
+            pl.col("value").quantile(upper_quantile, "linear").alias("upper"),
+        )
+    else:
+        bin_ranges = bin_ranges.lazy().select(
+            pl.col(bin_keys).cast(pl.String), pl.col("lower", "upper").cast(pl.Float64)
+        )
+
+    num_values = values.group_by(group_keys).agg(pl.len().alias("num_values"))
+
+    counts = (
+        values.join(bin_ranges, on=bin_keys)
+        .filter(pl.col("value").is_between(pl.col("lower"), pl.col("upper")))
+        .with_columns(
+            # the upper edge belongs to the last bin, all values are in the
+            # first bin if all values of the shared bins are equal
+            pl.when(pl.col("upper") > pl.col("lower"))
+            .then(
+                (pl.col("value") - pl.col("lower"))
+                / (pl.col("upper") - pl.col("lower"))
+                * num_bins
+            )
+            .otherwise(0)
+            .floor()
+            .cast(pl.Int64)
+            .clip(upper_bound=num_bins - 1)
+            .alias("bin")
+        )
+        .group_by([*group_keys, "bin"])
+        .agg(pl.len().alias("count"))
+    )
+
+    # all bins of every group, including empty ones
+    bins = (
+        num_values.join(bin_ranges, on=bin_keys)
+        .join(pl.LazyFrame({"bin": np.arange(num_bins)}), how="cross")
+        .join(counts, on=[*group_keys, "bin"], how="left")
+        .with_columns(
+            pl.col("count").fill_null(0),
+            ((pl.col("upper") - pl.col("lower")) / num_bins).alias("bin_width"),
+        )
+        .with_columns(
+            (pl.col("lower") + pl.col("bin") * pl.col("bin_width")).alias("bin_left"),
+            (pl.col("lower") + (pl.col("bin") + 1) * pl.col("bin_width")).alias(
+                "bin_right"
+            ),
+            (pl.col("count") / (pl.col("num_values") * pl.col("bin_width"))).alias(
+                "density"
+            ),
+        )
+    )
+
+    return (
+        bins.select(
+            *group_keys,
+            "bin",
+            "bin_left",
+            "bin_right",
+            "count",
+            "num_values",
+            "density",
+        )
+        .sort([*group_keys, "bin"])
+        .collect()
+    )
+
+
+def histogram_arrays(
+    table: pl.DataFrame, **group_values: str
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Select a single histogram of 'histogram_table' and return its bin edges,
+    densities and number of values.
+    """
+
+    selected = table.filter(
+        *[pl.col(k).str.to_lowercase() == v.lower() for k, v in group_values.items()]
+    ).sort("bin")
+
+    if len(selected) == 0:
+        raise KeyError(f"No histogram for {group_values}")
+
+    edges = np.append(selected["bin_left"].to_numpy(), selected["bin_right"][-1])
+    return edges, selected["density"].to_numpy(), selected["num_values"][0]
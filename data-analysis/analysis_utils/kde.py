@@ -0,0 +1,311 @@
+from typing import NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+from scipy.signal import fftconvolve
+
+from analysis_utils.loading import scan_tracking_dataframe
+from analysis_utils.profiling import profiled, stage
+from analysis_utils.sampling import Stratum, valid_rows
+
+
+def kde_bandwidth_factor(num_points: int, bw_method: Union[str, float] = "scott"):
+    # same bandwidth factors as 'scipy.stats.gaussian_kde' for 2D data
+    if bw_method == "scott":
+        return num_points ** (-1.0 / 6)
+    if bw_method == "silverman":
+        return (num_points * (2 + 2) / 4.0) ** (-1.0 / 6)
+    if np.isscalar(bw_method) and not isinstance(bw_method, str):
+        return float(bw_method)
+
+    raise ValueError(f"Unknown bandwidth method '{bw_method}'")
+
+
+class KDEGrid(NamedTuple):
+    # regular grid in whitened coordinates, on which the data is binned
+    mean: np.ndarray
+    cholesky: np.ndarray
+    num_points: int
+    sigma: float
+    lower_bounds: np.ndarray
+    spacing: float
+    shape: tuple[int, int]
+
+    def whiten(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        data = np.vstack(
+            (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        )
+        return np.linalg.solve(self.cholesky, data - self.mean[:, None])
+
+
+def kde_grid(
+    mean: np.ndarray,
+    cholesky: np.ndarray,
+    num_points: int,
+    whitened_min: np.ndarray,
+    whitened_max: np.ndarray,
+    bw_method: Union[str, float] = "scott",
+    oversampling: int = 4,
+    max_grid_size: int = 2048,
+) -> KDEGrid:
+    if num_points < 3:
+        raise ValueError("At least three points are needed for a 2D KDE")
+
+    sigma = kde_bandwidth_factor(num_points, bw_method)
+
+    lower_bounds = np.asarray(whitened_min) - sigma
+    upper_bounds = np.asarray(whitened_max) + sigma
+
+    spacing = max(
+        sigma / oversampling,
+        (upper_bounds - lower_bounds).max() / (max_grid_size - 2),
+    )
+    shape = tuple(
+        (np.ceil((upper_bounds - lower_bounds) / spacing).astype(int) + 2).tolist()
+    )
+
+    return KDEGrid(
+        mean=np.asarray(mean, dtype=np.float64),
+        cholesky=cholesky,
+        num_points=num_points,
+        sigma=sigma,
+        lower_bounds=lower_bounds,
+        spacing=spacing,
+        shape=shape,
+    )
+
+
+def _linear_binning_weights(grid: KDEGrid, whitened: np.ndarray):
+    position = (whitened - grid.lower_bounds[:, None]) / grid.spacing
+    # points outside of the grid are moved to its border
+    lower = np.clip(
+        np.floor(position).astype(np.int64), 0, np.array(grid.shape)[:, None] - 2
+    )
+    return lower, np.clip(position - lower, 0, 1)
+
+
+def bin_points(grid: KDEGrid, whitened: np.ndarray) -> np.ndarray:
+    # linear binning: every point distributes its weight over the four
+    # surrounding grid nodes
+    lower, frac = _linear_binning_weights(grid, whitened)
+
+    counts = np.zeros(grid.shape[0] * grid.shape[1])
+    for dx, x_weight in ((0, 1 - frac[0]), (1, frac[0])):
+        for dy, y_weight in ((0, 1 - frac[1]), (1, frac[1])):
+            counts += np.bincount(
+                (lower[0] + dx) * grid.shape[1] + lower[1] + dy,
+                weights=x_weight * y_weight,
+                minlength=len(counts),
+            )
+    return counts.reshape(grid.shape)
+
+
+def density_grid(grid: KDEGrid, counts: np.ndarray, truncate: float = 4.0):
+    # separable gaussian smoothing
+    for axis, axis_size in enumerate(grid.shape):
+        radius = min(int(np.ceil(truncate * grid.sigma / grid.spacing)), axis_size - 1)
+        offsets = np.arange(-radius, radius + 1) * grid.spacing
+        kernel = np.exp(-0.5 * (offsets / grid.sigma) ** 2) / (
+            np.sqrt(2 * np.pi) * grid.sigma
+        )
+        kernel_shape = [1, 1]
+        kernel_shape[axis] = len(kernel)
+        counts = fftconvolve(counts, kernel.reshape(kernel_shape), mode="same")
+
+    # FFT round-off may produce tiny negative values
+    return np.maximum(counts, 0) / grid.num_points
+
+
+def interpolate_density(
+    grid: KDEGrid, densities: np.ndarray, whitened: np.ndarray
+) -> np.ndarray:
+    # bilinear interpolation of the density grid at the points
+    lower, frac = _linear_binning_weights(grid, whitened)
+
+    density = np.zeros(whitened.shape[1])
+    for dx, x_weight in ((0, 1 - frac[0]), (1, frac[0])):
+        for dy, y_weight in ((0, 1 - frac[1]), (1, frac[1])):
+            density += x_weight * y_weight * densities[lower[0] + dx, lower[1] + dy]
+
+    # account for the change of variables
+    return density / np.abs(np.prod(np.diag(grid.cholesky)))
+
+
+@profiled()
+def grid_kde(
+    x: np.ndarray,
+    y: np.ndarray,
+    bw_method: Union[str, float] = "scott",
+    oversampling: int = 4,
+    truncate: float = 4.0,
+    max_grid_size: int = 2048,
+) -> np.ndarray:
+    """
+    Evaluate a 2D Gaussian kernel density estimate of (x, y) at every point.
+
+    Reproduces 'scipy.stats.gaussian_kde(...)(points)' (including the full
+    data covariance and Scott's bandwidth by default), but instead of summing
+    over all pairs of points the data is whitened, linearly binned onto a
+    regular grid, smoothed with a separable Gaussian kernel using FFTs and
+    interpolated back to the points. The runtime is linear in the number of
+    points.
+    """
+
+    data = np.vstack((np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)))
+    num_points = data.shape[1]
+
+    if num_points < 3:
+        raise ValueError("At least three points are needed for a 2D KDE")
+
+    # transform the data such that the kernel becomes isotropic
+    mean = data.mean(axis=1)
+    cholesky = np.linalg.cholesky(np.cov(data))
+    whitened = np.linalg.solve(cholesky, data - mean[:, None])
+
+    grid = kde_grid(
+        mean,
+        cholesky,
+        num_points,
+        whitened.min(axis=1),
+        whitened.max(axis=1),
+        bw_method=bw_method,
+        oversampling=oversampling,
+        max_grid_size=max_grid_size,
+    )
+
+    return interpolate_density(
+        grid, density_grid(grid, bin_points(grid, whitened), truncate), whitened
+    )
+
+
+def _stratum_rows(schema: pl.Schema, stratum: Stratum) -> pl.Expr:
+    return pl.all_horizontal(*stratum.filters, *valid_rows(schema, stratum.columns))
+
+
+def stratified_grid_kde(
+    df_file: str,
+    strata: dict[str, Stratum],
+    points: dict[str, Sequence[np.ndarray]],
+    filters: Optional[Sequence[pl.Expr]] = None,
+    bw_method: Union[str, float] = "scott",
+    oversampling: int = 4,
+    truncate: float = 4.0,
+    max_grid_size: int = 2048,
+    batch_size: int = 1_000_000,
+) -> dict[str, np.ndarray]:
+    """
+    Evaluate the 2D Gaussian kernel density estimate of all rows of every
+    stratum (with its two 'columns') at the (x, y) 'points' of the stratum,
+    e.g. at the cells of a reservoir sample.
+
+    Same estimate as 'grid_kde' of all rows, but the tracking dataframe is
+    never loaded as a whole: the means, covariances and whitened bounds of all
+    strata are aggregated by two queries, and a single pass over batches of
+    'batch_size' rows bins the rows of all strata onto their grids. Only the
+    grids and one batch are held in memory.
+    """
+
+    if len(strata) == 0:
+        return {}
+
+    columns = list(
+        dict.fromkeys(
+            c
+            for s in strata.values()
+            for c in [*s.columns, *(r for f in s.filters for r in f.meta.root_names())]
+        )
+    )
+
+    lf = scan_tracking_dataframe(df_file, columns, filters)
+    schema = lf.collect_schema()
+
+    def stratum_column(name, c):
+        return pl.col(c).cast(pl.Float64).filter(_stratum_rows(schema, strata[name]))
+
+    with stage("stratified_grid_kde/moments"):
+        moments = lf.select(
+            expr.alias(f"{i}__{moment}")
+            for i, (name, stratum) in enumerate(strata.items())
+            for moment, expr in {
+                "count": stratum_column(name, stratum.columns[0]).count(),
+                "mean_x": stratum_column(name, stratum.columns[0]).mean(),
+                "mean_y": stratum_column(name, stratum.columns[1]).mean(),
+                "var_x": stratum_column(name, stratum.columns[0]).var(),
+                "var_y": stratum_column(name, stratum.columns[1]).var(),
+                "cov": pl.cov(
+                    stratum_column(name, stratum.columns[0]),
+                    stratum_column(name, stratum.columns[1]),
+                ),
+            }.items()
+        ).collect()
+        moments = moments.row(0, named=True)
+
+    # transform the data such that the kernel becomes isotropic
+    choleskys = {}
+    for i, name in enumerate(strata):
+        if moments[f"{i}__count"] < 3:
+            raise ValueError(f"At least three points are needed for a 2D KDE ({name})")
+        choleskys[name] = np.linalg.cholesky(
+            [
+                [moments[f"{i}__var_x"], moments[f"{i}__cov"]],
+                [moments[f"{i}__cov"], moments[f"{i}__var_y"]],
+            ]
+        )
+
+    def whitened_columns(i, name):
+        # forward substitution with the Cholesky factor of the covariance
+        cholesky = choleskys[name]
+        x = stratum_column(name, strata[name].columns[0]) - moments[f"{i}__mean_x"]
+        y = stratum_column(name, strata[name].columns[1]) - moments[f"{i}__mean_y"]
+        w_x = x / cholesky[0, 0]
+        return w_x, (y - cholesky[1, 0] * w_x) / cholesky[1, 1]
+
+    with stage("stratified_grid_kde/bounds"):
+        bounds = lf.select(
+            expr
+            for i, name in enumerate(strata)
+            for axis, w in enumerate(whitened_columns(i, name))
+            for expr in [
+                w.min().alias(f"{i}__min_{axis}"),
+                w.max().alias(f"{i}__max_{axis}"),
+            ]
+        ).collect()
+        bounds = bounds.row(0, named=True)
+
+    grids = {
+        name: kde_grid(
+            np.array([moments[f"{i}__mean_x"], moments[f"{i}__mean_y"]]),
+            choleskys[name],
+            moments[f"{i}__count"],
+            np.array([bounds[f"{i}__min_0"], bounds[f"{i}__min_1"]]),
+            np.array([bounds[f"{i}__max_0"], bounds[f"{i}__max_1"]]),
+            bw_method=bw_method,
+            oversampling=oversampling,
+            max_grid_size=max_grid_size,
+        )
+        for i, name in enumerate(strata)
+    }
+    counts = {name: np.zeros(grid.shape) for name, grid in grids.items()}
+
+    with stage("stratified_grid_kde/binning") as s:
+        for batch in lf.collect_batches(chunk_size=batch_size):
+            s.add_rows(len(batch))
+            for name, stratum in strata.items():
+                rows = batch.filter(_stratum_rows(batch.schema, stratum))
+                counts[name] += bin_points(
+                    grids[name],
+                    grids[name].whiten(
+                        rows[stratum.columns[0]].to_numpy(),
+                        rows[stratum.columns[1]].to_numpy(),
+                    ),
+                )
+
+    with stage("stratified_grid_kde/interpolation"):
+        return {
+            name: interpolate_density(
+                grid,
+                density_grid(grid, counts[name], truncate),
+                grid.whiten(*points[name]),
+            )
+            for name, grid in grids.items()
+        }
@@ -0,0 +1,104 @@
+import re
+from typing import Optional, Sequence
+
+import polars as pl
+
+from analysis_utils.loading import scan_tracking_dataframe, tracking_dataframe_columns
+
+LAG_TIME_COLUMN = "lag_time_minutes"
+
+# column names of the motility measures written by 'annotate_D2min' and
+# 'annotate_crsd' for every lag time in 'params.lag_times_minutes'
+MOTILITY_MEASURES = {
+    "D2min": "D2min_{lag_time}_minutes",
+    "cage_relative_squared_displacement_mum_squared": (
+        "cage_relative_squared_displacement_mum_squared_{lag_time}_min"
+    ),
+}
+
+
+def motility_column(measure: str, lag_time: int) -> str:
+    return MOTILITY_MEASURES[measure].format(lag_time=lag_time)
+
+
+def lag_time_index(columns: Sequence[str]) -> dict[int, dict[str, str]]:
+    # lag time -> motility measure -> column, for all motility columns
+    patterns = {
+        measure: re.compile(
+            "^" + re.escape(template).replace(r"\{lag_time\}", r"(\d+)") + "$"
+        )
+        for measure, template in MOTILITY_MEASURES.items()
+    }
+
+    index: dict[int, dict[str, str]] = {}
+    for column in columns:
+        for measure, pattern in patterns.items():
+            if match := pattern.match(column):
+                index.setdefault(int(match.group(1)), {})[measure] = column
+
+    return dict(sorted(index.items()))
+
+
+def tracking_lag_times(df_file: str, measures: Sequence[str] = ("D2min",)) -> list[int]:
+    # all lag times for which every one of 'measures' is available
+    return [
+        lag_time
+        for lag_time, lag_time_columns in lag_time_index(
+            tracking_dataframe_columns(df_file)
+        ).items()
+        if all(m in lag_time_columns for m in measures)
+    ]
+
+
+def scan_lag_time_view(
+    df_file: str,
+    measures: Sequence[str],
+    columns: Sequence[str] = (),
+    filters: Optional[Sequence[pl.Expr]] = None,
+    lag_times: Optional[Sequence[int]] = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scan the motility 'measures' of the tracking dataframe in long
+    format: one row per cell and lag time, with the lag time in
+    'LAG_TIME_COLUMN', one column per measure and the per-cell 'columns'.
+
+    Uses all lag times with all 'measures' by default. The rows are ordered by
+    lag time, so that per-lag-time statistics are a single grouped query.
+    """
+
+    if lag_times is None:
+        lag_times = tracking_lag_times(df_file, measures)
+
+    wide = scan_tracking_dataframe(
+        df_file,
+        [
+            *columns,
+            *[motility_column(m, lt) for lt in lag_times for m in measures],
+        ],
+        filters,
+    )
+
+    views = [
+        wide.select(
+            pl.lit(lag_time, dtype=pl.Int32).alias(LAG_TIME_COLUMN),
+            *columns,
+            # compacted columns may have different float types
+            *[
+                pl.col(motility_column(m, lag_time)).cast(pl.Float64).alias(m)
+                for m in measures
+            ],
+        )
+        for lag_time in lag_times
+    ]
+
+    if len(views) == 0:
+        # no rows, but the same schema as with lag times
+        return pl.LazyFrame(
+            schema={
+                LAG_TIME_COLUMN: pl.Int32,
+                **wide.collect_schema(),
+                **{m: pl.Float64 for m in measures},
+            }
+        )
+
+    return pl.concat(views, how="vertical")
@@ -0,0 +1,184 @@
+import json
+import os
+from functools import lru_cache, reduce
+from typing import Optional, Sequence, Union
+
+import polars as pl
+
+from analysis_utils.profiling import stage
+
+# written by 'data-preparation/scripts/partition_tracking_dataframe.py'
+MANIFEST_FILENAME = "manifest.json"
+
+# categories of the metadata columns, also used for their encoding by
+# 'data-preparation/scripts/add_dataset_metadata.py'
+CELL_LINE_NAMES = ["HeLa", "CaSki", "MS751", "MCF-10A"]
+CELL_CULTURE_METHODOLOGIES = ["control", "co-culture"]
+
+
+def is_partitioned_dataset(df_file: str) -> bool:
+    return os.path.isfile(os.path.join(df_file, MANIFEST_FILENAME))
+
+
+@lru_cache(maxsize=8)
+def read_manifest(df_file: str) -> dict:
+    # parsed once per dataset and process, the manifest must not be modified
+    with open(os.path.join(df_file, MANIFEST_FILENAME), "r") as f:
+        return json.load(f)
+
+
+def tracking_dataframe_columns(df_file: str) -> list[str]:
+    # only reads the schema, not the data
+    if is_partitioned_dataset(df_file):
+        return read_manifest(df_file)["columns"]
+
+    return pl.scan_ipc(df_file).collect_schema().names()
+
+
+def _can_skip_partition(partition: dict, predicate: pl.Expr) -> bool:
+    # a partition can only be skipped based on its column statistics if
+    # the predicate is a plain missing-value check of a single column
+    root_names = predicate.meta.root_names()
+    if len(root_names) != 1:
+        return False
+
+    column = root_names[0]
+    column_stats = partition["statistics"].get(column)
+    if column_stats is None:
+        return False
+
+    num_missing = column_stats["null_count"]
+    if predicate.meta.eq(pl.col(column).is_not_nan()):
+        num_missing += column_stats.get("nan_count", 0)
+    elif not predicate.meta.eq(pl.col(column).is_not_null()):
+        return False
+
+    return num_missing == partition["num_rows"]
+
+
+def select_partitions(
+    manifest: dict, filters: Optional[Sequence[pl.Expr]] = None
+) -> list[dict]:
+    """
+    Select all partitions of a partitioned tracking dataset that can contain
+    rows matching 'filters'.
+
+    Filters that only involve partition keys are evaluated on the partition
+    keys themselves, missing-value checks are evaluated on the per-partition
+    column statistics. All other filters are left to the parquet reader, which
+    prunes row groups using the statistics stored in the files.
+    """
+
+    partitions = manifest["partitions"]
+    partition_keys = set(manifest["partition_keys"])
+
+    if not filters or len(partitions) == 0:
+        return partitions
+
+    key_filters, other_filters = [], []
+    for f in filters:
+        if set(f.meta.root_names()).issubset(partition_keys):
+            key_filters.append(f)
+        else:
+            other_filters.append(f)
+
+    if key_filters:
+        selected_indices = (
+            pl.DataFrame([p["keys"] for p in partitions])
+            .with_row_index("partition_index")
+            .filter(*key_filters)["partition_index"]
+            .to_list()
+        )
+        partitions = [partitions[i] for i in selected_indices]
+
+    return [
+        p
+        for p in partitions
+        if not any(_can_skip_partition(p, f) for f in other_filters)
+    ]
+
+
+def _scan_partition_files(paths: list[str]) -> pl.LazyFrame:
+    # parquet files, or uncompressed IPC files in the shared copy of a
+    # partitioned dataset made by 'analysis_utils/runner.py', which are
+    # memory-mapped
+    if all(os.path.splitext(p)[1] == ".arrow" for p in paths):
+        return pl.scan_ipc(paths)
+    return pl.scan_parquet(paths)
+
+
+def scan_tracking_dataframe(
+    df_file: Union[str, pl.LazyFrame],
+    columns: Sequence[str],
+    filters: Optional[Sequence[pl.Expr]] = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scan the combined cell tracking dataframe.
+
+    'df_file' is either a single IPC file or a partitioned tracking dataset,
+    in which case only the partitions that can match 'filters' are scanned,
+    or an already scanned dataframe such as a lag time view.
+    Only 'columns' are selected, and all 'filters' are combined with a logical
+    'and', so that polars can push the projection and the predicates down into
+    the scan before anything is materialized. Columns that are only needed for
+    filtering do not have to be listed in 'columns'.
+    """
+
+    if isinstance(df_file, pl.LazyFrame):
+        lf = df_file
+    elif is_partitioned_dataset(df_file):
+        manifest = read_manifest(df_file)
+        partitions = select_partitions(manifest, filters)
+
+        if len(partitions) > 0:
+            lf = _scan_partition_files(
+                [os.path.join(df_file, p["path"]) for p in partitions]
+            )
+        else:
+            # keep the schema, but do not read any rows
+            lf = _scan_partition_files([os.path.join(df_file, manifest["schema"])])
+    else:
+        lf = pl.scan_ipc(df_file)
+
+    if filters:
+        lf = lf.filter(reduce(lambda a, b: a & b, filters))
+
+    return lf.select(columns)
+
+
+def load_tracking_dataframe(
+    df_file: str,
+    columns: Sequence[str],
+    filters: Optional[Sequence[pl.Expr]] = None,
+) -> pl.DataFrame:
+    with stage("load_tracking_dataframe") as s:
+        df = scan_tracking_dataframe(df_file, columns, filters).collect()
+        s.add_rows(len(df))
+
+    return df
+
+
+def canonical_category(value: str, categories: Sequence[str]) -> str:
+    # names are matched case-insensitively, but the filters compare against
+    # the stored category, which is an integer comparison for enum columns
+    for category in categories:
+        if category.lower() == value.lower():
+            return category
+
+    raise ValueError(f"Unknown category '{value}', expected one of {categories}")
+
+
+def cell_line_filter(cell_line_name: str) -> pl.Expr:
+    return pl.col("cell_line_name").eq(
+        canonical_category(cell_line_name, CELL_LINE_NAMES)
+    )
+
+
+def culture_method_filter(cell_culture_methodology: str) -> pl.Expr:
+    return pl.col("cell_culture_methodology").eq(
+        canonical_category(cell_culture_methodology, CELL_CULTURE_METHODOLOGIES)
+    )
+
+
+def not_nan_filter(*column_names: str) -> list[pl.Expr]:
+    return [pl.col(c).is_not_nan() for c in column_names]
@@ -0,0 +1,352 @@
+import datetime
+import glob
+import json
+import os
+import resource
+import subprocess
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator, Optional, Sequence
+
+# analysis scripts write 'profile.json' into their output directory,
+# preparation scripts '<script>.profile.json' next to their outputs
+PROFILE_FILENAME = "profile.json"
+PROFILE_SUFFIX = ".profile.json"
+
+_PROC_STATUS = "/proc/self/status"
+_PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def _peak_rss_mib() -> float:
+    # VmHWM can be reset (see '_reset_peak_rss'), 'ru_maxrss' cannot
+    try:
+        with open(_PROC_STATUS, "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # writing '5' resets VmHWM to the current RSS (Linux only)
+    try:
+        with open(_PROC_CLEAR_REFS, "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _cpu_time_s() -> float:
+    # includes worker processes once they have been joined, e.g. render pools
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        usage_self.ru_utime
+        + usage_self.ru_stime
+        + usage_children.ru_utime
+        + usage_children.ru_stime
+    )
+
+
+class Stage:
+
+    def __init__(self, name: str, path: str, rows: Optional[int] = None):
+        self.name = name
+        self.path = path
+        self.rows = rows
+        self.wall_time_s = 0.0
+        # without the time of nested stages of the same process
+        self.exclusive_wall_time_s = 0.0
+        self.nested_wall_time_s = 0.0
+        self.cpu_time_s = 0.0
+        self.peak_rss_mib = 0.0
+
+    def add_rows(self, rows: int):
+        self.rows = (self.rows or 0) + rows
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "path": self.path,
+            "wall_time_s": self.wall_time_s,
+            "exclusive_wall_time_s": self.exclusive_wall_time_s,
+            "cpu_time_s": self.cpu_time_s,
+            "peak_rss_mib": self.peak_rss_mib,
+            "rows": self.rows,
+        }
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak RSS and processed rows of named,
+    possibly nested, stages of a task.
+    """
+
+    def __init__(self, task: str):
+        self.task = task
+        self.stages: list[Stage] = []
+        self._stack: list[Stage] = []
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None) -> Iterator[Stage]:
+        path = "/".join([*(s.name for s in self._stack), name])
+        stage = Stage(name, path, rows)
+
+        # the peak of the enclosing stage is kept before it is reset
+        if self._stack:
+            self._stack[-1].peak_rss_mib = max(
+                self._stack[-1].peak_rss_mib, _peak_rss_mib()
+            )
+        _reset_peak_rss()
+
+        self._stack.append(stage)
+        start_wall, start_cpu = time.perf_counter(), _cpu_time_s()
+        try:
+            yield stage
+        finally:
+            stage.wall_time_s = time.perf_counter() - start_wall
+            stage.exclusive_wall_time_s = max(
+                stage.wall_time_s - stage.nested_wall_time_s, 0.0
+            )
+            stage.cpu_time_s = _cpu_time_s() - start_cpu
+            stage.peak_rss_mib = max(stage.peak_rss_mib, _peak_rss_mib())
+            self._stack.pop()
+
+            if self._stack:
+                self._stack[-1].nested_wall_time_s += stage.wall_time_s
+                self._stack[-1].peak_rss_mib = max(
+                    self._stack[-1].peak_rss_mib, stage.peak_rss_mib
+                )
+            self.stages.append(stage)
+
+    def add(
+        self,
+        name: str,
+        wall_time_s: float,
+        cpu_time_s: float = 0.0,
+        rows: Optional[int] = None,
+        nested: bool = True,
+    ):
+        # timings that were measured separately, e.g. summed over all figures;
+        # times summed over worker processes overlap with the enclosing stage
+        # and are not 'nested' in it
+        stage = Stage(name, "/".join([*(s.name for s in self._stack), name]), rows)
+        stage.wall_time_s = stage.exclusive_wall_time_s = wall_time_s
+        stage.cpu_time_s = cpu_time_s
+        self.stages.append(stage)
+
+        if nested and self._stack:
+            self._stack[-1].nested_wall_time_s += wall_time_s
+
+    def to_dict(self) -> dict:
+        return {
+            "task": self.task,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "hostname": os.uname().nodename,
+            "stages": [s.to_dict() for s in self.stages],
+        }
+
+    def write(self, outfile: str):
+        with open(outfile, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# profiler of the running task, stages outside of a task are not recorded
+_active_profiler: Optional[Profiler] = None
+
+
+@contextmanager
+def profile_task(task: str, outfile: Optional[str]) -> Iterator[Profiler]:
+    """
+    Profile the stages of a task and write them to 'outfile' (if given) when
+    the task ends, also if it fails.
+    """
+
+    global _active_profiler
+    previous, _active_profiler = _active_profiler, Profiler(task)
+    profiler = _active_profiler
+
+    try:
+        with profiler.stage(task):
+            yield profiler
+    finally:
+        _active_profiler = previous
+        if outfile is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+            profiler.write(outfile)
+
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None) -> Iterator[Stage]:
+    if _active_profiler is None:
+        yield Stage(name, name, rows)
+        return
+
+    with _active_profiler.stage(name, rows) as s:
+        yield s
+
+
+def add_stage_timings(
+    name: str,
+    wall_time_s: float,
+    cpu_time_s: float = 0.0,
+    rows: Optional[int] = None,
+    nested: bool = True,
+):
+    if _active_profiler is not None:
+        _active_profiler.add(name, wall_time_s, cpu_time_s, rows, nested)
+
+
+def profiled(name: Optional[str] = None) -> Callable:
+    # decorator version of 'stage', named after the function by default
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def measure_subprocess(command: Sequence[str], env: Optional[dict] = None) -> dict:
+    """
+    Run 'command' in its own process and measure its wall time, CPU time and
+    peak RSS with 'wait4', e.g. for benchmarks.
+    """
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+
+    returncode = os.waitstatus_to_exitcode(status)
+    # already reaped by wait4
+    process.returncode = returncode
+
+    return {
+        "wall_time_s": wall_time,
+        "user_time_s": rusage.ru_utime,
+        "system_time_s": rusage.ru_stime,
+        # 'ru_maxrss' is the peak of the largest process, in KiB on Linux;
+        # worker processes of the command are not included
+        "peak_rss_mib": rusage.ru_maxrss / 1024,
+        "returncode": returncode,
+        "stderr_tail": stderr.decode(errors="replace")[-2000:] if returncode else "",
+    }
+
+
+def find_profiles(parent_dirs: Sequence[str]) -> list[str]:
+    return sorted(
+        fpath
+        for parent_dir in parent_dirs
+        for pattern in [PROFILE_FILENAME, "*" + PROFILE_SUFFIX]
+        for fpath in glob.glob(os.path.join(parent_dir, "**", pattern), recursive=True)
+    )
+
+
+def hotspot_report(profile_files: Sequence[str], top: int = 30) -> dict:
+    """
+    Merge the profiles of all tasks of a run and rank the stages by their
+    total exclusive wall time, i.e. without the time spent in nested stages.
+    Stages of the same name are merged across tasks. Profiles restored from
+    the analysis cache are skipped, they belong to an earlier run.
+    """
+
+    stages: dict[str, dict] = {}
+    tasks = []
+
+    for fpath in profile_files:
+        with open(fpath, "r") as f:
+            profile = json.load(f)
+
+        if profile.get("cached", False):
+            continue
+
+        total = next(s for s in profile["stages"] if s["path"] == profile["task"])
+        tasks.append(
+            {
+                "task": profile["task"],
+                "profile": fpath,
+                "wall_time_s": total["wall_time_s"],
+                "peak_rss_mib": total["peak_rss_mib"],
+            }
+        )
+
+        for s in profile["stages"]:
+            # without the task name, e.g. 'compute/load_tracking_dataframe'
+            key = s["path"].partition("/")[2] or s["path"]
+            merged = stages.setdefault(
+                key,
+                {
+                    "stage": key,
+                    "calls": 0,
+                    "tasks": set(),
+                    "wall_time_s": 0.0,
+                    "exclusive_wall_time_s": 0.0,
+                    "cpu_time_s": 0.0,
+                    "max_peak_rss_mib": 0.0,
+                    "rows": 0,
+                },
+            )
+            merged["calls"] += 1
+            merged["tasks"].add(profile["task"])
+            merged["wall_time_s"] += s["wall_time_s"]
+            merged["exclusive_wall_time_s"] += s["exclusive_wall_time_s"]
+            merged["cpu_time_s"] += s["cpu_time_s"]
+            merged["max_peak_rss_mib"] = max(
+                merged["max_peak_rss_mib"], s["peak_rss_mib"]
+            )
+            merged["rows"] += s["rows"] or 0
+
+    ranked = sorted(
+        stages.values(), key=lambda s: s["exclusive_wall_time_s"], reverse=True
+    )
+    for s in ranked:
+        s["tasks"] = sorted(s["tasks"])
+
+    return {
+        "tasks": sorted(tasks, key=lambda t: t["wall_time_s"], reverse=True),
+        "hotspots": ranked[:top],
+    }
+
+
+def print_hotspot_report(report: dict):
+    print(f"{'stage':<50} {'excl. [s]':>10} {'total [s]':>10} {'calls':>6} {'MiB':>7}")
+    for s in report["hotspots"]:
+        print(
+            f"{s['stage'][:50]:<50} {s['exclusive_wall_time_s']:>10.2f} "
+            f"{s['wall_time_s']:>10.2f} {s['calls']:>6} {s['max_peak_rss_mib']:>7.0f}"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--parent_dir",
+        type=str,
+        action="append",
+        required=True,
+        help="Directory that is searched recursively for profiles of tasks.",
+    )
+    parser.add_argument("--outfile", type=str, default=None)
+    parser.add_argument(
+        "--top", type=int, default=30, help="Number of stages in the report."
+    )
+    args = parser.parse_args()
+
+    report = hotspot_report(find_profiles(args.parent_dir), top=args.top)
+    print_hotspot_report(report)
+
+    if args.outfile is not None:
+        with open(args.outfile, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,170 @@
+import os
+from functools import lru_cache
+from typing import NamedTuple, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.loading import (
+    is_partitioned_dataset,
+    read_manifest,
+    scan_tracking_dataframe,
+    select_partitions,
+)
+from analysis_utils.profiling import stage
+
+
+class QuantileSketch(NamedTuple):
+    # quantiles of 'count' values at fixed, increasing 'probabilities'
+    probabilities: np.ndarray
+    quantiles: np.ndarray
+    count: int
+
+    def quantile(self, q) -> np.ndarray:
+        # interpolating between the stored quantiles bounds the rank error by
+        # the spacing of 'probabilities', exact at the stored probabilities
+        return np.interp(q, self.probabilities, self.quantiles)
+
+    def cdf(self, x: np.ndarray) -> np.ndarray:
+        # ties share the highest probability, the cdf is right-continuous
+        values, last = np.unique(self.quantiles[::-1], return_index=True)
+        probabilities = self.probabilities[::-1][last]
+        return np.interp(x, values, probabilities, left=0.0, right=1.0)
+
+
+def merge_sketches(sketches: Sequence[QuantileSketch]) -> Optional[QuantileSketch]:
+    """
+    Merge quantile sketches of disjoint sets of values into a sketch of their
+    union, with the same probabilities.
+
+    The cdf of the union is the count-weighted mixture of the piecewise linear
+    cdfs of the sketches, which is inverted at the probabilities of the
+    sketches. Returns None if there are no values at all.
+    """
+
+    sketches = [s for s in sketches if s.count > 0]
+    if len(sketches) == 0:
+        return None
+    if len(sketches) == 1:
+        return sketches[0]
+
+    probabilities = sketches[0].probabilities
+    counts = np.array([s.count for s in sketches])
+
+    values = np.unique(np.concatenate([s.quantiles for s in sketches]))
+    cdf = sum(c * s.cdf(values) for c, s in zip(counts, sketches)) / counts.sum()
+
+    return QuantileSketch(
+        probabilities=probabilities,
+        quantiles=np.interp(probabilities, cdf, values),
+        count=int(counts.sum()),
+    )
+
+
+@lru_cache(maxsize=4)
+def _read_sketches(sketches_file: str) -> dict[str, np.ndarray]:
+    with np.load(sketches_file) as sketches:
+        return {k: sketches[k] for k in sketches.files}
+
+
+def _sketch_supports_filter(column: str, partition_keys: set, f: pl.Expr) -> bool:
+    # the sketches are per partition and ignore NaN and missing values
+    if set(f.meta.root_names()).issubset(partition_keys):
+        return True
+    return f.meta.eq(pl.col(column).is_not_nan()) or f.meta.eq(
+        pl.col(column).is_not_null()
+    )
+
+
+def has_quantile_sketches(df_file: str) -> bool:
+    # written next to the manifest by
+    # 'data-preparation/scripts/partition_tracking_dataframe.py'
+    return is_partitioned_dataset(df_file) and "quantile_sketches" in read_manifest(
+        df_file
+    )
+
+
+def load_quantile_sketch(
+    df_file: str, column: str, filters: Optional[Sequence[pl.Expr]] = None
+) -> Optional[QuantileSketch]:
+    """
+    Merge the quantile sketches of 'column' of all partitions that match
+    'filters'.
+
+    Returns None if 'df_file' has no quantile sketches of 'column', or if a
+    filter is neither a partition key filter nor a missing-value check of
+    'column', since the sketches cannot answer these.
+    """
+
+    if not has_quantile_sketches(df_file):
+        return None
+
+    manifest = read_manifest(df_file)
+
+    partition_keys = set(manifest["partition_keys"])
+    if not all(
+        _sketch_supports_filter(column, partition_keys, f) for f in filters or []
+    ):
+        return None
+
+    sketches = _read_sketches(os.path.join(df_file, manifest["quantile_sketches"]))
+    columns = sketches["columns"].tolist()
+    if column not in columns:
+        return None
+
+    column_index = columns.index(column)
+    partition_indices = {p: i for i, p in enumerate(sketches["partitions"].tolist())}
+
+    merged = merge_sketches(
+        [
+            QuantileSketch(
+                sketches["probabilities"],
+                sketches["quantiles"][partition_indices[p["path"]], column_index],
+                int(sketches["counts"][partition_indices[p["path"]], column_index]),
+            )
+            for p in select_partitions(manifest, filters)
+        ]
+    )
+
+    if merged is None:
+        # no values, but the sketches answered the query
+        return QuantileSketch(sketches["probabilities"], np.full(0, np.nan), 0)
+
+    return merged
+
+
+def column_quantiles(
+    df_file: str,
+    column: str,
+    quantiles: Sequence[float],
+    filters: Optional[Sequence[pl.Expr]] = None,
+) -> np.ndarray:
+    """
+    Quantiles of the non-NaN values of 'column' of the rows matching 'filters'.
+
+    Uses the quantile sketches of a partitioned tracking dataset if they can
+    answer the query, and otherwise computes the quantiles exactly. NaN is
+    returned for every quantile if there are no values.
+    """
+
+    sketch = load_quantile_sketch(df_file, column, filters)
+
+    if sketch is not None:
+        if sketch.count == 0:
+            return np.full(len(quantiles), np.nan)
+        return sketch.quantile(quantiles)
+
+    with stage("column_quantiles"):
+        values = (
+            scan_tracking_dataframe(df_file, [column], filters)
+            .select(pl.col(column).cast(pl.Float64))
+            .filter(pl.col(column).is_not_null() & pl.col(column).is_not_nan())
+            .select(
+                pl.col(column).quantile(q, "linear").alias(str(i))
+                for i, q in enumerate(quantiles)
+            )
+            .collect()
+            .row(0)
+        )
+
+    return np.array(values, dtype=float)
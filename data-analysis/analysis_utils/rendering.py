@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, NamedTuple, Optional, Sequence
+
+from analysis_utils.profiling import add_stage_timings
+
+DEFAULT_RC_PARAMS = {
+    "text.usetex": False,
+    "font.family": "sans-serif",
+    "font.sans-serif": ["Fira Sans"],
+    "mathtext.fontset": "stixsans",
+}
+
+
+class FigureJob(NamedTuple):
+    # 'plot_function' has to return a matplotlib figure and must be importable
+    # by the worker processes, i.e. defined at the top level of a module
+    plot_function: Callable
+    kwargs: dict[str, Any]
+    filename: str
+    savefig_kwargs: dict[str, Any] = {}
+
+
+def init_render_worker(rc_params: Optional[dict] = None):
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot as plt
+
+    if rc_params:
+        plt.rcParams.update(rc_params)
+
+
+def _render_figure_timed(
+    job: FigureJob, parent_dir_out: str
+) -> tuple[str, float, float]:
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    fig = job.plot_function(**job.kwargs)
+    plotted = time.perf_counter()
+
+    outfile = os.path.join(parent_dir_out, job.filename)
+    fig.savefig(outfile, **job.savefig_kwargs)
+    plt.close(fig)
+
+    return outfile, plotted - start, time.perf_counter() - plotted
+
+
+def render_figure(job: FigureJob, parent_dir_out: str) -> str:
+    return _render_figure_timed(job, parent_dir_out)[0]
+
+
+def render_figures(
+    jobs: Sequence[FigureJob],
+    parent_dir_out: str,
+    workers: int = 1,
+    rc_params: Optional[dict] = None,
+) -> list[str]:
+    """
+    Render and save all figure jobs, either in this process or in a pool of
+    'workers' processes that are initialized once with the Agg backend and
+    'rc_params'.
+    """
+
+    if workers <= 1 or len(jobs) <= 1:
+        init_render_worker(rc_params)
+        rendered = [_render_figure_timed(job, parent_dir_out) for job in jobs]
+    else:
+        # 'spawn' avoids forking a process in which polars' thread pool is running
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_render_worker,
+            initargs=(rc_params,),
+        ) as pool:
+            rendered = list(
+                pool.map(_render_figure_timed, jobs, [parent_dir_out] * len(jobs))
+            )
+
+    # summed over all figures, and over all workers if rendered in parallel
+    in_process = workers <= 1 or len(jobs) <= 1
+    for name, index in [("plot", 1), ("savefig", 2)]:
+        add_stage_timings(
+            name,
+            sum(r[index] for r in rendered),
+            rows=len(rendered),
+            nested=in_process,
+        )
+
+    return [r[0] for r in rendered]
@@ -0,0 +1,89 @@
+import json
+import os
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from analysis_utils.profiling import stage as profile_stage
+
+RESULTS_SUFFIX = "_results.npz"
+STAGES = ("all", "compute", "render")
+
+_METADATA_KEY = "__metadata__"
+_SEPARATOR = "::"
+
+
+def _json_scalar(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def save_results(results_file: str, records: dict[str, dict[str, Any]]):
+    """
+    Save the numeric results of an analysis.
+
+    'records' maps a record name (usually one figure) to its fields. Array
+    fields are stored as separate arrays, all other fields (numbers, strings,
+    lists) are stored in a JSON metadata entry.
+    """
+
+    arrays: dict[str, np.ndarray] = {}
+    metadata: dict[str, dict[str, Any]] = {}
+
+    for record_name, record in records.items():
+        metadata[record_name] = {}
+        for field, value in record.items():
+            if isinstance(value, np.ndarray):
+                arrays[f"{record_name}{_SEPARATOR}{field}"] = value
+            else:
+                metadata[record_name][field] = _json_scalar(value)
+
+    np.savez_compressed(
+        results_file, **arrays, **{_METADATA_KEY: np.array(json.dumps(metadata))}
+    )
+
+
+def load_results(results_file: str) -> dict[str, dict[str, Any]]:
+    with np.load(results_file, allow_pickle=False) as npz:
+        records = json.loads(str(npz[_METADATA_KEY]))
+
+        for key in npz.files:
+            if key == _METADATA_KEY:
+                continue
+            record_name, field = key.rsplit(_SEPARATOR, 1)
+            records[record_name][field] = npz[key]
+
+    return records
+
+
+def run_analysis_stages(
+    analysis_name: str,
+    compute: Callable[[str], dict[str, dict[str, Any]]],
+    render: Callable[[dict[str, dict[str, Any]], str, int], Any],
+    df_file: Optional[str],
+    parent_dir_out: str,
+    workers: int = 1,
+    stage: str = "all",
+    results_file: Optional[str] = None,
+):
+    # the compute stage writes the results artifact, the render stage only reads it
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+
+    if results_file is None:
+        results_file = os.path.join(parent_dir_out, analysis_name + RESULTS_SUFFIX)
+
+    if stage in ("all", "compute"):
+        if df_file is None:
+            raise ValueError("A dataframe file is required for the compute stage")
+        with profile_stage("compute"):
+            records = compute(df_file)
+        with profile_stage("save_results"):
+            save_results(results_file, records)
+
+    if stage in ("all", "render"):
+        with profile_stage("load_results"):
+            records = load_results(results_file)
+        with profile_stage("render"):
+            render(records, parent_dir_out, workers)
@@ -0,0 +1,392 @@
+import ast
+import glob
+import json
+import multiprocessing
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence
+
+from analysis_utils.cache import cache_key, restore_outputs, store_outputs
+
+SHARED_DATAFRAME_FILENAME = "tracking_dataframe.arrow"
+SHARED_DATASET_DIRNAME = "tracking_dataset"
+
+# upper bound of the decoded size of a value of the numeric and categorical
+# columns, used to check the free space of the shared directory
+BYTES_PER_VALUE = 8
+
+
+def discover_scripts(scripts_dir: str) -> list[str]:
+    # the same scripts as 'analysis-scripts/**/*.py' in 'pipeline.nf'
+    return sorted(
+        glob.glob(os.path.join(scripts_dir, "**", "*.py"), recursive=True),
+        key=os.path.basename,
+    )
+
+
+def script_name(script: str) -> str:
+    # the name of the output directory, like 'python_file.baseName'
+    return os.path.splitext(os.path.basename(script))[0]
+
+
+def referenced_columns(sources: Sequence[str], df_file: str) -> list[str]:
+    """
+    Columns of the tracking dataframe 'df_file' that the Python files 'sources'
+    can use: the columns named by a string literal, the partition keys and all
+    motility columns, whose names are built from the lag times.
+    """
+
+    # imported here, so that the workers only import polars when needed
+    from analysis_utils.lag_times import lag_time_index
+    from analysis_utils.loading import (
+        is_partitioned_dataset,
+        read_manifest,
+        tracking_dataframe_columns,
+    )
+
+    literals = set()
+    for source in sources:
+        with open(source, "r") as f:
+            literals.update(
+                node.value
+                for node in ast.walk(ast.parse(f.read()))
+                if isinstance(node, ast.Constant) and isinstance(node.value, str)
+            )
+
+    columns = tracking_dataframe_columns(df_file)
+    if is_partitioned_dataset(df_file):
+        literals.update(read_manifest(df_file)["partition_keys"])
+    literals.update(
+        c
+        for lt_columns in lag_time_index(columns).values()
+        for c in lt_columns.values()
+    )
+
+    return [c for c in columns if c in literals]
+
+
+def dataframe_num_rows(df_file: str) -> int:
+    # only reads the metadata, not the data
+    from analysis_utils.loading import is_partitioned_dataset, read_manifest
+
+    if is_partitioned_dataset(df_file):
+        return read_manifest(df_file)["num_rows"]
+
+    import polars as pl
+
+    return pl.scan_ipc(df_file).select(pl.len()).collect().item()
+
+
+def materialize_dataframe(df_file: str, outfile: str, columns: Sequence[str]):
+    """
+    Write the 'columns' of a tracking dataframe in a single IPC file to an
+    uncompressed IPC file.
+
+    Uncompressed IPC files are memory-mapped by polars, so all processes that
+    scan 'outfile' share the same pages instead of reading and decoding their
+    own copy.
+    """
+
+    from analysis_utils.loading import scan_tracking_dataframe
+
+    scan_tracking_dataframe(df_file, columns).sink_ipc(
+        outfile, compression="uncompressed"
+    )
+
+
+def materialize_partitioned_dataset(df_file: str, outdir: str, columns: Sequence[str]):
+    """
+    Write the 'columns' of every partition of a partitioned tracking dataset
+    to an uncompressed IPC file in 'outdir', together with a manifest and the
+    quantile sketches, so that 'outdir' is scanned like 'df_file'.
+
+    Like 'materialize_dataframe', the partitions are decoded once and then
+    memory-mapped by all processes, while the partition pruning and the
+    quantile sketches still apply.
+    """
+
+    import numpy as np
+    import polars as pl
+
+    from analysis_utils.loading import MANIFEST_FILENAME, read_manifest
+
+    manifest = read_manifest(df_file)
+    os.makedirs(outdir, exist_ok=True)
+
+    def write_partition(path: str) -> str:
+        shared_path = os.path.splitext(path)[0] + ".arrow"
+        os.makedirs(os.path.dirname(os.path.join(outdir, shared_path)), exist_ok=True)
+        pl.scan_parquet(os.path.join(df_file, path)).select(columns).sink_ipc(
+            os.path.join(outdir, shared_path), compression="uncompressed"
+        )
+        return shared_path
+
+    partitions = [
+        {
+            **p,
+            "path": write_partition(p["path"]),
+            "statistics": {c: s for c, s in p["statistics"].items() if c in columns},
+        }
+        for p in manifest["partitions"]
+    ]
+
+    if "quantile_sketches" in manifest:
+        # the sketches refer to their partitions by path
+        shared_paths = {
+            p["path"]: shared_p["path"]
+            for p, shared_p in zip(manifest["partitions"], partitions)
+        }
+        with np.load(os.path.join(df_file, manifest["quantile_sketches"])) as sketches:
+            sketches = {k: sketches[k] for k in sketches.files}
+        sketches["partitions"] = np.array(
+            [shared_paths[p] for p in sketches["partitions"].tolist()], dtype=str
+        )
+        np.savez(os.path.join(outdir, manifest["quantile_sketches"]), **sketches)
+
+    with open(os.path.join(outdir, MANIFEST_FILENAME), "w") as f:
+        json.dump(
+            {
+                **manifest,
+                "columns": list(columns),
+                "schema": write_partition(manifest["schema"]),
+                "partitions": partitions,
+            },
+            f,
+            indent=2,
+        )
+
+
+def run_script(
+    script: str,
+    df_file: str,
+    outdir: str,
+    workers: int = 1,
+    key: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> tuple[str, float]:
+    """
+    Run an analysis script like 'python <script>' in this process, and store
+    its outputs as 'key' in 'cache_dir' if given.
+    """
+
+    start = time.perf_counter()
+    os.makedirs(outdir, exist_ok=True)
+
+    argv = sys.argv
+    sys.argv = [
+        script,
+        f"--dataframe_file={df_file}",
+        f"--parent_dir_out={outdir}",
+        f"--workers={workers}",
+    ]
+    try:
+        # the modules imported by previous scripts are reused
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        sys.argv = argv
+
+    if key is not None:
+        store_outputs(cache_dir, key, outdir)
+
+    return script, time.perf_counter() - start
+
+
+def run_analysis_scripts(
+    scripts: Sequence[str],
+    df_file: str,
+    parent_dir_out: str,
+    processes: int,
+    workers: int = 1,
+    shared_dir: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    dataframe_fingerprint: Optional[str] = None,
+    code_paths: Sequence[str] = (),
+    invalidate: Sequence[str] = (),
+):
+    """
+    Run all analysis 'scripts' on the tracking dataframe 'df_file' in a pool of
+    'processes' worker processes, writing the outputs of every script to
+    '<parent_dir_out>/<script name>'.
+
+    With a 'shared_dir' (ideally a tmpfs), the columns that the scripts and
+    'analysis_utils' refer to are decoded once into an uncompressed copy of
+    the tracking dataframe there, which all scripts memory-map. A partitioned
+    tracking dataset keeps its partitions, manifest and quantile sketches in
+    the copy. Without a 'shared_dir', or if it has too little free space, all
+    scripts scan 'df_file' directly. Every worker imports the shared libraries
+    once for all scripts it runs. 'workers' is the number of rendering
+    processes of every script.
+
+    With a 'cache_dir' and the 'dataframe_fingerprint' of 'df_file', the
+    outputs of unchanged scripts are restored instead, like in 'pipeline.nf'.
+    """
+
+    if cache_dir is not None and dataframe_fingerprint is None:
+        raise ValueError("Caching requires the fingerprint of the dataframe")
+
+    keys = {
+        script: (
+            cache_key(script, dataframe_fingerprint, code_paths)
+            if cache_dir is not None
+            and "all" not in invalidate
+            and script_name(script) not in invalidate
+            else None
+        )
+        for script in scripts
+    }
+
+    if cache_dir is not None:
+        # cached scripts do not need the dataframe at all
+        for script, key in keys.items():
+            if key is None:
+                continue
+            outdir = os.path.join(parent_dir_out, script_name(script))
+            if restore_outputs(cache_dir, key, outdir):
+                print(f"Restored cached results of {script_name(script)} ({key})")
+                scripts = [s for s in scripts if s != script]
+
+    if len(scripts) == 0:
+        return
+
+    # imported here, so that the workers only import polars when needed
+    from analysis_utils.loading import is_partitioned_dataset
+
+    shared_tmp_dir = None
+    scanned_df_file = df_file
+    if shared_dir is not None:
+        columns = referenced_columns(
+            [
+                *scripts,
+                *glob.glob(os.path.join(os.path.dirname(__file__), "*.py")),
+            ],
+            df_file,
+        )
+        size = BYTES_PER_VALUE * len(columns) * dataframe_num_rows(df_file)
+
+        if shutil.disk_usage(shared_dir).free < size:
+            print(f"Not enough free space in {shared_dir}, scanning {df_file}")
+        else:
+            shared_tmp_dir = tempfile.mkdtemp(prefix="analysis-", dir=shared_dir)
+            scanned_df_file = os.path.join(
+                shared_tmp_dir,
+                (
+                    SHARED_DATASET_DIRNAME
+                    if is_partitioned_dataset(df_file)
+                    else SHARED_DATAFRAME_FILENAME
+                ),
+            )
+
+    try:
+        if shared_tmp_dir is not None:
+            print(f"Sharing {len(columns)} columns of {df_file} in {scanned_df_file}")
+            if is_partitioned_dataset(df_file):
+                materialize_partitioned_dataset(df_file, scanned_df_file, columns)
+            else:
+                materialize_dataframe(df_file, scanned_df_file, columns)
+
+        # the scripts run concurrently, so every script gets its share of the
+        # polars thread pool, unless it is configured explicitly
+        env_threads = os.environ.setdefault(
+            "POLARS_MAX_THREADS",
+            str(max(1, os.cpu_count() // min(processes, len(scripts)))),
+        )
+        print(f"Running {len(scripts)} scripts, {env_threads} polars threads each")
+
+        # 'spawn' avoids forking a process in which polars' thread pool is running
+        with ProcessPoolExecutor(
+            max_workers=min(processes, len(scripts)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    run_script,
+                    script,
+                    scanned_df_file,
+                    os.path.join(parent_dir_out, script_name(script)),
+                    workers,
+                    keys[script],
+                    cache_dir,
+                )
+                for script in scripts
+            ]
+
+            for future in futures:
+                script, wall_time = future.result()
+                print(f"Executed {script_name(script)} in {wall_time:.1f} s")
+    finally:
+        if shared_tmp_dir is not None:
+            shutil.rmtree(shared_tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Run all analysis scripts on a single shared copy of the "
+        "tracking dataframe."
+    )
+    parser.add_argument("--dataframe_file", type=str, required=True)
+    parser.add_argument("--parent_dir_out", type=str, required=True)
+    parser.add_argument(
+        "--scripts_dir",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "..", "analysis-scripts"),
+    )
+    parser.add_argument(
+        "--script",
+        type=str,
+        action="append",
+        default=[],
+        help="Only run the analysis scripts with these names.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of analysis scripts that run concurrently.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used for rendering the figures of a script.",
+    )
+    parser.add_argument(
+        "--shared_dir",
+        type=str,
+        default=None,
+        help="Directory for a shared uncompressed copy of the columns of the "
+        "dataframe that the scripts use, ideally a tmpfs like '/dev/shm'.",
+    )
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--dataframe_fingerprint", type=str, default=None)
+    parser.add_argument("--code_path", type=str, action="append", default=[])
+    parser.add_argument(
+        "--invalidate",
+        type=str,
+        default="",
+        help="'all' or a comma separated list of script names to re-run.",
+    )
+    args = parser.parse_args()
+
+    scripts = discover_scripts(args.scripts_dir)
+    if args.script:
+        scripts = [s for s in scripts if script_name(s) in args.script]
+
+    run_analysis_scripts(
+        scripts,
+        args.dataframe_file,
+        args.parent_dir_out,
+        args.processes,
+        workers=args.workers,
+        shared_dir=args.shared_dir,
+        cache_dir=args.cache_dir,
+        dataframe_fingerprint=args.dataframe_fingerprint,
+        code_paths=args.code_path,
+        invalidate=[s.strip() for s in args.invalidate.split(",") if s.strip()],
+    )
@@ -0,0 +1,102 @@
+from typing import NamedTuple, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.loading import scan_tracking_dataframe
+from analysis_utils.profiling import stage
+
+_ROW_INDEX = "__row_index"
+_SAMPLE_KEY = "__sample_key"
+
+
+class Stratum(NamedTuple):
+    # rows with a NaN or missing value in any of 'columns' are not sampled
+    columns: Sequence[str]
+    filters: Sequence[pl.Expr] = ()
+
+
+def sample_keys(row_index: np.ndarray, seed: int) -> np.ndarray:
+    # splitmix64 of the row index, i.e. a fixed pseudo-random key per row
+    # that does not depend on how the rows are split into batches
+    with np.errstate(over="ignore"):
+        z = row_index.astype(np.uint64) + np.uint64(seed) * np.uint64(
+            0x9E3779B97F4A7C15
+        )
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def valid_rows(schema: pl.Schema, columns: Sequence[str]) -> list[pl.Expr]:
+    return [
+        (
+            pl.col(c).is_not_null() & pl.col(c).is_not_nan()
+            if schema[c].is_float()
+            else pl.col(c).is_not_null()
+        )
+        for c in columns
+    ]
+
+
+def stratified_reservoir_sample(
+    df_file: str,
+    strata: dict[str, Stratum],
+    size: int,
+    seed: int = 0,
+    filters: Optional[Sequence[pl.Expr]] = None,
+    batch_size: int = 1_000_000,
+) -> dict[str, pl.DataFrame]:
+    """
+    Draw a uniform sample without replacement of at most 'size' rows for every
+    stratum in a single pass over the tracking dataframe.
+
+    Every row gets a fixed pseudo-random key derived from its position and
+    'seed', and every stratum keeps the rows with the 'size' smallest keys of
+    its matching rows (bottom-k reservoir). The samples are therefore
+    reproducible for the same dataframe, 'filters' and 'seed', independent of
+    the batch size. Only 'batch_size' rows and the reservoirs are held in
+    memory. The rows of every sample are returned in the order of the
+    dataframe.
+    """
+
+    columns = list(
+        dict.fromkeys(
+            c
+            for s in strata.values()
+            for c in [*s.columns, *(r for f in s.filters for r in f.meta.root_names())]
+        )
+    )
+
+    # 'filters' apply to all strata and prune partitions, the keys are
+    # assigned to the rows that remain
+    lf = scan_tracking_dataframe(df_file, columns, filters).with_row_index(_ROW_INDEX)
+
+    reservoirs: dict[str, Optional[pl.DataFrame]] = {name: None for name in strata}
+
+    with stage("stratified_reservoir_sample") as s:
+        for batch in lf.collect_batches(chunk_size=batch_size):
+            s.add_rows(len(batch))
+            batch = batch.with_columns(
+                pl.Series(_SAMPLE_KEY, sample_keys(batch[_ROW_INDEX].to_numpy(), seed))
+            )
+
+            for name, stratum in strata.items():
+                candidates = batch.filter(
+                    *stratum.filters, *valid_rows(batch.schema, stratum.columns)
+                ).select(_ROW_INDEX, _SAMPLE_KEY, *stratum.columns)
+
+                if reservoirs[name] is not None:
+                    candidates = pl.concat([reservoirs[name], candidates])
+
+                reservoirs[name] = candidates.bottom_k(size, by=_SAMPLE_KEY)
+
+    return {
+        name: (
+            # an empty dataframe yields no batches at all
+            lf.head(0).select(*stratum.columns).collect()
+            if reservoirs[name] is None
+            else reservoirs[name].sort(_ROW_INDEX).select(*stratum.columns)
+        )
+        for name, stratum in strata.items()
+    }
@@ -0,0 +1,277 @@
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.loading import scan_tracking_dataframe
+from analysis_utils.profiling import profiled
+
+SUMMARY_STATISTICS = [
+    "num_values",
+    "min",
+    "q1",
+    "median",
+    "q3",
+    "max",
+    "whisker_low",
+    "whisker_high",
+    "num_outliers_low",
+    "num_outliers_high",
+    "bandwidth",
+]
+
+
+def kde_bandwidth_factor_1d(
+    num_values: np.ndarray, bw_method: Union[str, float] = "scott"
+) -> np.ndarray:
+    # same bandwidth factors as 'scipy.stats.gaussian_kde' for 1D data
+    num_values = np.asarray(num_values, dtype=np.float64)
+    if bw_method == "scott":
+        return num_values ** (-1.0 / 5)
+    if bw_method == "silverman":
+        return (num_values * 3 / 4.0) ** (-1.0 / 5)
+    if np.isscalar(bw_method) and not isinstance(bw_method, str):
+        return np.full_like(num_values, float(bw_method))
+
+    raise ValueError(f"Unknown bandwidth method '{bw_method}'")
+
+
+@profiled()
+def violin_summary_table(
+    df_file: str,
+    columns: Sequence[str],
+    group_by: Sequence[str],
+    filters: Optional[Sequence[pl.Expr]] = None,
+    bw_method: Union[str, float] = "scott",
+    cut: float = 2.0,
+    gridsize: int = 100,
+    whis: float = 1.5,
+    num_bins: int = 2048,
+) -> pl.DataFrame:
+    """
+    Summarize the distribution of every column in 'columns' for every group of
+    'group_by' in two grouped passes over the data, with everything needed to
+    draw a box and a violin plot.
+
+    The box statistics are those of 'matplotlib.cbook.boxplot_stats': the
+    quartiles, the whiskers at the most extreme values within 'whis' times
+    the interquartile range of the box and the number of values beyond the
+    whiskers. The violin is the Gaussian KDE of 'sns.violinplot' (with the
+    bandwidth of 'scipy.stats.gaussian_kde' and 'cut' bandwidths beyond the
+    extreme values) at 'gridsize' points, which is evaluated on a histogram
+    with 'num_bins' bins instead of on all values. NaN and missing values are
+    ignored.
+
+    The result has one row per column and group, with the 'support' and
+    'density' of the KDE as list columns.
+    """
+
+    keys = ["column", *group_by]
+
+    values = (
+        scan_tracking_dataframe(df_file, [*group_by, *columns], filters)
+        .with_columns(
+            pl.col(group_by).cast(pl.String),
+            # compacted columns may have different float types
+            pl.col(columns).cast(pl.Float64),
+        )
+        .unpivot(on=columns, index=group_by, variable_name="column")
+        .filter(pl.col("value").is_not_null() & pl.col("value").is_not_nan())
+    )
+
+    value = pl.col("value")
+    iqr = pl.col("q3") - pl.col("q1")
+
+    statistics = (
+        values.group_by(keys)
+        .agg(
+            pl.len().alias("num_values"),
+            value.min().alias("min"),
+            value.quantile(0.25, "linear").alias("q1"),
+            value.median().alias("median"),
+            value.quantile(0.75, "linear").alias("q3"),
+            value.max().alias("max"),
+            value.std().alias("std"),
+        )
+        .with_columns(
+            (pl.col("q1") - whis * iqr).alias("fence_low"),
+            (pl.col("q3") + whis * iqr).alias("fence_high"),
+        )
+        .collect()
+    )
+
+    bandwidth = statistics["std"].to_numpy() * kde_bandwidth_factor_1d(
+        statistics["num_values"].to_numpy(), bw_method
+    )
+    statistics = statistics.with_columns(
+        pl.Series("bandwidth", bandwidth),
+        pl.Series("lower", statistics["min"].to_numpy() - cut * bandwidth),
+        pl.Series("upper", statistics["max"].to_numpy() + cut * bandwidth),
+    )
+
+    # whiskers, outliers and the histogram of the KDE in a second pass, which
+    # needs the fences and the support of every group
+    with_statistics = values.join(statistics.lazy(), on=keys)
+
+    whiskers = with_statistics.group_by(keys).agg(
+        value.filter(value >= pl.col("fence_low")).min().alias("whisker_low"),
+        value.filter(value <= pl.col("fence_high")).max().alias("whisker_high"),
+        (value < pl.col("fence_low")).sum().alias("num_outliers_low"),
+        (value > pl.col("fence_high")).sum().alias("num_outliers_high"),
+    )
+
+    histograms = (
+        with_statistics.with_columns(
+            pl.when(pl.col("upper") > pl.col("lower"))
+            .then(
+                (value - pl.col("lower"))
+                / (pl.col("upper") - pl.col("lower"))
+                * num_bins
+            )
+            .otherwise(0)
+            .floor()
+            .cast(pl.Int64)
+            .clip(upper_bound=num_bins - 1)
+            .alias("bin")
+        )
+        .group_by([*keys, "bin"])
+        .agg(pl.len().alias("count"))
+    )
+
+    # both share a single scan of the values
+    whiskers, histograms = pl.collect_all([whiskers, histograms])
+
+    summaries = statistics.join(whiskers, on=keys)
+    group_histograms = histograms.partition_by(keys, as_dict=True)
+
+    supports, densities = [], []
+    for row in summaries.iter_rows(named=True):
+        support = np.linspace(row["lower"], row["upper"], gridsize)
+
+        if not row["bandwidth"] > 0:
+            # a single value or no variance, like 'sns.violinplot' there is no
+            # density to draw
+            supports.append(support)
+            densities.append(np.full(gridsize, np.nan))
+            continue
+
+        group_histogram = group_histograms[tuple(row[k] for k in keys)]
+        bin_width = (row["upper"] - row["lower"]) / num_bins
+        bin_centers = row["lower"] + (group_histogram["bin"].to_numpy() + 0.5) * (
+            bin_width
+        )
+
+        # sum of gaussians at the bin centers, weighted by their counts
+        kernel = np.exp(
+            -0.5 * ((support[:, None] - bin_centers[None, :]) / row["bandwidth"]) ** 2
+        ) / (np.sqrt(2 * np.pi) * row["bandwidth"])
+        density = kernel @ group_histogram["count"].to_numpy() / row["num_values"]
+
+        supports.append(support)
+        densities.append(density)
+
+    return (
+        summaries.with_columns(
+            pl.Series("support", supports, dtype=pl.List(pl.Float64)),
+            pl.Series("density", densities, dtype=pl.List(pl.Float64)),
+        )
+        .select(*keys, *SUMMARY_STATISTICS, "support", "density")
+        .sort(keys)
+    )
+
+
+def violin_arrays(
+    table: pl.DataFrame, by: str, **group_values: str
+) -> dict[str, np.ndarray]:
+    """
+    Select the summaries of 'violin_summary_table' that match 'group_values'
+    and stack them in the order of the groups in 'by', one violin each.
+    """
+
+    selected = table.filter(
+        *[pl.col(k).str.to_lowercase() == v.lower() for k, v in group_values.items()]
+    ).sort(by)
+
+    if len(selected) == 0:
+        raise KeyError(f"No summaries for {group_values}")
+
+    return {
+        by: selected[by].to_numpy().astype(str),
+        **{s: selected[s].to_numpy() for s in SUMMARY_STATISTICS},
+        "support": np.vstack(selected["support"].to_list()),
+        "density": np.vstack(selected["density"].to_list()),
+    }
+
+
+def plot_violins(
+    ax,
+    labels: np.ndarray,
+    support: np.ndarray,
+    density: np.ndarray,
+    q1: np.ndarray,
+    median: np.ndarray,
+    q3: np.ndarray,
+    whisker_low: np.ndarray,
+    whisker_high: np.ndarray,
+    width: float = 0.8,
+    color: Optional[str] = None,
+    linecolor: str = ".25",
+):
+    """
+    Draw vertical violins with an inner box from precomputed summaries, like
+    'sns.violinplot(inner="box", density_norm="area")'.
+    """
+
+    import matplotlib as mpl
+    import seaborn as sns
+
+    color = sns.desaturate(color or "C0", 0.75)
+    linewidth = mpl.rcParams["patch.linewidth"]
+    box_width = linewidth * 4.5
+
+    # all violins have the same area
+    max_density = np.nanmax(density) if np.any(np.isfinite(density)) else 1.0
+
+    for position in range(len(labels)):
+        if np.all(np.isnan(density[position])):
+            ax.plot(
+                [position - width / 2, position + width / 2],
+                [median[position], median[position]],
+                color=linecolor,
+                linewidth=linewidth,
+            )
+            continue
+
+        span = density[position] / max_density * width / 2
+        ax.fill_betweenx(
+            support[position],
+            position - span,
+            position + span,
+            facecolor=color,
+            edgecolor=linecolor,
+            linewidth=linewidth,
+        )
+        ax.plot(
+            [position, position],
+            [whisker_low[position], whisker_high[position]],
+            color=linecolor,
+            linewidth=box_width / 3,
+        )
+        ax.plot(
+            [position, position],
+            [q1[position], q3[position]],
+            color=linecolor,
+            linewidth=box_width,
+        )
+        ax.plot(
+            [position],
+            [median[position]],
+            marker="_",
+            markersize=box_width / 1.2,
+            markeredgewidth=box_width / 5,
+            markeredgecolor="w",
+            markerfacecolor="w",
+        )
+
+    ax.set_xticks(range(len(labels)), labels)
+    ax.set_xlim(-0.5, len(labels) - 0.5)
@@ -0,0 +1,72 @@
+import json
+from argparse import ArgumentParser
+from collections import defaultdict
+
+
+def best_results(report: dict) -> dict[str, dict]:
+    # the fastest of all repeats of every benchmark
+    results = defaultdict(list)
+    for result in report["results"]:
+        if result["returncode"] == 0:
+            results[result["name"]].append(result)
+
+    return {
+        name: min(rs, key=lambda r: r["wall_time_s"]) for name, rs in results.items()
+    }
+
+
+def compare_benchmarks(baseline_file: str, candidate_file: str, threshold: float):
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    with open(candidate_file, "r") as f:
+        candidate = json.load(f)
+
+    if baseline["dataframe"]["num_rows"] != candidate["dataframe"]["num_rows"]:
+        print("Warning: the benchmarks were run on dataframes of different sizes")
+
+    baseline_results = best_results(baseline)
+    candidate_results = best_results(candidate)
+
+    print(
+        f"{'benchmark':<20} {'time [s]':>21} {'ratio':>7} "
+        f"{'peak RSS [MiB]':>21} {'ratio':>7}"
+    )
+
+    regressions = []
+    for name in sorted(baseline_results.keys() & candidate_results.keys()):
+        b, c = baseline_results[name], candidate_results[name]
+        time_ratio = c["wall_time_s"] / b["wall_time_s"]
+        rss_ratio = c["peak_rss_mib"] / b["peak_rss_mib"]
+
+        print(
+            f"{name:<20} {b['wall_time_s']:>10.2f}{c['wall_time_s']:>11.2f} "
+            f"{time_ratio:>7.2f} {b['peak_rss_mib']:>10.0f}{c['peak_rss_mib']:>11.0f} "
+            f"{rss_ratio:>7.2f}"
+        )
+
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            regressions.append(name)
+
+    for name in sorted(baseline_results.keys() ^ candidate_results.keys()):
+        print(f"{name:<20} only succeeded in one of the runs")
+
+    if regressions:
+        print(f"Regressions (> {threshold:.0%}): {', '.join(regressions)}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument("baseline_file", type=str)
+    parser.add_argument("candidate_file", type=str)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown or memory increase reported as a regression.",
+    )
+    args = parser.parse_args()
+
+    compare_benchmarks(args.baseline_file, args.candidate_file, args.threshold)
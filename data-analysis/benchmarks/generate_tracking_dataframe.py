@@ -0,0 +1,139 @@
+import os
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import polars as pl
+
+from analysis_utils.loading import CELL_CULTURE_METHODOLOGIES, CELL_LINE_NAMES
+
+LAG_TIMES_MINUTES = [30, 60, 90, 120, 150, 180, 210, 240]
+
+# every synthetic dataset has a single cell line and culture method, like the
+# datasets of the real pipeline
+DATASET_KINDS = [
+    ("HeLa", "control"),
+    ("HeLa", "co-culture"),
+    ("CaSki", "control"),
+    ("CaSki", "co-culture"),
+]
+
+
+def synthetic_dataset(
+    rng: np.random.Generator,
+    num_rows: int,
+    basename: str,
+    cell_line_name: str,
+    cell_culture_methodology: str,
+    lag_times_minutes: list[int],
+) -> pl.DataFrame:
+    columns = {}
+
+    columns["cell_area_mum_squared"] = rng.gamma(5.0, 60.0, num_rows)
+    columns["nucleus_area_mum_squared"] = columns["cell_area_mum_squared"] * rng.beta(
+        4.0, 12.0, num_rows
+    )
+    columns["cell_shape"] = 3.55 + rng.gamma(2.0, 0.25, num_rows)
+    columns["nucleus_shape"] = (
+        3.55 + 0.3 * (columns["cell_shape"] - 3.55) + rng.gamma(2.0, 0.05, num_rows)
+    )
+    columns["local_density_per_mum_squared"] = rng.gamma(8.0, 0.0004, num_rows)
+
+    # tracks that end before the lag time have no motility values, so the
+    # fraction of missing values grows with the lag time
+    track_length = rng.exponential(300.0, num_rows)
+    motility = rng.gamma(1.5, 1.0, num_rows)
+
+    for lt in lag_times_minutes:
+        missing = (track_length < lt) | (rng.random(num_rows) < 0.02)
+
+        d2min = motility * lt / 10.0 * rng.gamma(4.0, 0.25, num_rows)
+        d2min[missing] = np.nan
+        columns[f"D2min_{lt}_minutes"] = d2min
+
+        crsd = d2min * rng.gamma(8.0, 0.15, num_rows) + rng.gamma(1.0, 2.0, num_rows)
+        crsd[missing | (rng.random(num_rows) < 0.01)] = np.nan
+        columns[f"cage_relative_squared_displacement_mum_squared_{lt}_min"] = crsd
+
+    return pl.DataFrame(columns).with_columns(
+        pl.lit(cell_line_name, dtype=pl.Enum(CELL_LINE_NAMES)).alias("cell_line_name"),
+        pl.lit(
+            cell_culture_methodology, dtype=pl.Enum(CELL_CULTURE_METHODOLOGIES)
+        ).alias("cell_culture_methodology"),
+        pl.lit("eliane", dtype=pl.Enum(["eliane", "juergen"])).alias(
+            "dataset_provider"
+        ),
+        pl.lit(basename).alias("dataset_basename"),
+    )
+
+
+def generate_tracking_dataframe(
+    outfile: str,
+    num_rows: int,
+    rows_per_dataset: int = 1_000_000,
+    lag_times_minutes: list[int] = LAG_TIMES_MINUTES,
+    seed: int = 0,
+):
+    """
+    Write a synthetic combined cell tracking dataframe with the schema of the
+    real pipeline to an IPC file, one synthetic dataset at a time, so that
+    dataframes much larger than memory can be generated.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # at least one dataset of every kind
+    rows_per_dataset = max(min(rows_per_dataset, -(-num_rows // len(DATASET_KINDS))), 1)
+
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(outfile))
+    ) as tmpdir:
+        dataset_files = []
+
+        for dataset_index, start in enumerate(range(0, num_rows, rows_per_dataset)):
+            cell_line_name, cell_culture_methodology = DATASET_KINDS[
+                dataset_index % len(DATASET_KINDS)
+            ]
+            dataset_files.append(os.path.join(tmpdir, f"{dataset_index:06d}.ipc"))
+
+            synthetic_dataset(
+                rng,
+                min(rows_per_dataset, num_rows - start),
+                f"synthetic_{cell_line_name.lower()}_{dataset_index:04d}",
+                cell_line_name,
+                cell_culture_methodology,
+                lag_times_minutes,
+            ).write_ipc(dataset_files[-1])
+
+        # concatenate like 'concatenate_tracking_dataframes', but streaming
+        pl.concat([pl.scan_ipc(f) for f in dataset_files]).sink_ipc(
+            outfile, compression="lz4"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument("--outfile", type=str, required=True)
+    parser.add_argument("--num_rows", type=int, required=True)
+    parser.add_argument(
+        "--rows_per_dataset",
+        type=int,
+        default=1_000_000,
+        help="Number of rows of every synthetic dataset (and written batch).",
+    )
+    parser.add_argument(
+        "--lag_times_minutes",
+        type=str,
+        default=",".join(str(lt) for lt in LAG_TIMES_MINUTES),
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_tracking_dataframe(
+        args.outfile,
+        args.num_rows,
+        rows_per_dataset=args.rows_per_dataset,
+        lag_times_minutes=[int(lt) for lt in args.lag_times_minutes.split(",")],
+        seed=args.seed,
+    )
@@ -0,0 +1,189 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from typing import Optional
+
+import polars as pl
+from generate_tracking_dataframe import generate_tracking_dataframe
+
+from analysis_utils.loading import (
+    is_partitioned_dataset,
+    read_manifest,
+    tracking_dataframe_columns,
+)
+from analysis_utils.profiling import measure_subprocess
+
+# Usage (from 'data-analysis'):
+#   PYTHONPATH=. python benchmarks/run_benchmarks.py --num_rows=10000000 \
+#       --outfile=benchmark-results/<commit>.json
+#   PYTHONPATH=. python benchmarks/compare_benchmarks.py old.json new.json
+
+ANALYSIS_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "analysis-scripts"
+)
+
+# entry function -> analysis script
+BENCHMARKS = {
+    "phase_spaces": "cellular-dynamics/phase_spaces.py",
+    "d2min_vs_crsd": "cellular-dynamics/d2min_vs_crsd.py",
+    "motility": "eliane-paper/motility.py",
+    "cell_density": "eliane-paper/cell_density.py",
+    "cell_nucleus_shape": "eliane-paper/cell_nucleus_shape.py",
+    "boxplot_shapes": "eliane-paper/boxplots_shapes.py",
+}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ANALYSIS_SCRIPTS_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    name: str, df_file: str, parent_dir_out: str, workers: int, stage: str
+) -> dict:
+    # every benchmark runs in its own process, so that its peak RSS can be
+    # measured with 'wait4' and no state is shared between benchmarks
+    command = [
+        sys.executable,
+        os.path.join(ANALYSIS_SCRIPTS_DIR, BENCHMARKS[name]),
+        f"--dataframe_file={df_file}",
+        f"--parent_dir_out={parent_dir_out}",
+        f"--workers={workers}",
+        f"--stage={stage}",
+    ]
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in [os.path.dirname(ANALYSIS_SCRIPTS_DIR), env.get("PYTHONPATH")] if p
+    )
+
+    # render workers are separate processes and not included in the peak RSS
+    return {"name": name, **measure_subprocess(command, env)}
+
+
+def run_benchmarks(
+    df_file: str,
+    outfile: str,
+    benchmarks: list[str],
+    repeats: int = 1,
+    workers: int = 1,
+    stage: str = "all",
+):
+    results = []
+    with tempfile.TemporaryDirectory() as parent_dir_out:
+        for name in benchmarks:
+            for repeat in range(repeats):
+                result = run_benchmark(name, df_file, parent_dir_out, workers, stage)
+                result["repeat"] = repeat
+                print(
+                    f"{name} [{repeat + 1}/{repeats}]: {result['wall_time_s']:.2f} s, "
+                    f"{result['peak_rss_mib']:.0f} MiB"
+                    + (
+                        f" (exit code {result['returncode']})"
+                        if result["returncode"]
+                        else ""
+                    )
+                )
+                results.append(result)
+
+    if is_partitioned_dataset(df_file):
+        num_rows = read_manifest(df_file)["num_rows"]
+    else:
+        num_rows = pl.scan_ipc(df_file).select(pl.len()).collect().item()
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "host": {
+            "hostname": platform.node(),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "dataframe": {
+            "path": os.path.abspath(df_file),
+            "num_rows": num_rows,
+            "num_columns": len(tracking_dataframe_columns(df_file)),
+        },
+        "workers": workers,
+        "stage": stage,
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    with open(outfile, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--dataframe_file",
+        type=str,
+        default=None,
+        help="Tracking dataframe to benchmark with, a synthetic one is generated otherwise.",
+    )
+    parser.add_argument(
+        "--num_rows",
+        type=int,
+        default=1_000_000,
+        help="Number of rows of the synthetic tracking dataframe.",
+    )
+    parser.add_argument("--outfile", type=str, required=True)
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        default=",".join(BENCHMARKS.keys()),
+        help="Comma separated list of entry functions to benchmark.",
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--stage",
+        type=str,
+        choices=["all", "compute"],
+        default="all",
+        help="'compute' only measures the numeric part of every analysis.",
+    )
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(",")
+    unknown_benchmarks = [b for b in benchmarks if b not in BENCHMARKS]
+    if unknown_benchmarks:
+        raise ValueError(f"Unknown benchmarks {unknown_benchmarks}")
+
+    if args.dataframe_file is not None:
+        run_benchmarks(
+            args.dataframe_file,
+            args.outfile,
+            benchmarks,
+            args.repeats,
+            args.workers,
+            args.stage,
+        )
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            df_file = os.path.join(tmpdir, "synthetic_cell_tracks.ipc")
+            generate_tracking_dataframe(df_file, args.num_rows)
+            run_benchmarks(
+                df_file,
+                args.outfile,
+                benchmarks,
+                args.repeats,
+                args.workers,
+                args.stage,
+            )
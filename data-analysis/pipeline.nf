@@ -2,6 +2,7 @@ workflow data_analysis {
     take:
     all_cell_tracks_dataframe
     all_graph_datasets
+    preparation_profiles
 
     main:
     parent_dir_out = file(params.parent_outdir_analysis).resolve(params.out_dir).toString()
@@ -10,32 +11,184 @@ workflow data_analysis {
     new File(parent_dir_out).deleteDir()
     new File(parent_dir_out).mkdirs()
 
-    python_files_ch = Channel.fromPath("${moduleDir}/analysis-scripts/**/*.py", hidden: false)
+    // results are cached next to (not inside) parent_dir_out, which is cleared above
+    cache_dir = params.analysis_cache_dir ?: file(params.parent_outdir_analysis).resolve(".analysis-cache").toString()
 
-    execute_python_analysis_script(python_files_ch, all_cell_tracks_dataframe, all_graph_datasets, parent_dir_out)
+    dataframe_fingerprint = fingerprint_dataframe(all_cell_tracks_dataframe).map { it.trim() }
+
+    if (params.shared_analysis_runner) {
+        execute_analysis_runner(all_cell_tracks_dataframe, dataframe_fingerprint, parent_dir_out, cache_dir)
+        profiles = execute_analysis_runner.out.profile
+    }
+    else {
+        python_files_ch = Channel.fromPath("${moduleDir}/analysis-scripts/**/*.py", hidden: false)
+
+        execute_python_analysis_script(python_files_ch, all_cell_tracks_dataframe, dataframe_fingerprint, all_graph_datasets, parent_dir_out, cache_dir)
+        profiles = execute_python_analysis_script.out.profile
+    }
+
+    // ranked per-stage timings of all preparation and analysis scripts
+    aggregate_profiles(profiles.mix(preparation_profiles).collect(), parent_dir_out)
+
+    // neighbour statistics of every graph dataset, computed from its graph
+    // store (see 'convert_graph_dataset'), which is read one frame at a time
+    graph_datasets_ch = all_graph_datasets
+        .flatMap { it.collate(3) }
+        .map { basename, graph_store, _dataset_config -> tuple(basename, graph_store) }
+
+    graph_neighbour_statistics(graph_datasets_ch, parent_dir_out)
+}
+
+process fingerprint_dataframe {
+
+    label "single_threaded", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    path all_cell_tracks_dataframe
+
+    output:
+    stdout
+
+    script:
+    """
+    export PYTHONPATH="${moduleDir}:\${PYTHONPATH:-}"
+
+    python -m analysis_utils.cache fingerprint --path="${all_cell_tracks_dataframe}"
+    """
 }
 
 process execute_python_analysis_script {
 
     publishDir "${parent_dir_out}/${python_file.baseName}", mode: 'copy'
 
-    label "single_threaded", "short_running"
+    label "medium_cpu", "short_running"
 
     conda "${moduleDir}/environment.yml"
 
     input:
     path python_file
     path all_cell_tracks_dataframe
+    val dataframe_fingerprint
     val all_graph_datasets
     val parent_dir_out
+    val cache_dir
 
     output:
     path "*"
+    // per-stage timings and peak memory, see 'analysis_utils/profiling.py'
+    path "profile.json", emit: profile, optional: true
+
+    script:
+    // 'all' or a comma separated list of script names to re-run regardless of the cache
+    def invalidated = params.invalidate_analysis_cache.toString().tokenize(',')*.trim()
+    def invalidate = invalidated.contains("all") || invalidated.contains(python_file.baseName)
+    """
+    export PYTHONPATH="${moduleDir}:\${PYTHONPATH:-}"
+
+    cache_key=\$(python -m analysis_utils.cache key \
+        --script=${python_file} \
+        --dataframe_fingerprint=${dataframe_fingerprint} \
+        --code_path="${moduleDir}/analysis_utils" \
+        --code_path="${moduleDir}/environment.yml")
+
+    if [ "${invalidate}" = "false" ] && python -m analysis_utils.cache restore \
+        --cache_dir="${cache_dir}" --key=\${cache_key} --outdir="."; then
+        echo "Restored cached results of ${python_file.baseName} (\${cache_key})"
+    else
+        python ${python_file} \
+            --dataframe_file=${all_cell_tracks_dataframe} \
+            --parent_dir_out="." \
+            --workers=${task.cpus}
+
+        python -m analysis_utils.cache store \
+            --cache_dir="${cache_dir}" --key=\${cache_key} --outdir="."
+    fi
+    """
+}
+
+process execute_analysis_runner {
+
+    publishDir "${parent_dir_out}", mode: 'copy'
+
+    label "high_cpu", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    path all_cell_tracks_dataframe
+    val dataframe_fingerprint
+    val parent_dir_out
+    val cache_dir
+
+    output:
+    // one directory per analysis script, like 'execute_python_analysis_script'
+    path "*", type: "dir"
+    path "*/profile.json", emit: profile, optional: true
 
     script:
     """
-    python ${python_file} \
+    export PYTHONPATH="${moduleDir}:\${PYTHONPATH:-}"
+
+    python -m analysis_utils.runner \
         --dataframe_file=${all_cell_tracks_dataframe} \
         --parent_dir_out="." \
+        --scripts_dir="${moduleDir}/analysis-scripts" \
+        --processes=${task.cpus} \
+        ${params.analysis_shared_dir ? "--shared_dir=${params.analysis_shared_dir}" : ""} \
+        --cache_dir="${cache_dir}" \
+        --dataframe_fingerprint=${dataframe_fingerprint} \
+        --code_path="${moduleDir}/analysis_utils" \
+        --code_path="${moduleDir}/environment.yml" \
+        --invalidate="${params.invalidate_analysis_cache}"
+    """
+}
+
+process graph_neighbour_statistics {
+
+    publishDir "${parent_dir_out}/neighbour_statistics", mode: 'copy'
+
+    label "single_threaded", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    tuple val(basename), path(graph_store)
+    val parent_dir_out
+
+    output:
+    path "${basename}"
+
+    script:
+    """
+    export PYTHONPATH="${moduleDir}:\${PYTHONPATH:-}"
+
+    python -m analysis_utils.graphs statistics \
+        --graph_dataset="${basename}=${graph_store}" \
+        --outdir="${basename}"
+    """
+}
+
+process aggregate_profiles {
+
+    publishDir "${parent_dir_out}", mode: 'copy'
+
+    label "single_threaded", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    path profiles, stageAs: "profiles/*/profile.json"
+    val parent_dir_out
+
+    output:
+    path "hotspots.json"
+
+    script:
+    """
+    export PYTHONPATH="${moduleDir}:\${PYTHONPATH:-}"
+
+    python -m analysis_utils.profiling --parent_dir="profiles" --outfile="hotspots.json"
     """
 }
@@ -0,0 +1,244 @@
+import os
+from argparse import ArgumentParser
+from typing import Iterator, Optional
+
+import cv2
+import numpy as np
+import toml
+from core_data_utils.datasets import BaseDataSet, BaseDataSetEntry
+from frame_store import write_frame_store
+
+PROVIDERS = ["eliane", "juergen"]
+
+# file names of the frames in the layouts read by 'prepare_dataset.py'
+FRAME_FILENAMES = {
+    "eliane": "frame_{frame:04d}.png",
+    "juergen": "{basename}_t{frame:04d}c2.png",
+}
+
+NUCLEUS_RADIUS_MUM = 5.0
+CELL_RADIUS_MUM = 12.0
+# standard deviation of the displacement of a cell between two frames
+STEP_MUM = 1.5
+
+
+def synthetic_frames(
+    rng: np.random.Generator,
+    num_frames: int,
+    height: int,
+    width: int,
+    mum_per_px: float,
+    cells_per_mm_squared: float,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield (RGB image, cell label image) pairs of cells that perform a random
+    walk, with the nuclei in the blue and the cell bodies in the green channel.
+    """
+
+    area_mm_squared = height * width * (mum_per_px / 1000) ** 2
+    num_cells = max(int(round(cells_per_mm_squared * area_mm_squared)), 1)
+
+    positions = rng.random((num_cells, 2)) * [width, height]
+    nucleus_radius = max(int(round(NUCLEUS_RADIUS_MUM / mum_per_px)), 1)
+    cell_radius = max(int(round(CELL_RADIUS_MUM / mum_per_px)), nucleus_radius + 1)
+
+    for _ in range(num_frames):
+        nuclei = np.zeros((height, width), dtype=np.uint8)
+        cells = np.zeros((height, width), dtype=np.uint8)
+        labels = np.zeros((height, width), dtype=np.int32)
+
+        for label, (x, y) in enumerate(positions.astype(int), start=1):
+            cv2.circle(cells, (x, y), cell_radius, 90, -1)
+            cv2.circle(labels, (x, y), cell_radius, label, -1)
+            cv2.circle(nuclei, (x, y), nucleus_radius, 200, -1)
+
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        image[..., 0] = cv2.GaussianBlur(nuclei, (0, 0), nucleus_radius / 3)
+        image[..., 1] = cv2.GaussianBlur(cells, (0, 0), cell_radius / 6)
+        # camera noise, so that the PNG compression ratio is realistic
+        image = cv2.add(image, rng.integers(0, 12, image.shape, dtype=np.uint8))
+
+        yield cv2.cvtColor(image, cv2.COLOR_BGR2RGB), labels
+
+        positions += rng.normal(0.0, STEP_MUM / mum_per_px, positions.shape)
+        positions %= [width, height]
+
+
+def abstract_structure(labels: np.ndarray, mum_per_px: float) -> dict:
+    # one entry per cell, like the output of 'structure_abstraction'
+    num_labels, _, stats, centroids = cv2.connectedComponentsWithStats(
+        (labels > 0).view(np.uint8), connectivity=8
+    )
+    return {
+        label: {
+            "centroid_mum": centroids[label] * mum_per_px,
+            "cell_area_mum_squared": stats[label, cv2.CC_STAT_AREA] * mum_per_px**2,
+        }
+        for label in range(1, num_labels)
+    }
+
+
+def generate_dataset(
+    dataset_dir: str,
+    provider: str,
+    rng: np.random.Generator,
+    num_frames: int,
+    height: int,
+    width: int,
+    mum_per_px: float,
+    cells_per_mm_squared: float,
+    intermediates_dir: Optional[str] = None,
+) -> int:
+    """
+    Write the frames of one synthetic dataset in the layout of 'provider' and
+    return the number of bytes written. The cell approximations (frame store)
+    and abstract structures (pickle) read by 'annotate_cell_density.py' are
+    written to 'intermediates_dir', if given.
+    """
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    basename = os.path.basename(os.path.normpath(dataset_dir))
+
+    frames = synthetic_frames(
+        rng, num_frames, height, width, mum_per_px, cells_per_mm_squared
+    )
+
+    bytes_written = 0
+    cell_approximations, abstract_structures = [], {}
+
+    for frame, (image, labels) in enumerate(frames):
+        fpath = os.path.join(
+            dataset_dir,
+            FRAME_FILENAMES[provider].format(basename=basename, frame=frame),
+        )
+        cv2.imwrite(fpath, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        bytes_written += os.path.getsize(fpath)
+
+        if intermediates_dir is not None:
+            identifier = os.path.basename(fpath)
+            cell_approximations.append(BaseDataSetEntry(identifier, labels))
+            abstract_structures[identifier] = BaseDataSetEntry(
+                identifier, abstract_structure(labels, mum_per_px)
+            )
+
+    if intermediates_dir is not None:
+        write_frame_store(
+            cell_approximations,
+            os.path.join(intermediates_dir, "cell_approximation"),
+        )
+        BaseDataSet(dataset_entries=abstract_structures).to_pickle(
+            os.path.join(intermediates_dir, "abstract_structure.pickle")
+        )
+
+    return bytes_written
+
+
+def generate_microscopy_inputs(
+    outdir: str,
+    providers: list[str] = PROVIDERS,
+    num_datasets: int = 1,
+    num_frames: int = 20,
+    height: int = 1024,
+    width: int = 1024,
+    mum_per_px: float = 0.65,
+    cells_per_mm_squared: float = 2000.0,
+    with_intermediates: bool = False,
+    seed: int = 0,
+) -> list[dict]:
+    """
+    Write synthetic time-lapse datasets in the layout of the pipeline input,
+    '<outdir>/<provider>/config.toml' next to one directory per dataset, and
+    return a description of every dataset.
+    """
+
+    rng = np.random.default_rng(seed)
+    datasets = []
+
+    for provider in providers:
+        provider_dir = os.path.join(outdir, provider)
+        os.makedirs(provider_dir, exist_ok=True)
+
+        dataset_config = {
+            "experimental-parameters": {"provider": provider, "mum_per_px": mum_per_px}
+        }
+        config_file = os.path.join(provider_dir, "config.toml")
+        with open(config_file, "w") as f:
+            toml.dump(dataset_config, f)
+
+        for dataset_index in range(num_datasets):
+            # the cell line is inferred from the dataset name for 'eliane'
+            basename = f"synthetic_HeLa_{dataset_index:03d}"
+            intermediates_dir = (
+                os.path.join(outdir, "intermediates", provider, basename)
+                if with_intermediates
+                else None
+            )
+
+            bytes_written = generate_dataset(
+                os.path.join(provider_dir, basename),
+                provider,
+                rng,
+                num_frames,
+                height,
+                width,
+                mum_per_px,
+                cells_per_mm_squared,
+                intermediates_dir,
+            )
+
+            datasets.append(
+                {
+                    "provider": provider,
+                    "basename": basename,
+                    "dataset_dir": os.path.join(provider_dir, basename),
+                    "dataset_config": config_file,
+                    "intermediates_dir": intermediates_dir,
+                    "num_frames": num_frames,
+                    "height": height,
+                    "width": width,
+                    "mum_per_px": mum_per_px,
+                    "bytes": bytes_written,
+                }
+            )
+
+    return datasets
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument("--outdir", type=str, required=True)
+    parser.add_argument(
+        "--providers",
+        type=str,
+        default=",".join(PROVIDERS),
+        help="Comma separated list of directory layouts to write.",
+    )
+    parser.add_argument(
+        "--num_datasets", type=int, default=1, help="Datasets per provider."
+    )
+    parser.add_argument("--num_frames", type=int, default=20)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--mum_per_px", type=float, default=0.65)
+    parser.add_argument("--cells_per_mm_squared", type=float, default=2000.0)
+    parser.add_argument(
+        "--with_intermediates",
+        action="store_true",
+        help="Also write the inputs of 'annotate_cell_density.py'.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_microscopy_inputs(
+        args.outdir,
+        providers=args.providers.split(","),
+        num_datasets=args.num_datasets,
+        num_frames=args.num_frames,
+        height=args.height,
+        width=args.width,
+        mum_per_px=args.mum_per_px,
+        cells_per_mm_squared=args.cells_per_mm_squared,
+        with_intermediates=args.with_intermediates,
+        seed=args.seed,
+    )
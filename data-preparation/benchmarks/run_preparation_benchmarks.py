@@ -0,0 +1,158 @@
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+from analysis_utils.profiling import measure_subprocess
+from generate_microscopy_inputs import PROVIDERS, generate_microscopy_inputs
+
+# Usage (from 'data-preparation', with its conda environment, which installs
+# 'analysis_utils'):
+#   PYTHONPATH=scripts python benchmarks/run_preparation_benchmarks.py \
+#       --num_frames=100 --height=2048 --width=2048 --cpus=8 \
+#       --outfile=benchmark-results/<commit>.json
+
+SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"
+)
+
+OUTPUT_FORMATS = ["pickle", "frame_store"]
+
+
+def run_script(script: str, arguments: list[str]) -> dict:
+    # every script runs in its own process, so that its peak RSS can be
+    # measured with 'wait4'
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, script), *arguments]
+
+    return {"script": script, **measure_subprocess(command)}
+
+
+def benchmark_dataset(dataset: dict, outdir: str, cpus: int) -> list[dict]:
+    results = []
+
+    for output_format in OUTPUT_FORMATS:
+        outfile = os.path.join(
+            outdir, f"{dataset['provider']}_{dataset['basename']}_{output_format}"
+        )
+        result = run_script(
+            "prepare_dataset.py",
+            [
+                f"--indir={dataset['dataset_dir']}",
+                f"--dataset_config={dataset['dataset_config']}",
+                f"--outfile={outfile}",
+                f"--cpus={cpus}",
+                f"--output_format={output_format}",
+            ],
+        )
+        result["output_format"] = output_format
+        results.append(result)
+
+    if dataset["intermediates_dir"] is not None:
+        result = run_script(
+            "annotate_cell_density.py",
+            [
+                f"--ast_infile={os.path.join(dataset['intermediates_dir'], 'abstract_structure.pickle')}",
+                f"--cell_approximation_infile={os.path.join(dataset['intermediates_dir'], 'cell_approximation')}",
+                f"--outfile={os.path.join(outdir, dataset['basename'] + '_density.pickle')}",
+                f"--mum_per_px={dataset['mum_per_px']}",
+                f"--cpus={cpus}",
+            ],
+        )
+        results.append(result)
+
+    for result in results:
+        result.update(
+            provider=dataset["provider"],
+            basename=dataset["basename"],
+            frames_per_s=dataset["num_frames"] / result["wall_time_s"],
+        )
+
+    return results
+
+
+def run_preparation_benchmarks(
+    outfile: str, datasets: list[dict], cpus: int = 1, repeats: int = 1
+):
+    results = []
+    with tempfile.TemporaryDirectory() as outdir:
+        for dataset in datasets:
+            for repeat in range(repeats):
+                for result in benchmark_dataset(dataset, outdir, cpus):
+                    result["repeat"] = repeat
+                    print(
+                        f"{result['provider']}/{result['basename']} "
+                        f"{result['script']} {result.get('output_format', '')} "
+                        f"[{repeat + 1}/{repeats}]: "
+                        f"{result['frames_per_s']:.1f} frames/s, "
+                        f"{result['peak_rss_mib']:.0f} MiB"
+                        + (
+                            f" (exit code {result['returncode']})"
+                            if result["returncode"]
+                            else ""
+                        )
+                    )
+                    results.append(result)
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {
+            "hostname": platform.node(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "cpus": cpus,
+        "datasets": datasets,
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    with open(outfile, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument("--outfile", type=str, required=True)
+    parser.add_argument(
+        "--providers",
+        type=str,
+        default=",".join(PROVIDERS),
+        help="Comma separated list of directory layouts to benchmark.",
+    )
+    parser.add_argument("--num_frames", type=int, default=20)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--mum_per_px", type=float, default=0.65)
+    parser.add_argument("--cells_per_mm_squared", type=float, default=2000.0)
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=1,
+        help="CPU cores passed to the preparation scripts.",
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default=None,
+        help="Where to write the synthetic inputs, a temporary directory otherwise.",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as indir:
+        datasets = generate_microscopy_inputs(
+            indir,
+            providers=args.providers.split(","),
+            num_frames=args.num_frames,
+            height=args.height,
+            width=args.width,
+            mum_per_px=args.mum_per_px,
+            cells_per_mm_squared=args.cells_per_mm_squared,
+            with_intermediates=True,
+        )
+
+        run_preparation_benchmarks(args.outfile, datasets, args.cpus, args.repeats)
@@ -13,6 +13,70 @@ include { assemble_cell_track_dataframe          } from './cellular-dynamics-nf-
 include { calculate_local_density                } from './cellular-dynamics-nf-modules/modules/graph_processing/calculate_local_density/main.nf'
 include { concatenate_tracking_dataframes        } from './cellular-dynamics-nf-modules/modules/tracking/concatenate_tracking_dataframes/main.nf'
 include { cage_relative_squared_displacement     } from './cellular-dynamics-nf-modules/modules/tracking/cage_relative_squared_displacement/main.nf'
+
+def code_fingerprint(code_dir) {
+    // contents of the preparation scripts, the included modules, the shared
+    // 'analysis_utils' package and the conda environment, which change the
+    // per-dataset results as well
+    def sources = []
+    ["scripts", "cellular-dynamics-nf-modules/modules", "../data-analysis/analysis_utils"].each { dir ->
+        def source_dir = code_dir.resolve(dir)
+        if (!source_dir.exists()) {
+            return
+        }
+        source_dir.eachFileRecurse(groovy.io.FileType.FILES) { f ->
+            if (!f.toString().contains("__pycache__")) {
+                sources << "${code_dir.relativize(f)}:${f.text.md5()}"
+            }
+        }
+    }
+    sources << "environment.yml:${code_dir.resolve("environment.yml").text.md5()}"
+
+    return sources.sort().join("\n").md5()
+}
+
+def dataset_fingerprint(dataset_path, dataset_config, code_hash) {
+    // input images (relative path, size, modification time), dataset config,
+    // code and all parameters that change the per-dataset results
+    def listing = []
+    dataset_path.eachFileRecurse(groovy.io.FileType.FILES) { f ->
+        listing << "${dataset_path.relativize(f)}:${f.size()}:${f.lastModified()}"
+    }
+
+    def parts = [
+        listing.sort().join("\n"),
+        dataset_config.text,
+        code_hash,
+        params.min_nucleus_area_mumsq,
+        params.cell_cutoff_mum,
+        params.lag_times_minutes,
+        params.minimum_neighbors,
+        params.include_attrs,
+        params.exclude_attrs,
+    ]
+
+    return parts.join("\n").md5()
+}
+
+def read_prepared_record(publish_dir, basename) {
+    // written by 'record_prepared_dataset'
+    def record_file = file("${publish_dir}/${basename}/prepared/prepared_dataset.json")
+    if (!record_file.exists()) {
+        return null
+    }
+
+    def record = new groovy.json.JsonSlurper().parse(record_file.toFile())
+    def names = ["graph_dataset", "graph_store", "cell_tracks_dataframe", "dataset_config"]
+
+    // incomplete records (e.g. without a graph store) are treated like missing ones
+    if (names.any { record[it] == null }) {
+        return null
+    }
+    def outputs = names.collect { record_file.parent.resolve(record[it]) }
+
+    return outputs.every { it.exists() } ? record + [outputs: outputs] : null
+}
+
 workflow data_preparation {
     take:
     input_datasets
@@ -21,11 +85,37 @@ workflow data_preparation {
 
     publish_dir = params.parent_outdir_preparation + params.out_dir
 
-    // clear the parent_outdir
-    new File(publish_dir).deleteDir()
+    // published results are reused for unchanged datasets unless everything
+    // is explicitly reprocessed
+    if (params.reprocess_all_datasets) {
+        new File(publish_dir).deleteDir()
+    }
     new File(publish_dir).mkdirs()
 
-    prepare_dataset_from_raw(input_datasets, publish_dir)
+    code_hash = code_fingerprint(moduleDir)
+
+    fingerprinted_datasets = input_datasets
+        .map { basename, dataset_path, dataset_config ->
+            tuple(basename, dataset_path, dataset_config, dataset_fingerprint(dataset_path, dataset_config, code_hash))
+        }
+        .branch { basename, _dataset_path, _dataset_config, fingerprint ->
+            unchanged: read_prepared_record(publish_dir, basename)?.fingerprint == fingerprint
+            changed: true
+        }
+
+    // (basename, graph dataset, graph store, cell tracks dataframe, dataset config) of previous runs
+    unchanged_datasets = fingerprinted_datasets.unchanged.map { basename, _dataset_path, _dataset_config, _fingerprint ->
+        tuple(basename, *read_prepared_record(publish_dir, basename).outputs)
+    }
+
+    changed_datasets = fingerprinted_datasets.changed.map { basename, dataset_path, dataset_config, _fingerprint ->
+        tuple(basename, dataset_path, dataset_config)
+    }
+    changed_fingerprints = fingerprinted_datasets.changed.map { basename, _dataset_path, _dataset_config, fingerprint ->
+        tuple(basename, fingerprint)
+    }
+
+    prepare_dataset_from_raw(changed_datasets, publish_dir)
     nuclei_segmentation(prepare_dataset_from_raw.out.results, params.min_nucleus_area_mumsq, publish_dir)
     confluency_filter(nuclei_segmentation.out.results, "nuclei", publish_dir)
 
@@ -63,17 +153,55 @@ workflow data_preparation {
     annotate_D2min(build_graphs.out.results, params.lag_times_minutes, params.minimum_neighbors, publish_dir)
     cage_relative_squared_displacement(annotate_D2min.out.results, params.lag_times_minutes, publish_dir)
 
-    // graph dataset
-    all_graph_datasets = calculate_local_density(cage_relative_squared_displacement.out.results, publish_dir).collect()
+    calculate_local_density(cage_relative_squared_displacement.out.results, publish_dir)
+
+    // the pickled graph dataset is unpickled once here, the neighbour
+    // statistics read the graph store one frame at a time
+    convert_graph_dataset(calculate_local_density.out.results, publish_dir)
 
-    // dataframe
     assemble_cell_track_dataframe(calculate_local_density.out.results, params.include_attrs, params.exclude_attrs, publish_dir)
-    all_dataframes_list = add_cell_culture_metadata(assemble_cell_track_dataframe.out.results, publish_dir).collect { _first, second, _third -> second }
+    add_cell_culture_metadata(assemble_cell_track_dataframe.out.results, publish_dir)
+
+    record_prepared_dataset_input = calculate_local_density.out.results
+        .join(convert_graph_dataset.out.results, by: [0], failOnDuplicate: true, failOnMismatch: true)
+        .join(add_cell_culture_metadata.out.results, by: [0], failOnDuplicate: true, failOnMismatch: true)
+        .join(changed_fingerprints, by: [0], failOnDuplicate: true)
+        .map { basename, graph_dataset, _graph_config, graph_store, cell_tracks_dataframe, dataset_config, fingerprint ->
+            tuple(basename, graph_dataset, graph_store, cell_tracks_dataframe, dataset_config, fingerprint)
+        }
+    record_prepared_dataset(record_prepared_dataset_input, publish_dir)
+
+    // newly processed and unchanged datasets together
+    prepared_datasets = record_prepared_dataset.out.results.mix(unchanged_datasets)
+
+    // graph store
+    all_graph_datasets = prepared_datasets.map { basename, _graph_dataset, graph_store, _cell_tracks_dataframe, dataset_config -> tuple(basename, graph_store, dataset_config) }.collect()
+
+    // dataframe
+    all_dataframes_list = prepared_datasets.collect { _basename, _graph_dataset, _graph_store, cell_tracks_dataframe, _dataset_config -> cell_tracks_dataframe }
     concatenate_tracking_dataframes(all_dataframes_list, publish_dir)
 
+    if (params.compact_schema) {
+        compact_tracking_dataframe(concatenate_tracking_dataframes.out.results, params.compact_float_tolerance, publish_dir)
+        all_cell_tracks = compact_tracking_dataframe.out.results
+        compact_profiles = compact_tracking_dataframe.out.profile
+    }
+    else {
+        all_cell_tracks = concatenate_tracking_dataframes.out.results
+        compact_profiles = Channel.empty()
+    }
+
+    partition_tracking_dataframe(all_cell_tracks, publish_dir)
+
+    // per-stage timings of the preparation scripts of this repository, which
+    // are ranked together with those of the analysis scripts
+    preparation_profiles = prepare_dataset_from_raw.out.profile
+        .mix(add_cell_culture_metadata.out.profile, compact_profiles, partition_tracking_dataframe.out.profile)
+
     emit:
-    all_cell_tracks_dataframe = concatenate_tracking_dataframes.out.results
-    all_graph_datasets        = all_graph_datasets // this is a list of tuples of the form [basename, file, config]
+    all_cell_tracks_dataframe = partition_tracking_dataframe.out.results // partitioned dataset directory with manifest.json
+    all_graph_datasets        = all_graph_datasets // this is a list of tuples of the form [basename, graph store directory, config]
+    preparation_profiles      = preparation_profiles // '<script>.profile.json' of every preparation task
 }
 
 process prepare_dataset_from_raw {
@@ -89,7 +217,12 @@ process prepare_dataset_from_raw {
     val publish_directory
 
     output:
-    tuple val(basename), path("original_dataset.pickle"), path(dataset_config), emit: results
+    // the dataset config is re-emitted with the pixel size of the decoded images.
+    // The dataset stays a pickle ('--output_format=frame_store' is not used):
+    // the image processing modules of 'cellular-dynamics-nf-modules' read it
+    // with 'BaseDataSet.from_pickle'
+    tuple val(basename), path("original_dataset.pickle"), path("dataset_config.toml"), emit: results
+    path "prepare_dataset.profile.json", emit: profile
 
     script:
     """
@@ -99,6 +232,8 @@ process prepare_dataset_from_raw {
         --indir="${dataset_path}" \
         --outfile="original_dataset.pickle" \
         --dataset_config="${dataset_config}" \
+        --config_outfile="dataset_config.toml" \
+        --profile_outfile="prepare_dataset.profile.json" \
         --cpus=${task.cpus}
     """
 }
@@ -117,6 +252,7 @@ process add_cell_culture_metadata {
 
     output:
     tuple val(basename), path("cell_tracks_with_metadata.ipc"), path(dataset_config), emit: results
+    path "add_dataset_metadata.profile.json", emit: profile
 
     script:
     """
@@ -125,6 +261,121 @@ process add_cell_culture_metadata {
         --outfile="cell_tracks_with_metadata.ipc" \
         --basename=${basename} \
         --dataset_config=${dataset_config} \
+        --profile_outfile="add_dataset_metadata.profile.json" \
+        --cpus=${task.cpus}
+    """
+}
+
+process convert_graph_dataset {
+
+    publishDir "${parent_dir_out}/${basename}", mode: 'copy'
+
+    label "single_threaded", "short_running"
+
+    // unpickling the graphs needs networkx, which is part of the analysis
+    // environment
+    conda "${moduleDir}/../data-analysis/environment.yml"
+
+    input:
+    tuple val(basename), path(graph_dataset), path(graph_config)
+    val parent_dir_out
+
+    output:
+    tuple val(basename), path("graph_store"), emit: results
+
+    script:
+    """
+    python -m analysis_utils.graphs convert \
+        --infile="${graph_dataset}" \
+        --outdir="graph_store"
+    """
+}
+
+process record_prepared_dataset {
+
+    // hard links to the final per-dataset outputs (no second copy of them) and
+    // the fingerprint they were computed for, which allows later runs to skip
+    // unchanged datasets; the graph store directory is already published by
+    // 'convert_graph_dataset' next to the 'prepared' directory
+    publishDir "${parent_dir_out}/${basename}/prepared", mode: 'link', saveAs: { it == "graph_store" ? null : it }
+
+    label "single_threaded", "short_running"
+
+    input:
+    tuple val(basename), path(graph_dataset), path(graph_store), path(cell_tracks_dataframe), path(dataset_config), val(fingerprint)
+    val parent_dir_out
+
+    output:
+    tuple val(basename), path(graph_dataset, includeInputs: true), path(graph_store, includeInputs: true), path(cell_tracks_dataframe, includeInputs: true), path(dataset_config, includeInputs: true), emit: results
+    path "prepared_dataset.json", emit: record
+
+    script:
+    def record = groovy.json.JsonOutput.toJson(
+        [
+            fingerprint: fingerprint,
+            graph_dataset: graph_dataset.name,
+            graph_store: "../${graph_store.name}",
+            cell_tracks_dataframe: cell_tracks_dataframe.name,
+            dataset_config: dataset_config.name,
+        ]
+    )
+    """
+    echo '${record}' > prepared_dataset.json
+    """
+}
+
+process compact_tracking_dataframe {
+
+    publishDir "${parent_dir_out}", mode: 'copy'
+
+    label "low_cpu", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    path all_cell_tracks_dataframe
+    val float_tolerance
+    val parent_dir_out
+
+    output:
+    path "cell_tracks_compact.ipc", emit: results
+    path "cell_tracks_compact_schema.json", emit: schema
+    path "compact_tracking_dataframe.profile.json", emit: profile
+
+    script:
+    """
+    python ${moduleDir}/scripts/compact_tracking_dataframe.py \
+        --infile="${all_cell_tracks_dataframe}" \
+        --outfile="cell_tracks_compact.ipc" \
+        --schema_outfile="cell_tracks_compact_schema.json" \
+        --float_tolerance=${float_tolerance} \
+        --profile_outfile="compact_tracking_dataframe.profile.json" \
+        --cpus=${task.cpus}
+    """
+}
+
+process partition_tracking_dataframe {
+
+    publishDir "${parent_dir_out}", mode: 'copy'
+
+    label "low_cpu", "short_running"
+
+    conda "${moduleDir}/environment.yml"
+
+    input:
+    path all_cell_tracks_dataframe
+    val parent_dir_out
+
+    output:
+    path "cell_tracks_dataset", emit: results
+    path "partition_tracking_dataframe.profile.json", emit: profile
+
+    script:
+    """
+    python ${moduleDir}/scripts/partition_tracking_dataframe.py \
+        --infile="${all_cell_tracks_dataframe}" \
+        --outdir="cell_tracks_dataset" \
+        --profile_outfile="partition_tracking_dataframe.profile.json" \
         --cpus=${task.cpus}
     """
 }
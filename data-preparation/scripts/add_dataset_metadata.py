@@ -2,6 +2,14 @@ from argparse import ArgumentParser
 
 import polars as pl
 import toml
+from analysis_utils.loading import CELL_CULTURE_METHODOLOGIES, CELL_LINE_NAMES
+from analysis_utils.profiling import profile_task, stage
+
+# fixed global dictionaries, so that the metadata columns of all datasets share
+# the same encoding and stay dictionary-encoded when they are concatenated
+CELL_LINE_DTYPE = pl.Enum(CELL_LINE_NAMES)
+CELL_CULTURE_METHODOLOGY_DTYPE = pl.Enum(CELL_CULTURE_METHODOLOGIES)
+DATASET_PROVIDERS = pl.Enum(["eliane", "juergen"])
 
 
 def get_dataset_metadata(dataset_name: str, provider_name: str) -> tuple[str, str]:
@@ -61,13 +69,21 @@ if __name__ == "__main__":
         type=int,
         help="CPU cores to use.",
     )
+    parser.add_argument(
+        "--profile_outfile",
+        type=str,
+        default=None,
+        help="Where to write the per-stage timings and peak memory (JSON).",
+    )
 
     args = parser.parse_args()
 
     dataset_config = toml.load(args.dataset_config)
-    cell_tracking_df = pl.read_ipc(args.infile, memory_map=False)
+    cell_tracking_lf = pl.scan_ipc(args.infile)
 
-    if len(cell_tracking_df) > 0:
+    # the row count is read from the file metadata
+    num_rows = cell_tracking_lf.select(pl.len()).collect().item()
+    if num_rows > 0:
 
         provider = dataset_config["experimental-parameters"]["provider"]
 
@@ -75,15 +91,17 @@ if __name__ == "__main__":
             args.basename, provider_name=provider
         )
 
-        # create 'cell_line_name' and 'cell_culture_methodology' columns in df
-        cell_tracking_df = cell_tracking_df.with_columns(
-            pl.lit(cell_line_name).alias("cell_line_name")
-        )
-        cell_tracking_df = cell_tracking_df.with_columns(
-            pl.lit(cell_culture_methodology).alias("cell_culture_methodology")
-        )
-        cell_tracking_df = cell_tracking_df.with_columns(
-            pl.lit(provider.lower()).alias("dataset_provider")
+        # create the metadata columns in a single pass
+        cell_tracking_lf = cell_tracking_lf.with_columns(
+            pl.lit(cell_line_name, dtype=CELL_LINE_DTYPE).alias("cell_line_name"),
+            pl.lit(
+                cell_culture_methodology, dtype=CELL_CULTURE_METHODOLOGY_DTYPE
+            ).alias("cell_culture_methodology"),
+            pl.lit(provider.lower(), dtype=DATASET_PROVIDERS).alias("dataset_provider"),
+            pl.lit(args.basename).alias("dataset_basename"),
         )
 
-    cell_tracking_df.write_ipc(args.outfile, compression="lz4")
+    # stream batch by batch instead of materializing the whole dataframe
+    with profile_task("add_dataset_metadata", args.profile_outfile):
+        with stage("sink_ipc", rows=num_rows):
+            cell_tracking_lf.sink_ipc(args.outfile, compression="lz4")
@@ -4,11 +4,13 @@ from argparse import ArgumentParser
 
 import cv2
 import numpy as np
-from core_data_utils.datasets import BaseDataSet, BaseDataSetEntry
+from analysis_utils.profiling import profile_task, stage
+from core_data_utils.datasets import BaseDataSetEntry
 from core_data_utils.transformations import BaseMultiDataSetTransformation
+from frame_store import load_dataset
 
 
-class AnnotateCellDensityTransformation(BaseMultiDataSetTransformation):
+class CellOccupancyTransformation(BaseMultiDataSetTransformation):
 
     def __init__(self, mum_per_px: float):
         self._mum_per_px = mum_per_px
@@ -17,37 +19,70 @@ class AnnotateCellDensityTransformation(BaseMultiDataSetTransformation):
     def _transform_single_entry(
         self, entry: BaseDataSetEntry, dataset_properties: dict
     ) -> BaseDataSetEntry:
-        ast: dict = entry.data["abstract_structure"]
         cellapprox: np.array = entry.data["cell_approximation"]
 
-        occupied_area_fraction = (cellapprox > 0).mean()
+        # the occupancy mask is computed once and shared by both measures
+        occupied = np.ascontiguousarray(cellapprox > 0)
+
+        occupied_area_fraction = np.count_nonzero(occupied) / occupied.size
 
-        num_labels, _, _, _ = cv2.connectedComponentsWithStats(
-            (cellapprox > 0).astype(np.uint8), connectivity=8
+        # only the number of labels is needed, not the component statistics
+        num_labels, _ = cv2.connectedComponents(
+            occupied.view(np.uint8), connectivity=8, ltype=cv2.CV_32S
         )
         cell_density_per_mum_squared = (num_labels - 1) / (
-            cellapprox.shape[0] * cellapprox.shape[1] * self._mum_per_px**2
+            occupied.shape[0] * occupied.shape[1] * self._mum_per_px**2
         )
 
+        return BaseDataSetEntry(
+            identifier=entry.identifier,
+            data={
+                "occupied_area_fraction": occupied_area_fraction,
+                "cell_density_per_mum_squared": cell_density_per_mum_squared,
+            },
+        )
+
+    def __call__(self, cell_approximation, cpus: int = 1):
+        return super()._transform(cpus=cpus, cell_approximation=cell_approximation)
+
+
+class AnnotateCellDensityTransformation(BaseMultiDataSetTransformation):
+
+    def _transform_single_entry(
+        self, entry: BaseDataSetEntry, dataset_properties: dict
+    ) -> BaseDataSetEntry:
+        ast: dict = entry.data["abstract_structure"]
+        occupancy: dict = entry.data["cell_occupancy"]
+
         for _, props in ast.items():
-            props["occupied_area_fraction"] = occupied_area_fraction
-            props["cell_density_per_mum_squared"] = cell_density_per_mum_squared
+            props["occupied_area_fraction"] = occupancy["occupied_area_fraction"]
+            props["cell_density_per_mum_squared"] = occupancy[
+                "cell_density_per_mum_squared"
+            ]
 
         return BaseDataSetEntry(identifier=entry.identifier, data=ast)
 
-    def __call__(self, abstract_structure, cell_approximation, cpus: int = 1):
+    def __call__(self, abstract_structure, cell_occupancy, cpus: int = 1):
         return super()._transform(
             cpus=cpus,
             abstract_structure=abstract_structure,
-            cell_approximation=cell_approximation,
+            cell_occupancy=cell_occupancy,
         )
 
 
 if __name__ == "__main__":
 
+    # parallelism comes from the worker processes, not from OpenCV's threads
+    cv2.setNumThreads(0)
+
     parser = ArgumentParser()
     parser.add_argument("--ast_infile", type=str, required=True)
-    parser.add_argument("--cell_approximation_infile", type=str, required=True)
+    parser.add_argument(
+        "--cell_approximation_infile",
+        type=str,
+        required=True,
+        help="Pickled dataset or frame store directory.",
+    )
     parser.add_argument("--outfile", type=str, required=True)
     parser.add_argument("--mum_per_px", type=float, required=True)
     parser.add_argument(
@@ -56,16 +91,34 @@ if __name__ == "__main__":
         type=int,
         help="CPU cores to use.",
     )
+    parser.add_argument(
+        "--profile_outfile",
+        type=str,
+        default=None,
+        help="Where to write the per-stage timings and peak memory (JSON).",
+    )
 
     args = parser.parse_args()
 
-    cell_approx_ds = BaseDataSet.from_pickle(args.cell_approximation_infile)
-    abstract_structure_ds = BaseDataSet.from_pickle(args.ast_infile)
-
-    x = AnnotateCellDensityTransformation(args.mum_per_px)(
-        cpus=1,
-        abstract_structure=abstract_structure_ds,
-        cell_approximation=cell_approx_ds,
-    )
-
-    x.to_pickle(args.outfile)
+    # reduce the cell approximation images to a few numbers per frame before
+    # the abstract structures are loaded, so both datasets are never held in
+    # memory at the same time
+    with profile_task("annotate_cell_density", args.profile_outfile):
+        with stage("cell_occupancy"):
+            cell_occupancy_ds = CellOccupancyTransformation(args.mum_per_px)(
+                cpus=args.cpus,
+                cell_approximation=load_dataset(args.cell_approximation_infile),
+            )
+
+        with stage("load_abstract_structure"):
+            abstract_structure_ds = load_dataset(args.ast_infile)
+
+        with stage("annotate_cell_density"):
+            x = AnnotateCellDensityTransformation()(
+                cpus=args.cpus,
+                abstract_structure=abstract_structure_ds,
+                cell_occupancy=cell_occupancy_ds,
+            )
+
+        with stage("to_pickle"):
+            x.to_pickle(args.outfile)
@@ -0,0 +1,190 @@
+import json
+import math
+from argparse import ArgumentParser
+
+import numpy as np
+import polars as pl
+from analysis_utils.profiling import profile_task, stage
+
+# integer types from the smallest to the largest, with their value ranges
+INTEGER_DTYPES = {
+    pl.UInt8: np.iinfo(np.uint8),
+    pl.Int8: np.iinfo(np.int8),
+    pl.UInt16: np.iinfo(np.uint16),
+    pl.Int16: np.iinfo(np.int16),
+    pl.UInt32: np.iinfo(np.uint32),
+    pl.Int32: np.iinfo(np.int32),
+    pl.UInt64: np.iinfo(np.uint64),
+    pl.Int64: np.iinfo(np.int64),
+}
+
+
+def smallest_integer_dtype(min_value, max_value):
+    # 'None' for columns that only contain nulls
+    if min_value is None or max_value is None:
+        return None
+
+    for dtype, info in INTEGER_DTYPES.items():
+        if info.min <= min_value and max_value <= info.max:
+            return dtype
+
+    return None
+
+
+def float32_range_error(column: str) -> pl.Expr:
+    # maximum absolute rounding error of the finite values relative to their
+    # range (or to their magnitude for constant columns); values outside of the
+    # Float32 range become infinite and yield an infinite error
+    x = pl.col(column).filter(pl.col(column).is_finite())
+    rounded = pl.col(column).cast(pl.Float32).cast(pl.Float64)
+    error = (pl.col(column) - rounded).abs().filter(pl.col(column).is_finite())
+
+    value_range = x.max() - x.min()
+    scale = pl.when(value_range > 0).then(value_range).otherwise(x.abs().max())
+
+    return (
+        pl.when(scale > 0)
+        .then(error.max() / scale)
+        .otherwise(0.0)
+        .alias(f"{column}__range_error")
+    )
+
+
+def compact_schema(lf: pl.LazyFrame, float_tolerance: float) -> dict[str, dict]:
+    """
+    Determine a compact data type for every column of 'lf' with a single pass
+    over the data: Float64 columns become Float32 if the maximum rounding error
+    relative to the range of the column stays below 'float_tolerance', integer
+    columns get the smallest type that holds all their values and string
+    columns become categorical.
+
+    Float32 keeps about 7 significant digits of every value, so the error
+    relative to the value itself is always ~6e-8. Relative to the range, the
+    error grows with the offset of the values from zero: columns with a large
+    offset and a small spread (e.g. absolute timestamps or stage positions)
+    lose their variation and stay Float64.
+    """
+
+    schema = lf.collect_schema()
+
+    float_columns = [c for c, dtype in schema.items() if dtype == pl.Float64]
+    integer_columns = [c for c, dtype in schema.items() if dtype.is_integer()]
+
+    statistics = lf.select(
+        *[float32_range_error(c) for c in float_columns],
+        *[pl.col(c).min().alias(f"{c}__min") for c in integer_columns],
+        *[pl.col(c).max().alias(f"{c}__max") for c in integer_columns],
+    ).collect()
+
+    statistics = statistics.row(0, named=True) if statistics.width > 0 else {}
+
+    columns = {}
+    for c, dtype in schema.items():
+        column = {"original_dtype": str(dtype), "dtype": str(dtype)}
+
+        if c in float_columns:
+            range_error = statistics[f"{c}__range_error"] or 0.0
+            if range_error <= float_tolerance:
+                column["dtype"] = str(pl.Float32)
+            # 'None' if the values exceed the Float32 range
+            column["max_range_error"] = (
+                range_error if math.isfinite(range_error) else None
+            )
+
+        elif c in integer_columns:
+            compact_dtype = smallest_integer_dtype(
+                statistics[f"{c}__min"], statistics[f"{c}__max"]
+            )
+            if compact_dtype is not None:
+                column["dtype"] = str(compact_dtype)
+
+        elif dtype == pl.String:
+            column["dtype"] = str(pl.Categorical)
+
+        columns[c] = column
+
+    return columns
+
+
+def compact_tracking_dataframe(
+    infile: str, outfile: str, schema_outfile: str, float_tolerance: float
+):
+    lf = pl.scan_ipc(infile)
+    with stage("compact_schema"):
+        columns = compact_schema(lf, float_tolerance)
+
+    casts = {
+        "Float32": pl.Float32,
+        "Categorical": pl.Categorical,
+        **{str(dtype): dtype for dtype in INTEGER_DTYPES},
+    }
+
+    with stage("sink_ipc"):
+        lf.with_columns(
+            pl.col(c).cast(casts[column["dtype"]])
+            for c, column in columns.items()
+            if column["dtype"] != column["original_dtype"]
+        ).sink_ipc(outfile, compression="lz4")
+
+    for c, column in columns.items():
+        if "max_range_error" in column:
+            print(
+                f"{c}: {column['original_dtype']} -> {column['dtype']} "
+                f"(max. error relative to the range {column['max_range_error']})"
+            )
+
+    with open(schema_outfile, "w") as f:
+        json.dump({"float_tolerance": float_tolerance, "columns": columns}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        "--infile",
+        required=True,
+        type=str,
+        help="Path to the concatenated tracking dataframe.",
+    )
+    parser.add_argument(
+        "--outfile",
+        required=True,
+        type=str,
+        help="Path to write the compacted tracking dataframe to.",
+    )
+    parser.add_argument(
+        "--schema_outfile",
+        required=True,
+        type=str,
+        help="Path to write the applied schema (JSON sidecar) to.",
+    )
+    parser.add_argument(
+        "--float_tolerance",
+        type=float,
+        default=1e-6,
+        help=(
+            "Maximum rounding error, relative to the range of the column, for "
+            "downcasting a column to Float32. The default of 1e-6 keeps columns "
+            "whose values lie more than ~16 times their range away from zero "
+            "as Float64."
+        ),
+    )
+    parser.add_argument(
+        "--cpus",
+        required=True,
+        type=int,
+        help="CPU cores to use.",
+    )
+    parser.add_argument(
+        "--profile_outfile",
+        type=str,
+        default=None,
+        help="Where to write the per-stage timings and peak memory (JSON).",
+    )
+
+    args = parser.parse_args()
+
+    with profile_task("compact_tracking_dataframe", args.profile_outfile):
+        compact_tracking_dataframe(
+            args.infile, args.outfile, args.schema_outfile, args.float_tolerance
+        )
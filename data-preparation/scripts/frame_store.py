@@ -0,0 +1,123 @@
+import json
+import os
+import pickle
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+
+import numpy as np
+from core_data_utils.datasets import BaseDataSet, BaseDataSetEntry
+
+# A frame store is a directory with one uncompressed '.npy' file per frame,
+# a JSON index (identifier, file, shape, dtype) in frame order and the entry
+# metadata in a small pickle. Frames are memory mapped when they are accessed,
+# so opening a store only reads the index.
+INDEX_FILENAME = "index.json"
+METADATA_FILENAME = "metadata.pickle"
+FRAMES_DIRNAME = "frames"
+FORMAT_VERSION = 1
+
+
+def is_frame_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+def write_frame_store(entries: Iterable[BaseDataSetEntry], outdir: str) -> int:
+    """
+    Write dataset entries with array data to a frame store, one frame at a
+    time, and return the number of frames written.
+    """
+
+    os.makedirs(os.path.join(outdir, FRAMES_DIRNAME), exist_ok=True)
+
+    index, metadata = [], {}
+
+    for frame_index, entry in enumerate(entries):
+        if not isinstance(entry.data, np.ndarray):
+            raise TypeError(
+                f"Entry '{entry.identifier}' does not hold an array, but "
+                f"'{type(entry.data).__name__}'"
+            )
+
+        # identifiers may contain characters that are not valid in file names
+        filename = os.path.join(FRAMES_DIRNAME, f"{frame_index:06d}.npy")
+        np.save(os.path.join(outdir, filename), entry.data, allow_pickle=False)
+
+        index.append(
+            {
+                "identifier": entry.identifier,
+                "file": filename,
+                "shape": list(entry.data.shape),
+                "dtype": entry.data.dtype.str,
+            }
+        )
+        metadata[entry.identifier] = entry.metadata
+
+    with open(os.path.join(outdir, METADATA_FILENAME), "wb") as f:
+        pickle.dump(metadata, f)
+
+    # the index is written last, an interrupted write is not a valid store
+    with open(os.path.join(outdir, INDEX_FILENAME), "w") as f:
+        json.dump({"format_version": FORMAT_VERSION, "entries": index}, f)
+
+    return len(index)
+
+
+class FrameStore(Mapping):
+    # identifier -> entry, a frame is only opened when its entry is accessed
+    # and closed again once the entry is no longer referenced
+
+    def __init__(self, path: str):
+        self._path = path
+
+        with open(os.path.join(path, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+
+        if index["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported frame store version {index['format_version']} "
+                f"in '{path}'"
+            )
+
+        self._entries = {e["identifier"]: e for e in index["entries"]}
+
+        with open(os.path.join(path, METADATA_FILENAME), "rb") as f:
+            self._metadata = pickle.load(f)
+
+    @property
+    def identifiers(self) -> list:
+        return list(self._entries.keys())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator:
+        return iter(self._entries)
+
+    def frame(self, identifier) -> np.memmap:
+        # read-only memory map, pages are only loaded when they are accessed
+        return np.load(
+            os.path.join(self._path, self._entries[identifier]["file"]),
+            mmap_mode="r",
+            allow_pickle=False,
+        )
+
+    def __getitem__(self, identifier) -> BaseDataSetEntry:
+        return BaseDataSetEntry(
+            identifier=identifier,
+            data=self.frame(identifier),
+            metadata=self._metadata.get(identifier, {}),
+        )
+
+    def to_dataset(self) -> BaseDataSet:
+        # the store itself holds the entries, so no frame is opened here and
+        # every memory map (and its file descriptor) lives only as long as
+        # its entry is used
+        return BaseDataSet(dataset_entries=self)
+
+
+def load_dataset(path: str) -> BaseDataSet:
+    # frame stores are opened lazily, everything else is a pickled dataset
+    if is_frame_store(path):
+        return FrameStore(path).to_dataset()
+
+    return BaseDataSet.from_pickle(path)
@@ -0,0 +1,245 @@
+import json
+import math
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import polars as pl
+from analysis_utils.profiling import profile_task, stage
+
+PARTITION_KEYS = [
+    "dataset_provider",
+    "cell_line_name",
+    "cell_culture_methodology",
+    "dataset_basename",
+]
+
+MANIFEST_FILENAME = "manifest.json"
+QUANTILE_SKETCHES_FILENAME = "quantile_sketches.npz"
+# an empty parquet file with the schema of all partitions
+SCHEMA_FILENAME = "schema.parquet"
+
+# percentiles are mostly needed in the tails, e.g. for axis limits and cutoffs
+SKETCH_PROBABILITIES = np.unique(
+    np.concatenate(
+        [
+            np.linspace(0, 1, 101),
+            np.linspace(0, 0.1, 101),
+            np.linspace(0.9, 1, 101),
+        ]
+    ).round(6)
+)
+
+
+def _json_value(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    return str(value)
+
+
+def column_statistics(lf: pl.LazyFrame) -> dict[str, dict]:
+    # min / max are only meaningful for numeric and string columns
+    schema = lf.collect_schema()
+    stats_columns = [
+        c
+        for c, dtype in schema.items()
+        if dtype.is_numeric() or dtype in (pl.String, pl.Boolean)
+    ]
+    float_columns = [c for c in stats_columns if schema[c].is_float()]
+
+    if len(stats_columns) == 0:
+        return {}
+
+    stats_row = (
+        lf.select(
+            *[pl.col(c).min().alias(f"{c}__min") for c in stats_columns],
+            *[pl.col(c).max().alias(f"{c}__max") for c in stats_columns],
+            *[pl.col(c).null_count().alias(f"{c}__null_count") for c in stats_columns],
+            *[pl.col(c).is_nan().sum().alias(f"{c}__nan_count") for c in float_columns],
+        )
+        .collect()
+        .row(0, named=True)
+    )
+
+    statistics = {}
+    for c in stats_columns:
+        statistics[c] = {
+            "min": _json_value(stats_row[f"{c}__min"]),
+            "max": _json_value(stats_row[f"{c}__max"]),
+            "null_count": stats_row[f"{c}__null_count"],
+        }
+        if c in float_columns:
+            statistics[c]["nan_count"] = stats_row[f"{c}__nan_count"]
+
+    return statistics
+
+
+def quantile_sketch(
+    lf: pl.LazyFrame, columns: list[str]
+) -> tuple[np.ndarray, np.ndarray]:
+    # quantiles at 'SKETCH_PROBABILITIES' and number of values per column,
+    # ignoring NaN and missing values; one column is read at a time
+    quantiles = np.full((len(columns), len(SKETCH_PROBABILITIES)), np.nan)
+    counts = np.zeros(len(columns), dtype=np.int64)
+
+    for i, c in enumerate(columns):
+        values = (
+            lf.select(pl.col(c).cast(pl.Float64))
+            .collect()
+            .to_series()
+            .drop_nulls()
+            .drop_nans()
+            .to_numpy()
+        )
+        counts[i] = len(values)
+        if len(values) > 0:
+            quantiles[i] = np.quantile(values, SKETCH_PROBABILITIES)
+
+    return quantiles, counts
+
+
+def partition_path(keys: dict[str, str]) -> str:
+    return os.path.join(
+        *[f"{k}={str(v).replace(os.sep, '_')}" for k, v in keys.items()],
+        "part-0.parquet",
+    )
+
+
+def partition_tracking_dataframe(infile: str, outdir: str, row_group_size: int):
+    # the concatenated dataframe is only scanned, every partition is streamed
+    # into its file and then read back one column at a time, so that no more
+    # than a single column of a single partition is ever held in memory
+    cell_tracking_lf = pl.scan_ipc(infile)
+    schema = cell_tracking_lf.collect_schema()
+
+    missing_keys = [k for k in PARTITION_KEYS if k not in schema]
+    if missing_keys:
+        raise RuntimeError(
+            f"Tracking dataframe is missing the partition columns {missing_keys}"
+        )
+
+    os.makedirs(outdir, exist_ok=True)
+
+    # readers build empty frames from it, e.g. if no partition matches a filter
+    pl.DataFrame(schema=schema).write_parquet(os.path.join(outdir, SCHEMA_FILENAME))
+
+    sketch_columns = [
+        c
+        for c, dtype in schema.items()
+        if dtype.is_numeric() and c not in PARTITION_KEYS
+    ]
+    sketch_quantiles, sketch_counts = [], []
+
+    with stage("partition_keys"):
+        all_keys = (
+            cell_tracking_lf.select(PARTITION_KEYS)
+            .unique(maintain_order=True)
+            .collect()
+            .iter_rows(named=True)
+        )
+
+    partitions = []
+    for keys in all_keys:
+        relative_path = partition_path(keys)
+        partition_file = os.path.join(outdir, relative_path)
+        os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+
+        with stage("write_parquet") as s:
+            cell_tracking_lf.filter(
+                *[pl.col(k).eq_missing(v) for k, v in keys.items()]
+            ).sink_parquet(
+                partition_file,
+                compression="lz4",
+                statistics=True,
+                row_group_size=row_group_size,
+            )
+            partition_lf = pl.scan_parquet(partition_file)
+            num_rows = partition_lf.select(pl.len()).collect().item()
+            s.add_rows(num_rows)
+
+        with stage("column_statistics", rows=num_rows):
+            statistics = column_statistics(partition_lf)
+
+        with stage("quantile_sketch", rows=num_rows):
+            quantiles, counts = quantile_sketch(partition_lf, sketch_columns)
+            sketch_quantiles.append(quantiles)
+            sketch_counts.append(counts)
+
+        partitions.append(
+            {
+                "path": relative_path,
+                "keys": {k: _json_value(v) for k, v in keys.items()},
+                "num_rows": num_rows,
+                "num_row_groups": math.ceil(num_rows / row_group_size),
+                "statistics": statistics,
+            }
+        )
+
+    manifest = {
+        "partition_keys": PARTITION_KEYS,
+        "columns": schema.names(),
+        "num_rows": sum(p["num_rows"] for p in partitions),
+        "schema": SCHEMA_FILENAME,
+        "partitions": partitions,
+        "quantile_sketches": QUANTILE_SKETCHES_FILENAME,
+    }
+
+    # one sketch per numeric column and partition, which are merged for any
+    # combination of partitions by 'data-analysis/analysis_utils/quantiles.py'
+    np.savez(
+        os.path.join(outdir, QUANTILE_SKETCHES_FILENAME),
+        probabilities=SKETCH_PROBABILITIES,
+        columns=np.array(sketch_columns, dtype=str),
+        partitions=np.array([p["path"] for p in partitions], dtype=str),
+        quantiles=np.array(sketch_quantiles).reshape(
+            len(partitions), len(sketch_columns), len(SKETCH_PROBABILITIES)
+        ),
+        counts=np.array(sketch_counts, dtype=np.int64).reshape(
+            len(partitions), len(sketch_columns)
+        ),
+    )
+
+    with open(os.path.join(outdir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument(
+        "--infile",
+        required=True,
+        type=str,
+        help="Path to the concatenated tracking dataframe.",
+    )
+    parser.add_argument(
+        "--outdir",
+        required=True,
+        type=str,
+        help="Directory to write the partitioned tracking dataset to.",
+    )
+    parser.add_argument(
+        "--row_group_size",
+        type=int,
+        default=250_000,
+        help="Maximum number of rows per parquet row group.",
+    )
+    parser.add_argument(
+        "--cpus",
+        required=True,
+        type=int,
+        help="CPU cores to use.",
+    )
+    parser.add_argument(
+        "--profile_outfile",
+        type=str,
+        default=None,
+        help="Where to write the per-stage timings and peak memory (JSON).",
+    )
+
+    args = parser.parse_args()
+
+    with profile_task("partition_tracking_dataframe", args.profile_outfile):
+        partition_tracking_dataframe(args.infile, args.outdir, args.row_group_size)
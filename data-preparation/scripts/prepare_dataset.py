@@ -1,33 +1,165 @@
 import os
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterator, NamedTuple, Optional, Sequence
 
 import cv2
+import numpy as np
 import toml
+from analysis_utils.profiling import profile_task, stage
 from core_data_utils.datasets import BaseDataSet, BaseDataSetEntry
 from core_data_utils.datasets.image import ImageDataset
+from frame_store import write_frame_store
+
+# channel indices of images decoded by OpenCV (BGR order)
+CHANNEL_INDICES = {"blue": 0, "green": 1, "red": 2}
+DECODE_CHANNELS = ["rgb", "gray", *CHANNEL_INDICES.keys()]
+DOWNSCALE_FACTORS = [1, 2, 4, 8]
+
+IMREAD_FLAGS = {
+    (False, 1): cv2.IMREAD_COLOR,
+    (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+    (True, 1): cv2.IMREAD_GRAYSCALE,
+    (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+class DecodeSettings(NamedTuple):
+    channel: str = "rgb"
+    downscale: int = 1
+    # (x, y, width, height) in pixels of the full resolution image
+    roi: Optional[tuple[int, int, int, int]] = None
+
+
+def decode_settings_from_config(dataset_config: dict) -> DecodeSettings:
+    decoding = dataset_config.get("image-decoding", {})
+
+    settings = DecodeSettings(
+        channel=decoding.get("channel", "rgb").lower(),
+        downscale=int(decoding.get("downscale", 1)),
+        roi=tuple(int(v) for v in decoding["roi"]) if "roi" in decoding else None,
+    )
+
+    if settings.channel not in DECODE_CHANNELS:
+        raise ValueError(
+            f"Unknown decode channel '{settings.channel}', expected one of {DECODE_CHANNELS}"
+        )
+    if settings.downscale not in DOWNSCALE_FACTORS:
+        raise ValueError(
+            f"Unsupported downscale factor {settings.downscale}, expected one of {DOWNSCALE_FACTORS}"
+        )
+    if settings.roi is not None and (
+        len(settings.roi) != 4 or min(settings.roi) < 0 or min(settings.roi[2:]) == 0
+    ):
+        raise ValueError(f"Invalid region of interest {settings.roi}")
+
+    return settings
+
+
+def adjust_dataset_config(dataset_config: dict, settings: DecodeSettings) -> dict:
+    # downstream steps read the pixel size from the dataset config, which has
+    # to describe the decoded rather than the raw images
+    adjusted = {
+        k: dict(v) if isinstance(v, dict) else v for k, v in dataset_config.items()
+    }
+    parameters = adjusted.get("experimental-parameters", {})
+
+    if "mum_per_px" in parameters:
+        parameters["mum_per_px"] = parameters["mum_per_px"] * settings.downscale
+
+    return adjusted
 
 
 def load_dir_eliane(pdir) -> BaseDataSet:
+    # decoded sequentially by core_data_utils, unlike juergen's frames: the
+    # file selection, identifiers and color conversion of 'from_directory'
+    # define this dataset and are not reimplemented here
     ds = ImageDataset.from_directory(pdir)
 
     return ds
 
 
-def load_dir_juergen(pdir) -> BaseDataSet:
+def read_images_parallel(
+    paths: Sequence[str], read_image: Callable, cpus: int = 1
+) -> Iterator:
+    # OpenCV releases the GIL while decoding, so threads decode in parallel.
+    # Images are yielded in the order of 'paths' and only a few decoded
+    # images are kept ahead of the consumer.
+    with ThreadPoolExecutor(max_workers=max(cpus, 1)) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(read_image, path))
+            if len(pending) >= 2 * max(cpus, 1):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_image_juergen(path: str, settings: DecodeSettings = DecodeSettings()):
+    grayscale = settings.channel == "gray"
+
+    # reduced resolution images are decoded directly by OpenCV
+    image = cv2.imread(path, IMREAD_FLAGS[(grayscale, settings.downscale)])
+    if image is None:
+        raise RuntimeError(f"Could not read image '{path}'")
+
+    if settings.roi is not None:
+        x, y, width, height = (v // settings.downscale for v in settings.roi)
+        image = image[y : y + height, x : x + width]
+
+    if settings.channel in CHANNEL_INDICES:
+        # copy only the selected channel instead of converting all of them
+        return np.ascontiguousarray(image[..., CHANNEL_INDICES[settings.channel]])
+
+    if grayscale:
+        return np.ascontiguousarray(image)
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-    filenames = [
-        fn for fn in os.listdir(pdir) if os.path.isfile(os.path.join(pdir, fn))
-    ]
-    data = {}
 
-    for fpath in filenames:
-        if fpath.endswith("c2.png"):
-            image = cv2.cvtColor(
-                cv2.imread(os.path.join(pdir, fpath), cv2.IMREAD_COLOR),
-                cv2.COLOR_BGR2RGB,
-            )
-            data[fpath] = BaseDataSetEntry(identifier=fpath, data=image, metadata={})
-    return BaseDataSet(dataset_entries=data)
+def iter_dir_juergen(
+    pdir,
+    cpus: int = 1,
+    settings: DecodeSettings = DecodeSettings(),
+    metadata: Optional[dict] = None,
+) -> Iterator[BaseDataSetEntry]:
+
+    filenames = sorted(
+        fn
+        for fn in os.listdir(pdir)
+        if os.path.isfile(os.path.join(pdir, fn)) and fn.endswith("c2.png")
+    )
+
+    images = read_images_parallel(
+        [os.path.join(pdir, fn) for fn in filenames],
+        partial(read_image_juergen, settings=settings),
+        cpus,
+    )
+
+    for fpath, image in zip(filenames, images):
+        yield BaseDataSetEntry(
+            identifier=fpath, data=image, metadata=dict(metadata or {})
+        )
+
+
+def load_dir_juergen(
+    pdir,
+    cpus: int = 1,
+    settings: DecodeSettings = DecodeSettings(),
+    metadata: Optional[dict] = None,
+) -> BaseDataSet:
+    return BaseDataSet(
+        dataset_entries={
+            entry.identifier: entry
+            for entry in iter_dir_juergen(pdir, cpus, settings, metadata)
+        }
+    )
 
 
 if __name__ == "__main__":
@@ -42,7 +174,27 @@ if __name__ == "__main__":
         "--cpus",
         required=True,
         type=int,
-        help="CPU cores to use.",
+        help="CPU cores to use for decoding juergen's frames, eliane datasets "
+        "are always decoded sequentially.",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["pickle", "frame_store"],
+        default="pickle",
+        help="'frame_store' writes a directory of memory-mappable frames.",
+    )
+    parser.add_argument(
+        "--config_outfile",
+        type=str,
+        default=None,
+        help="Where to write the dataset config with the pixel size of the decoded images.",
+    )
+    parser.add_argument(
+        "--profile_outfile",
+        type=str,
+        default=None,
+        help="Where to write the per-stage timings and peak memory (JSON).",
     )
 
     args = parser.parse_args()
@@ -51,13 +203,53 @@ if __name__ == "__main__":
 
     provider = dataset_config["experimental-parameters"]["provider"]
 
-    if provider.lower() == "eliane":
-        x = load_dir_eliane(args.indir)
-
-    elif provider.lower() == "juergen":
-        x = load_dir_juergen(args.indir)
-
-    else:
+    if provider.lower() not in ["eliane", "juergen"]:
         raise RuntimeError(f"Data provider '{provider}' unknown.")
 
-    x.to_pickle(args.outfile)
+    decode_settings = decode_settings_from_config(dataset_config)
+
+    if provider.lower() == "eliane" and decode_settings != DecodeSettings():
+        # decoding is done by 'ImageDataset.from_directory'
+        raise RuntimeError("'image-decoding' is not supported for provider 'eliane'.")
+
+    adjusted_config = adjust_dataset_config(dataset_config, decode_settings)
+
+    frame_metadata = {
+        "decode_channel": decode_settings.channel,
+        "downscale": decode_settings.downscale,
+        "roi": decode_settings.roi,
+    }
+    if "mum_per_px" in adjusted_config["experimental-parameters"]:
+        frame_metadata["mum_per_px"] = adjusted_config["experimental-parameters"][
+            "mum_per_px"
+        ]
+
+    if args.config_outfile is not None:
+        with open(args.config_outfile, "w") as f:
+            toml.dump(adjusted_config, f)
+
+    with profile_task("prepare_dataset", args.profile_outfile):
+        if args.output_format == "frame_store":
+            # juergen's frames are written as they are read, without ever
+            # assembling the full dataset
+            with stage("decode_and_write_frame_store") as s:
+                if provider.lower() == "eliane":
+                    entries = iter(load_dir_eliane(args.indir))
+                else:
+                    entries = iter_dir_juergen(
+                        args.indir, args.cpus, decode_settings, frame_metadata
+                    )
+
+                s.add_rows(write_frame_store(entries, args.outfile))
+
+        else:
+            with stage("decode"):
+                if provider.lower() == "eliane":
+                    x = load_dir_eliane(args.indir)
+                else:
+                    x = load_dir_juergen(
+                        args.indir, args.cpus, decode_settings, frame_metadata
+                    )
+
+            with stage("to_pickle"):
+                x.to_pickle(args.outfile)